@@ -8,8 +8,16 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'numpy': ['numpy'],
+        'zstd': ['zstandard'],
+        'arrow': ['pyarrow'],
+        'test': ['moto'],
+    },
     entry_points='''
         [console_scripts]
         wikiexport=src.main:main
+        wikiexport-rollup=src.main:rollup
+        wikiexport-benchmark=src.benchmark.main:main
     ''',
 )
\ No newline at end of file
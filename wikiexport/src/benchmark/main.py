@@ -0,0 +1,118 @@
+from typing import Dict, Optional
+import json
+import platform
+import sys
+import tempfile
+import time
+
+import click
+
+from src.benchmark.stages import StageBenchmark, StageResult
+from src.benchmark.synthetic import SyntheticDump
+
+
+# relative change of the time of a stage under which it's reported as unchanged by --compare
+TOLERANCE = 0.1
+
+
+@click.command()
+
+@click.option('--nb-lines',
+              help='number of lines of the synthetic dump. An hourly dump has about 5 millions',
+              type=click.IntRange(min=1), default=1000000, show_default=True)
+
+@click.option('--nb-domains',
+              help='number of domains of the synthetic dump',
+              type=click.IntRange(min=1), default=1000, show_default=True)
+
+@click.option('--seed',
+              help='seed of the synthetic dump: the same seed and sizes always give the same dump',
+              type=click.INT, default=0, show_default=True)
+
+@click.option('--repeat',
+              help='number of runs of each stage, the best time is kept',
+              type=click.IntRange(min=1), default=3, show_default=True)
+
+@click.option('--stage', 'stage_names',
+              help='stage to run, can be repeated. All of them by default',
+              type=click.Choice(StageBenchmark.STAGE_NAMES), multiple=True)
+
+@click.option('--output',
+              help='JSON file where to write the results',
+              type=click.Path(dir_okay=False, writable=True))
+
+@click.option('--compare',
+              help='JSON file of a previous run to compare the results with',
+              type=click.Path(exists=True, dir_okay=False))
+
+def main(nb_lines, nb_domains, seed, repeat, stage_names, output, compare):
+    """ Benchmarks the stages of the pipeline on a synthetic dump
+    """
+
+    dump = SyntheticDump(nb_lines, nb_domains, seed)
+    click.echo(click.style(f'Benchmarking {len(stage_names) or "all the"} stage(s) on {nb_lines} lines ...',
+                           fg='green'))
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = StageBenchmark(dump, work_dir, repeat).run(list(stage_names or StageBenchmark.STAGE_NAMES))
+
+    report = {'metadata': {'nb_lines': nb_lines, 'nb_domains': nb_domains, 'seed': seed, 'repeat': repeat,
+                           'python': sys.version.split()[0], 'platform': platform.platform(),
+                           'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'stages': {stage_name: _to_dict(result) for stage_name, result in results.items()}}
+
+    for stage_name, stage in report['stages'].items():
+        if stage is None:
+            click.echo(click.style(f'{stage_name}: skipped, its optional dependency is not installed', fg='yellow'))
+        else:
+            click.echo(f'{stage_name}: {stage["seconds"]:.4f} s, {stage["items_per_second"]:,.0f} items/s')
+
+    if output:
+        with open(output, 'w') as file_handle:
+            json.dump(report, file_handle, indent=2)
+        click.echo(click.style(f'Results written in {output}', fg='green'))
+
+    if compare:
+        with open(compare) as file_handle:
+            _echo_comparison(json.load(file_handle), report)
+
+
+def _to_dict(result: Optional[StageResult]) -> Optional[Dict[str, float]]:
+    """ JSON friendly result of a stage, with its throughput
+
+    :param result: result of the stage, None when skipped
+    :return: dict(seconds, items, bytes, items_per_second, megabytes_per_second) or None
+    """
+
+    if result is None:
+        return None
+
+    return {'seconds': result.seconds, 'items': result.items, 'bytes': result.bytes,
+            'items_per_second': result.items / result.seconds,
+            'megabytes_per_second': result.bytes / 1024 ** 2 / result.seconds}
+
+
+def _echo_comparison(previous_report: dict, report: dict) -> None:
+    """ Prints the change of time of the stages both reports have
+
+    :param previous_report: report of the previous run
+    :param report: report of this run
+    :return: None
+    """
+
+    for key in ('nb_lines', 'nb_domains', 'seed'):
+        if previous_report['metadata'].get(key) != report['metadata'][key]:
+            click.echo(click.style(f'The previous run used another {key}: the times are not comparable', fg='yellow'))
+
+    for stage_name, stage in report['stages'].items():
+        previous_stage = previous_report['stages'].get(stage_name)
+        if stage is None or previous_stage is None:
+            continue
+        change = stage['seconds'] / previous_stage['seconds'] - 1
+        if change > TOLERANCE:
+            color = 'red'
+        elif change < -TOLERANCE:
+            color = 'green'
+        else:
+            color = None
+        click.echo(click.style(f'{stage_name}: {previous_stage["seconds"]:.4f} s -> {stage["seconds"]:.4f} s '
+                               f'({change:+.1%})', fg=color))
@@ -0,0 +1,164 @@
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+import os
+import time
+
+import boto3
+
+from src.benchmark.synthetic import SyntheticDump
+from src.model.blacklist import BlacklistFilter
+from src.model.engine import Engine
+from src.model.pageview import Pageview
+from src.model.wikimedia import Wikimedia
+from src.model.writer import LocalWriter, S3Writer, Writer
+
+try:
+    import moto
+except ImportError:
+    # moto is an optional test dependency: pip install ./wikiexport[test]
+    moto = None
+
+
+class StageResult(NamedTuple):
+    """
+    Best time of a stage out of the repeated runs, with the number of items (lines, keys or pageviews) it processed
+    and the number of bytes it read or wrote
+    """
+
+    seconds: float
+    items: int
+    bytes: int = 0
+
+
+class StageBenchmark:
+    """
+    Times each stage of the pipeline on a SyntheticDump: reading the gzipped dump, building pageviews, the blacklist
+    lookups, the top K, the sort and both writers. The inputs of a stage are prepared before it's timed, and each
+    stage is run `repeat` times to keep its best time. Stages whose optional dependency isn't installed are skipped
+    """
+
+    STAGE_NAMES = ('read_lines', 'read_raw_lines', 'instance_from_pageview_line', 'blacklist_set', 'blacklist_filter',
+                   'get_top_pageviews_per_domain', 'python_engine', 'numpy_engine', 'sort', 'local_writer',
+                   's3_writer')
+
+
+    def __init__(self, dump: SyntheticDump, work_dir: str, repeat: int = 3, nb_blacklist_keys: int = 1000) -> None:
+        """ Instantiates the benchmark of a dump
+
+        :param dump: synthetic dump processed by the stages
+        :param work_dir: directory of the dump file and of the written results
+        :param repeat: number of runs of each stage
+        :param nb_blacklist_keys: size of the blacklist
+        """
+
+        self.dump = dump
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.nb_blacklist_keys = nb_blacklist_keys
+
+
+    def run(self, stage_names: List[str] = STAGE_NAMES) -> Dict[str, Optional[StageResult]]:
+        """ Runs the stages in the order of the pipeline
+
+        :param stage_names: stages to run, among STAGE_NAMES
+        :return: dict(stage name -> result, None when skipped)
+        """
+
+        file_path = self.dump.write_gzip(os.path.join(self.work_dir, 'pageviews.gz'))
+        file_size = os.path.getsize(file_path)
+        lines = list(Wikimedia._read_lines(file_path))
+        raw_lines = list(Wikimedia._read_raw_lines(file_path))
+        pageviews = [Pageview.instance_from_pageview_line(line) for line in lines]
+        keys = [tuple(line.split(b' ', 2)[:2]) for line in raw_lines]
+        blacklist_keys = self.dump.get_blacklist_keys(self.nb_blacklist_keys)
+        blacklist_filter = BlacklistFilter(blacklist_keys)
+        top_pageviews = Engine.instantiate_engine('python').get_top_pageviews_per_domain(raw_lines, blacklist_keys)
+        nb_lines = len(raw_lines)
+
+        stages = {
+            'read_lines': lambda: self._time(lambda: sum(1 for _ in Wikimedia._read_lines(file_path)), nb_lines,
+                                             file_size),
+            'read_raw_lines': lambda: self._time(lambda: sum(1 for _ in Wikimedia._read_raw_lines(file_path)),
+                                                 nb_lines, file_size),
+            'instance_from_pageview_line': lambda: self._time(
+                lambda: [Pageview.instance_from_pageview_line(line) for line in lines], nb_lines),
+            'blacklist_set': lambda: self._time(lambda: sum(key in blacklist_keys for key in keys), nb_lines),
+            'blacklist_filter': lambda: self._time(lambda: sum(key in blacklist_filter for key in keys), nb_lines),
+            'get_top_pageviews_per_domain': lambda: self._time(
+                lambda: Wikimedia.get_top_pageviews_per_domain(pageviews), nb_lines),
+            'python_engine': lambda: self._time_engine('python', raw_lines, blacklist_keys),
+            'numpy_engine': lambda: self._time_engine('numpy', raw_lines, blacklist_keys),
+            'sort': lambda: self._time(lambda: Wikimedia.sort_pageviews_per_domain_and_views(list(top_pageviews)),
+                                       len(top_pageviews)),
+            'local_writer': lambda: self._time_writer(LocalWriter(self.work_dir), top_pageviews),
+            's3_writer': lambda: self._time_s3_writer(top_pageviews),
+        }
+
+        return {stage_name: stages[stage_name]() for stage_name in stage_names}
+
+
+    def _time(self, func: Callable, items: int, nb_bytes: int = 0) -> StageResult:
+        """ Best time of func out of repeat runs
+
+        :param func: the stage
+        :param items: number of items processed by a run
+        :param nb_bytes: number of bytes processed by a run
+        :return: the result of the stage
+        """
+
+        best_seconds = float('inf')
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            func()
+            best_seconds = min(best_seconds, time.perf_counter() - start)
+
+        return StageResult(best_seconds, items, nb_bytes)
+
+
+    def _time_engine(self, engine_name: str, raw_lines: List[bytes],
+                     blacklist_keys: Set[Tuple[bytes, bytes]]) -> Optional[StageResult]:
+        """ Times the fused parse, filter and rank of an engine with the plain blacklist set, as the command runs it
+        by default
+
+        :param engine_name: one of Engine.ENGINE_NAMES
+        :param raw_lines: lines of the dump
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8
+        :return: the result of the stage, None when the engine isn't installed
+        """
+
+        try:
+            engine = Engine.instantiate_engine(engine_name)
+        except ImportError:
+            return None
+
+        return self._time(lambda: engine.get_top_rows_per_domain(raw_lines, blacklist_keys), len(raw_lines))
+
+
+    def _time_writer(self, writer: Writer, pageviews: List[Pageview]) -> StageResult:
+        """ Times the encoding and the write of the top pageviews
+
+        :param writer: the writer
+        :param pageviews: the top pageviews
+        :return: the result of the stage, with the size of the written CSV
+        """
+
+        result = self._time(lambda: writer.write_pageviews(pageviews, datetime(2020, 1, 1)), len(pageviews))
+        nb_bytes = sum(len(chunk) for chunk in writer.output_format.encode(pageviews))
+
+        return result._replace(bytes=nb_bytes)
+
+
+    def _time_s3_writer(self, pageviews: List[Pageview]) -> Optional[StageResult]:
+        """ Times the S3Writer against the S3 stand-in of moto: it measures the encoding and the client side of the
+        upload, not the network
+
+        :param pageviews: the top pageviews
+        :return: the result of the stage, None when moto isn't installed
+        """
+
+        if moto is None:
+            return None
+
+        with moto.mock_aws():
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='benchmark')
+            return self._time_writer(S3Writer('s3://benchmark/results', 'key', 'secret'), pageviews)
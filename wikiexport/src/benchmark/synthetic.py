@@ -0,0 +1,109 @@
+from typing import Generator, List, Set, Tuple
+import gzip
+import random
+
+
+class SyntheticDump:
+    """
+    Deterministic stand-in for an hourly pageviews dump: the same nb_lines and seed always give the same lines.
+    Like the real dumps, lines are sorted by domain, (domain, page_title) pairs are unique, domain sizes follow a Zipf
+    law (a few domains such as en or en.m have most of the lines) and view counts are long-tailed (most pages are
+    viewed once, a few thousands of times)
+    """
+
+    MAIN_DOMAINS = ('en', 'en.m', 'de', 'de.m', 'ja', 'ja.m', 'es', 'es.m', 'ru', 'ru.m', 'fr', 'fr.m', 'it', 'it.m',
+                    'zh', 'zh.m', 'pt', 'pt.m', 'pl', 'pl.m', 'commons.m')
+    DOMAIN_SUFFIXES = ('', '.m', '.b', '.d', '.q', '.s', '.v', '.voy')
+    # exponents of the Zipf law of the domain sizes and of the Pareto law of the view counts
+    DOMAIN_SKEW = 1.1
+    VIEW_COUNT_SHAPE = 1.2
+    # one title out of NON_ASCII_RATE isn't ASCII
+    NON_ASCII_RATE = 20
+
+
+    def __init__(self, nb_lines: int, nb_domains: int = 1000, seed: int = 0) -> None:
+        """ Instantiates a synthetic dump
+
+        :param nb_lines: number of lines of the dump
+        :param nb_domains: number of domains, the first ones being MAIN_DOMAINS
+        :param seed: seed of the random generator
+        """
+
+        self.nb_lines = nb_lines
+        self.nb_domains = nb_domains
+        self.seed = seed
+
+
+    def get_domains(self) -> List[str]:
+        """ The domains of the dump, from the largest to the smallest
+
+        :return: list of domains
+        """
+
+        domains = list(self.MAIN_DOMAINS[:self.nb_domains])
+        for i in range(len(domains), self.nb_domains):
+            domains.append(f'l{i}{self.DOMAIN_SUFFIXES[i % len(self.DOMAIN_SUFFIXES)]}')
+
+        return domains
+
+
+    def get_lines(self) -> Generator[bytes, None, None]:
+        """ The lines of the dump, as read from the decompressed file (domain page_title view_count response_size)
+
+        :return: generator of raw lines ending with a new line
+        """
+
+        rng = random.Random(self.seed)
+        domains = self.get_domains()
+        weights = [1 / rank ** self.DOMAIN_SKEW for rank in range(1, len(domains) + 1)]
+        domain_sizes = [0] * len(domains)
+        for domain_index in rng.choices(range(len(domains)), weights, k=self.nb_lines):
+            domain_sizes[domain_index] += 1
+
+        for domain, domain_size in sorted(zip(domains, domain_sizes)):
+            encoded_domain = domain.encode('utf-8')
+            for title_number in range(domain_size):
+                view_count = int(rng.paretovariate(self.VIEW_COUNT_SHAPE))
+                yield b'%s %s %d 0\n' % (encoded_domain, self._get_title(title_number), view_count)
+
+
+    def write_gzip(self, file_path: str) -> str:
+        """ Writes the dump gzipped, like the files of dumps.wikimedia.org
+
+        :param file_path: path of the file
+        :return: file_path
+        """
+
+        with gzip.open(file_path, 'wb', compresslevel=6) as file_handle:
+            file_handle.writelines(self.get_lines())
+
+        return file_path
+
+
+    def get_blacklist_keys(self, nb_keys: int) -> Set[Tuple[bytes, bytes]]:
+        """ Deterministic blacklist of nb_keys (domain, page_title) pairs of the dump, most of them among the most
+        viewed pages so they change the top K
+
+        :param nb_keys: number of keys
+        :return: set of (domain, page_title) encoded in UTF-8
+        """
+
+        rng = random.Random(self.seed + 1)
+        rows = [line.split(b' ')[:3] for line in self.get_lines()]
+        rows.sort(key=lambda row: -int(row[2]))
+        candidates = rows[:max(nb_keys * 2, 1)]
+
+        return {(domain, page_title) for domain, page_title, _ in rng.sample(candidates, min(nb_keys, len(candidates)))}
+
+
+    def _get_title(self, title_number: int) -> bytes:
+        """ Unique title of a domain
+
+        :param title_number: rank of the title in its domain
+        :return: title encoded in UTF-8
+        """
+
+        if title_number % self.NON_ASCII_RATE == 0:
+            return f'Ça_été_{title_number}'.encode('utf-8')
+
+        return b'Page_%d' % title_number
@@ -1,10 +1,25 @@
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+import time
+
 import click
 
 from src.utils import get_yesterday_datetime_hour, get_datetime_hours_between
-from src.model.wikimedia import Wikimedia
-from src.model.cache import LocalCache
+from src.model.aggregate import AggregateStore, ErrorBound, Rollup
+from src.model.cache import SqliteCache
 from src.model.blacklist import BlackList
+from src.model.engine import Engine
+from src.model.output_format import OutputFormat
+from src.model.profiler import HourProfiler
+from src.model.result_cache import ResultCache
+from src.model.wikimedia import Wikimedia
 from src.model.writer import Writer
+from src.pipeline import compute_datetime_hour, process_datetime_hours, ProcessingOptions
+
+
+# seconds between two checks of the hours claimed by another run
+LEASE_POLL_INTERVAL = 10
+
 
 @click.command()
 
@@ -18,34 +33,382 @@ from src.model.writer import Writer
               type=click.DateTime(formats=['%Y%m%dT%H:00:00']))
 
 @click.option('--output',
-              help= 'output path where to put CSV files. Can be a directory or an S3 bucket of the form s3://mybucket/my-folder',
-              type=click.STRING, required=True, default='/tmp', show_default='/tmp')
+              help= 'output path where to put CSV files. Can be a directory or an S3 bucket of the form s3://mybucket/my-folder. '
+                    'Repeat it to write every result to several destinations (computed once, written concurrently)',
+              type=click.STRING, required=True, multiple=True, default=['/tmp'], show_default='/tmp')
+
+@click.option('--aws-access-key-id', type=click.STRING, help='AWS credentials: ACCESS KEY ID')
+@click.option('--aws-secret-access-key', type=click.STRING, help='AWS credentials: SECRET ACCESS KEY')
+
+@click.option('--workers',
+              help='number of processes used to process the hours of the datetime range in parallel',
+              type=click.IntRange(min=1), default=1, show_default=True)
+
+@click.option('--stage-to-disk',
+              help='download each dump file to /tmp before reading it instead of decompressing it while it\'s downloaded',
+              is_flag=True, default=False)
+
+@click.option('--prefetch-depth',
+              help='number of upcoming hours downloaded in the background while the current one is computed. '
+                   'Only used when --workers is 1',
+              type=click.IntRange(min=0), default=0, show_default=True)
+
+@click.option('--prefetch-disk-budget',
+              help='maximum size in MB of the prefetched files waiting in /tmp',
+              type=click.IntRange(min=1), default=2048, show_default=True)
+
+@click.option('--engine',
+              help='engine computing the top 25 of each domain. numpy requires the numpy extra',
+              type=click.Choice(Engine.ENGINE_NAMES), default='python', show_default=True)
+
+@click.option('--parse-processes',
+              help='number of processes parsing a single hour: the dump is decompressed once and its blocks are '
+                   'parsed in parallel. Only used when --workers is 1',
+              type=click.IntRange(min=1), default=1, show_default=True)
+
+@click.option('--claimed-hours',
+              help='what to do with the hours another run is processing: wait for its results (or for its lease to '
+                   'expire) or skip them',
+              type=click.Choice(['wait', 'skip']), default='wait', show_default=True)
+
+@click.option('--lease-ttl',
+              help='seconds an hour stays claimed by this run without a new result. Another run can take over the '
+                   'hours of a run that died once their lease expired',
+              type=click.IntRange(min=1), default=1800, show_default=True)
+
+@click.option('--result-cache-size',
+              help='maximum size in MB of the computed results kept in /tmp so an hour can be written to another '
+                   'output without being processed again. 0 disables the result cache',
+              type=click.IntRange(min=0), default=256, show_default=True)
+
+@click.option('--validate-cache',
+              help='check that the cached results of the datetime range still exist in the output (in bulk) and '
+                   'process again the ones that were deleted',
+              is_flag=True, default=False)
+
+@click.option('--write-queue-size',
+              help='number of computed hours that can wait for their result to be written in the background while '
+                   'the next hour is computed. 0 writes each hour before computing the next one. Only used when '
+                   '--workers is 1',
+              type=click.IntRange(min=0), default=2, show_default=True)
+
+@click.option('--format', 'output_format',
+              help='format of the result files: CSV, compressed CSV (csv.zst requires the zstd extra) or columnar '
+                   '(parquet and arrow require the arrow extra)',
+              type=click.Choice(OutputFormat.FORMAT_NAMES), default='csv', show_default=True)
+
+@click.option('--aggregate-size',
+              help='persist the top N pages (at least 25) of each domain of the processed hours in /tmp so '
+                   'wikiexport-rollup can use them without downloading the dumps again. 0 persists the full counts',
+              type=click.IntRange(min=0))
+
+@click.option('--metrics-dir',
+              help='directory where the time, bytes, rows and peak RSS of the stages of each hour are exported, as '
+                   'JSON lines (wikiexport_metrics.jsonl) and for the Prometheus textfile collector (wikiexport.prom)',
+              type=click.Path(file_okay=False, writable=True))
+
+@click.option('--blacklist-prefilter',
+              help='look the blacklist up through a Bloom filter and print the lookups, prefilter hits and false '
+                   'positives of each hour. It is slower than the plain set lookups',
+              is_flag=True)
+
+@click.option('--profile',
+              help='profile each processed hour with cProfile (cpu), tracemalloc (memory) or both. The profile '
+                   '(.prof) and the allocation snapshot (.tracemalloc) are saved next to the result of the hour and '
+                   'a summary of the hot spots is printed. Profiling slows the processing down, memory most',
+              type=click.Choice(HourProfiler.MODES))
+
+@click.option('--profile-top',
+              help='number of functions and of lines printed in the summary of each profile',
+              type=click.IntRange(min=1), default=20, show_default=True)
+
+def main(start_datetime, end_datetime, output, aws_access_key_id, aws_secret_access_key, workers, stage_to_disk,
+         prefetch_depth, prefetch_disk_budget, engine, parse_processes, claimed_hours, lease_ttl, result_cache_size,
+         validate_cache, write_queue_size, output_format, aggregate_size, metrics_dir, blacklist_prefilter, profile,
+         profile_top):
+
+    if prefetch_depth and workers > 1:
+        raise click.UsageError('--prefetch-depth can only be used when --workers is 1')
+    if parse_processes > 1 and workers > 1:
+        raise click.UsageError('--parse-processes can only be used when --workers is 1')
+    try:
+        Engine.instantiate_engine(engine)
+        OutputFormat.instantiate_format(output_format)
+    except ImportError as e:
+        raise click.UsageError(str(e))
+
+    datetime_hours = get_datetime_hours_between(start_datetime, end_datetime)
+    cache = SqliteCache.get_instance()
+    if blacklist_prefilter:
+        blacklist_keys = BlackList.get_pageviews_blacklist_filter()
+    else:
+        blacklist_keys = BlackList.get_pageviews_blacklist_keys()
+
+    options = ProcessingOptions(stage_to_disk=stage_to_disk, prefetch_depth=prefetch_depth,
+                                prefetch_disk_budget=prefetch_disk_budget * 1024 ** 2, engine=engine,
+                                parse_processes=parse_processes, result_cache_size=result_cache_size * 1024 ** 2,
+                                write_queue_size=write_queue_size, output_format=output_format,
+                                aggregate_size=aggregate_size, metrics_dir=metrics_dir, profile=profile,
+                                profile_top=profile_top)
+    writer = Writer.instantiate_writer(output, aws_access_key_id, aws_secret_access_key, output_format)
+    result_cache = ResultCache(options.result_cache_size) if options.result_cache_size else None
+    if validate_cache:
+        _invalidate_missing_results(cache, datetime_hours, writer)
+
+    datetime_hours_to_process, datetime_hours_claimed = _claim_hours(cache, datetime_hours, writer, result_cache,
+                                                                     lease_ttl)
+    failed_datetime_hours = _process_claimed_hours(cache, datetime_hours_to_process, blacklist_keys, output,
+                                                   aws_access_key_id, aws_secret_access_key, workers, options,
+                                                   lease_ttl)
+
+    while datetime_hours_claimed and claimed_hours == 'wait':
+        time.sleep(LEASE_POLL_INTERVAL)
+        # hours the other run released (they failed) or whose lease expired (it died) are taken over
+        datetime_hours_to_process, datetime_hours_claimed = _claim_hours(cache, datetime_hours_claimed, writer,
+                                                                         result_cache, lease_ttl, verbose=False)
+        failed_datetime_hours += _process_claimed_hours(cache, datetime_hours_to_process, blacklist_keys, output,
+                                                        aws_access_key_id, aws_secret_access_key, workers, options,
+                                                        lease_ttl)
+
+    for datetime_hour in datetime_hours_claimed:
+        click.echo(click.style(f'{datetime_hour} skipped, it\'s being processed by another run', fg='yellow'))
+
+    if failed_datetime_hours:
+        failed = ', '.join(str(datetime_hour) for datetime_hour in sorted(failed_datetime_hours))
+        raise click.ClickException(f'{len(failed_datetime_hours)} hour(s) could not be processed: {failed}')
+
+
+def _invalidate_missing_results(cache: SqliteCache, datetime_hours: List[datetime], writer: Writer) -> None:
+    """ Removes from the cache the hours whose result was written at the path of writer but doesn't exist anymore.
+    The entries are read and the paths checked in bulk, see SqliteCache.get_entries and Writer.get_existing_paths
+
+    :param cache: cache of the processed hours
+    :param datetime_hours: hours to validate
+    :param writer: writer of this run
+    :return: None
+    """
+
+    click.echo(click.style(f'Validating the cached results of {len(datetime_hours)} hour(s) ...', fg='green'))
+    cached_paths = {datetime_hour: file_path for datetime_hour, file_path in cache.get_entries(datetime_hours).items()
+                    if file_path == writer.get_path(datetime_hour)}
+    existing_paths = writer.get_existing_paths(cached_paths.values())
+    missing_datetime_hours = sorted(datetime_hour for datetime_hour, file_path in cached_paths.items()
+                                    if file_path not in existing_paths)
+
+    cache.remove_entries(missing_datetime_hours)
+    for datetime_hour in missing_datetime_hours:
+        click.echo(click.style(f'Result of {datetime_hour} not found in {cached_paths[datetime_hour]}, '
+                               f'it will be processed again', fg='yellow'))
+
+
+def _claim_hours(cache: SqliteCache, datetime_hours: List[datetime], writer: Writer,
+                 result_cache: Optional[ResultCache], lease_ttl: int,
+                 verbose: bool = True) -> Tuple[List[datetime], List[datetime]]:
+    """ Sorts hours into the ones already written at the path of writer, the ones this run claims and the ones
+    claimed by another run. A claimed hour whose result is in result_cache is written right away instead of being
+    processed
+
+    :param cache: cache of the processed hours and their leases
+    :param datetime_hours: hours to sort
+    :param writer: writer of this run
+    :param result_cache: cache of the computed results, None when disabled
+    :param lease_ttl: duration of the leases in seconds
+    :param verbose: when False, the hours claimed by another run are not reported
+    :return: (hours to process, hours claimed by another run)
+    """
+
+    datetime_hours_to_process, datetime_hours_claimed = [], []
+    for datetime_hour in datetime_hours:
+        file_path = writer.get_path(datetime_hour)
+        if cache.get_entry(datetime_hour) == file_path:
+            click.echo(click.style(f'{datetime_hour} already processed. Result can be found in {file_path}', fg='green'))
+        elif cache.claim_entry(datetime_hour, lease_ttl, file_path):
+            if not _write_cached_result(cache, datetime_hour, writer, result_cache):
+                datetime_hours_to_process.append(datetime_hour)
+        else:
+            datetime_hours_claimed.append(datetime_hour)
+            if verbose:
+                click.echo(click.style(f'{datetime_hour} is being processed by another run', fg='yellow'))
+
+    return datetime_hours_to_process, datetime_hours_claimed
+
+
+def _write_cached_result(cache: SqliteCache, datetime_hour: datetime, writer: Writer,
+                         result_cache: Optional[ResultCache]) -> bool:
+    """ Writes the cached result of an hour claimed by this run, without downloading its dump
+
+    :param cache: cache of the processed hours
+    :param datetime_hour: hour claimed by this run
+    :param writer: writer of this run
+    :param result_cache: cache of the computed results, None when disabled
+    :return: True if the result was cached and written, False if the hour must be processed
+    """
+
+    pageviews = result_cache.get_pageviews(datetime_hour) if result_cache is not None else None
+    if pageviews is None:
+        return False
+
+    try:
+        result_path = writer.write_pageviews(pageviews, datetime_hour)
+    except Exception as e:
+        click.echo(click.style(f'Cached result of {datetime_hour} could not be written, it will be processed. '
+                               f'Exception {type(e)} occurred with arguments: {e.args}', fg='yellow'))
+        return False
+
+    cache.set_entry(datetime_hour, result_path)
+    click.echo(click.style(f'Results for {datetime_hour} written from the result cache in {result_path}', fg='green'))
+
+    return True
+
+
+def _process_claimed_hours(cache: SqliteCache, datetime_hours: List[datetime], blacklist_keys: Set[Tuple[bytes, bytes]],
+                           output: Sequence[str], aws_access_key_id: str, aws_secret_access_key: str, workers: int,
+                           options: ProcessingOptions, lease_ttl: int) -> List[datetime]:
+    """ Processes hours claimed by this run and records each result in the cache as soon as it's written. The leases
+    of the pending hours are renewed every time a result comes and released when an hour fails or the run stops
+
+    :param cache: cache holding the leases of datetime_hours
+    :param datetime_hours: hours claimed by this run
+    :param blacklist_keys: blacklisted (domain, page_title) encoded in UTF-8
+    :param output: output paths given to Writer.instantiate_writer
+    :param aws_access_key_id: AWS credentials: ACCESS KEY ID
+    :param aws_secret_access_key: AWS credentials: SECRET ACCESS KEY
+    :param workers: number of processes to use
+    :param options: options of the processing
+    :param lease_ttl: duration of the leases in seconds
+    :return: hours that failed
+    """
+
+    failed_datetime_hours = []
+    pending_datetime_hours = set(datetime_hours)
+    try:
+        results = process_datetime_hours(datetime_hours, blacklist_keys, output,
+                                         aws_access_key_id, aws_secret_access_key, workers, options)
+        for datetime_hour, result_path, exception in results:
+            pending_datetime_hours.discard(datetime_hour)
+            if exception is None:
+                cache.set_entry(datetime_hour, result_path)
+                click.echo(click.style(f'Results for {datetime_hour} can be found in {cache.get_entry(datetime_hour)}', fg='green'))
+            else:
+                cache.release_claims([datetime_hour])
+                failed_datetime_hours.append(datetime_hour)
+                click.echo(click.style(f'Processing {datetime_hour} failed. Exception {type(exception)} occurred with arguments: {exception.args}', fg='red'))
+            cache.renew_claims(pending_datetime_hours, lease_ttl)
+    finally:
+        cache.release_claims(pending_datetime_hours)
+
+    return failed_datetime_hours
+
+
+@click.command()
+
+@click.option('--start-datetime',
+              help='first hour (truncated to the hour) of the datetime range to roll up',
+              type=click.DateTime(formats=['%Y%m%dT%H:00:00']),
+              default=get_yesterday_datetime_hour(), show_default='yesterday\'s hour' , required=True)
+
+@click.option('--end-datetime',
+              help='end datetime inclusive (truncated to the hour) of the datetime range to roll up',
+              type=click.DateTime(formats=['%Y%m%dT%H:00:00']))
+
+@click.option('--output',
+              help= 'output path where to put the result. Can be a directory or an S3 bucket of the form '
+                    's3://mybucket/my-folder. Repeat it to write the result to several destinations',
+              type=click.STRING, required=True, multiple=True, default=['/tmp'], show_default='/tmp')
 
 @click.option('--aws-access-key-id', type=click.STRING, help='AWS credentials: ACCESS KEY ID')
 @click.option('--aws-secret-access-key', type=click.STRING, help='AWS credentials: SECRET ACCESS KEY')
 
-def main(start_datetime, end_datetime, output, aws_access_key_id, aws_secret_access_key):
+@click.option('--aggregate-size',
+              help='number of pages of each domain (at least 25) kept in the aggregates of the hours that were not '
+                   'aggregated yet. The larger, the smaller the error bound. 0 keeps the full counts',
+              type=click.IntRange(min=0), default=1000, show_default=True)
+
+@click.option('--sketch-capacity',
+              help='maximum number of pages counted per domain over the range (Space-Saving), so memory doesn\'t grow '
+                   'with the length of the range. Counts become lower bounds whose error is reported. By default '
+                   'every page is counted',
+              type=click.IntRange(min=25))
+
+@click.option('--stage-to-disk',
+              help='download each dump file to /tmp before reading it instead of decompressing it while it\'s downloaded',
+              is_flag=True, default=False)
+
+@click.option('--engine',
+              help='engine computing the aggregates. numpy requires the numpy extra',
+              type=click.Choice(Engine.ENGINE_NAMES), default='python', show_default=True)
 
+@click.option('--format', 'output_format',
+              help='format of the result file',
+              type=click.Choice(OutputFormat.FORMAT_NAMES), default='csv', show_default=True)
+
+def rollup(start_datetime, end_datetime, output, aws_access_key_id, aws_secret_access_key, aggregate_size,
+           sketch_capacity, stage_to_disk, engine, output_format):
+    """ Computes the top 25 pages of each domain over a datetime range from the hourly aggregates. Only the hours
+    that were not aggregated yet (see the --aggregate-size option of wikiexport) are downloaded
+    """
+
+    try:
+        Engine.instantiate_engine(engine)
+        OutputFormat.instantiate_format(output_format)
+    except ImportError as e:
+        raise click.UsageError(str(e))
+
+    end_datetime = end_datetime or start_datetime
     datetime_hours = get_datetime_hours_between(start_datetime, end_datetime)
-    cache = LocalCache.get_instance()
-    pageviews_blacklist = BlackList.get_pageviews_blacklist()
-    writer = Writer.instantiate_writer(output, aws_access_key_id, aws_secret_access_key)
+    options = ProcessingOptions(stage_to_disk=stage_to_disk, engine=engine, aggregate_size=aggregate_size)
+    aggregate_store = AggregateStore()
+    blacklist_keys = None
+    range_rollup = Rollup(sketch_capacity)
+    failed_datetime_hours = []
 
     for datetime_hour in datetime_hours:
-        click.echo(click.style(f'processing request for {datetime_hour}', fg='green'))
-        if datetime_hour not in cache:
-            click.echo(click.style('Downloading data ...', fg='green'))
-            pageviews = Wikimedia.get_pageviews(datetime_hour)
-            click.echo(click.style('Filtering data ...', fg='green'))
-            filtered_pageviews = (pageview for pageview in pageviews if pageview not in pageviews_blacklist)
-            click.echo(click.style('Computing top 25 for each domain ...', fg='green'))
-            top_pageviews_per_domain = Wikimedia.get_top_pageviews_per_domain(filtered_pageviews)
-            Wikimedia.sort_pageviews_per_domain_and_views(top_pageviews_per_domain)
-            click.echo(click.style('Writing pageviews ...', fg='green'))
-            result_path = writer.write_pageviews(top_pageviews_per_domain, datetime_hour)
-            cache.set_entry(datetime_hour, result_path)
-            click.echo(click.style(f'Results can be found in {cache.get_entry(datetime_hour)}', fg='green'))
+        aggregate = aggregate_store.get_aggregate(datetime_hour)
+        if aggregate is None:
+            if blacklist_keys is None:
+                blacklist_keys = BlackList.get_pageviews_blacklist_keys()
+            try:
+                compute_datetime_hour(datetime_hour, blacklist_keys, options)
+            except Exception as e:
+                failed_datetime_hours.append(datetime_hour)
+                click.echo(click.style(f'Aggregating {datetime_hour} failed. Exception {type(e)} occurred with '
+                                       f'arguments: {e.args}', fg='red'))
+                continue
+            aggregate = aggregate_store.get_aggregate(datetime_hour)
         else:
-            click.echo(click.style(f'{datetime_hour} already processed. Result can be found in {cache.get_entry(datetime_hour)}', fg='green'))
+            click.echo(click.style(f'{datetime_hour} already aggregated', fg='green'))
+        range_rollup.add_aggregate(aggregate)
+
+    if failed_datetime_hours:
+        failed = ', '.join(str(datetime_hour) for datetime_hour in failed_datetime_hours)
+        raise click.ClickException(f'{len(failed_datetime_hours)} hour(s) could not be aggregated: {failed}')
+
+    top_rows_per_domain, error_bounds = range_rollup.get_top_rows_per_domain()
+    pageviews = Wikimedia.rows_to_pageviews(top_rows_per_domain)
+    Wikimedia.sort_pageviews_per_domain_and_views(pageviews)
+
+    # the result is named after the range: <start>--<end>.<extension>
+    file_pattern = f'{Writer.FILE_PATTERN}--{end_datetime.strftime(Writer.FILE_PATTERN)}'
+    writer = Writer.instantiate_writer(output, aws_access_key_id, aws_secret_access_key, output_format, file_pattern)
+    result_path = writer.write_pageviews(pageviews, start_datetime)
+    error_bounds_path = writer.write_bytes(range_rollup.encode_error_bounds(top_rows_per_domain, error_bounds),
+                                           start_datetime, Rollup.ERROR_BOUNDS_EXTENSION)
+
+    click.echo(click.style(f'Rollup of {len(datetime_hours)} hour(s) can be found in {result_path}', fg='green'))
+    _echo_error_bounds(error_bounds, error_bounds_path)
+
+
+def _echo_error_bounds(error_bounds: Dict[bytes, ErrorBound], error_bounds_path: str) -> None:
+    """ Reports the error bounds of a rollup
+
+    :param error_bounds: dict(domain -> ErrorBound), see Rollup.get_top_rows_per_domain
+    :param error_bounds_path: path where the error bound of every row was written
+    :return: None
+    """
 
-    cache.save_cache()
\ No newline at end of file
+    max_error = max((error_bound.max_error for error_bound in error_bounds.values()), default=0)
+    nb_guaranteed = sum(error_bound.guaranteed for error_bound in error_bounds.values())
+    color = 'green' if nb_guaranteed == len(error_bounds) else 'yellow'
+    click.echo(click.style(f'Top 25 guaranteed for {nb_guaranteed} out of {len(error_bounds)} domain(s), counts are '
+                           f'at most {max_error} view(s) below the true counts. The bound of every row can be found '
+                           f'in {error_bounds_path}', fg=color))
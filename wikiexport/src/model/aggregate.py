@@ -0,0 +1,247 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import heapq
+import os
+import sys
+import zlib
+
+from src.model.heavy_hitters import SpaceSaving
+
+
+class HourlyAggregate(NamedTuple):
+    """
+    Partial aggregate of an hour: the top `size` (view_count, page_title) of each domain, after the blacklist, and
+    the threshold of each domain. A page missing from the rows of its domain has at most `threshold` views that hour.
+    A size of 0 means full counts: every page is kept and every threshold is 0
+    """
+
+    size: int
+    rows_per_domain: Dict[bytes, List[Tuple[int, bytes]]]
+    thresholds: Dict[bytes, int]
+
+
+    @classmethod
+    def from_top_rows(cls, top_rows_per_domain: Dict[bytes, List[Tuple[int, int, bytes]]],
+                      size: int) -> 'HourlyAggregate':
+        """ Builds the aggregate of the top rows computed by an engine with k = size (or FULL_SIZE when size is 0)
+
+        :param top_rows_per_domain: dict(domain -> list of (view_count, -line_number, page_title))
+        :param size: number of rows kept per domain, 0 for full counts
+        :return: the aggregate
+        """
+
+        rows_per_domain, thresholds = {}, {}
+        for domain, top_rows in top_rows_per_domain.items():
+            rows_per_domain[domain] = [(view_count, page_title) for view_count, _, page_title in top_rows]
+            # the domain may have more pages than the kept ones: none of them had more views than the last kept one
+            if size and len(top_rows) >= size:
+                thresholds[domain] = min(view_count for view_count, _, _ in top_rows)
+
+        return cls(size, rows_per_domain, thresholds)
+
+
+class AggregateStore:
+    """
+    Persists the hourly partial aggregates in DIR_PATH so a range can be rolled up without downloading the dumps of
+    the hours already aggregated. Each hour is a zlib compressed file whose first line is the size of the aggregate,
+    followed by 'domain page_title view_count' lines (the dump format) and 'domain threshold' lines.
+    Files are written to a temporary path then renamed so several runs can share the directory. Unlike ResultCache,
+    aggregates are never evicted
+    """
+
+    DIR_PATH = '/tmp/wikiexporter_aggregates'
+    FILE_PATTERN = '%Y%m%dT%H:%M:%S'
+    # k given to the engines for full counts
+    FULL_SIZE = sys.maxsize
+
+
+    def __init__(self, dir_path: str = None) -> None:
+        """ Instantiates an aggregate store
+
+        :param dir_path: directory of the aggregates, DIR_PATH when None
+        """
+
+        self.dir_path = dir_path or self.DIR_PATH
+
+
+    def get_aggregate(self, dt: datetime) -> Optional[HourlyAggregate]:
+        """ The aggregate of dt
+
+        :param dt: datetime of the request
+        :return: the aggregate, or None when dt was not aggregated
+        """
+
+        try:
+            with open(self._get_file_path(dt), 'rb') as file_handle:
+                content = zlib.decompress(file_handle.read())
+        except (OSError, zlib.error):
+            return None
+
+        lines = content.split(b'\n')
+        rows_per_domain, thresholds = defaultdict(list), {}
+        for line in lines[1:]:
+            fields = line.split(b' ')
+            if len(fields) == 3:
+                rows_per_domain[fields[0]].append((int(fields[2]), fields[1]))
+            elif len(fields) == 2:
+                thresholds[fields[0]] = int(fields[1])
+
+        return HourlyAggregate(int(lines[0]), dict(rows_per_domain), thresholds)
+
+
+    def set_aggregate(self, dt: datetime, aggregate: HourlyAggregate) -> None:
+        """ Persists the aggregate of dt
+
+        :param dt: datetime of the request
+        :param aggregate: the aggregate
+        :return: None
+        """
+
+        lines = [b'%d' % aggregate.size]
+        for domain, rows in aggregate.rows_per_domain.items():
+            lines.extend(b'%s %s %d' % (domain, page_title, view_count) for view_count, page_title in rows)
+        lines.extend(b'%s %d' % (domain, threshold) for domain, threshold in aggregate.thresholds.items())
+
+        os.makedirs(self.dir_path, exist_ok=True)
+        file_path = self._get_file_path(dt)
+        temporary_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file_handle:
+            file_handle.write(zlib.compress(b'\n'.join(lines)))
+        os.replace(temporary_path, file_path)
+
+
+    def _get_file_path(self, dt: datetime) -> str:
+        """ Path of the aggregate of dt
+
+        :param dt: datetime of the request
+        :return: file path
+        """
+
+        return os.path.join(self.dir_path, f'{dt.strftime(self.FILE_PATTERN)}.zlib')
+
+
+class ErrorBound(NamedTuple):
+    """
+    Error bound of the top K of a domain in a rollup: the counts are lower bounds which are at most max_error below
+    the true counts, and when guaranteed is True the top K pages are the true ones
+    """
+
+    max_error: int
+    guaranteed: bool
+
+
+class Rollup:
+    """
+    Merges hourly aggregates into the counts of a range. The count of a page is the sum of its views in the hours it
+    was kept, so it's a lower bound of its true count: in every other hour it had at most the threshold of its
+    domain. The sum of these thresholds is the error bound of the page.
+    With a capacity, the pages of each domain are counted by a SpaceSaving summary of capacity counters instead of
+    every page, so memory doesn't grow with the length of the range. The error of a counter is added to the bounds:
+    the page had at most that many views in the aggregates before its counter was created, so its count minus the
+    error is still a lower bound and its count plus the thresholds it didn't cover an upper bound.
+    The bounds are written next to the result in a CSV file of extension ERROR_BOUNDS_EXTENSION
+    """
+
+    ERROR_BOUNDS_EXTENSION = 'errors.csv'
+    ERROR_BOUNDS_HEADER = 'domain,page_title,pageview_count,max_error,top_guaranteed'
+
+
+    def __init__(self, capacity: Optional[int] = None) -> None:
+        """ Instantiates an empty rollup
+
+        :param capacity: maximum number of pages counted per domain, None to count every page exactly
+        """
+
+        self.capacity = capacity
+        # domain -> summary of page_title -> [view_count, error, sum of the thresholds of the hours it was kept]
+        self.counts = defaultdict(lambda: SpaceSaving(capacity))
+        # domain -> sum of the thresholds of every hour
+        self.total_thresholds = defaultdict(int)
+
+
+    def add_aggregate(self, aggregate: HourlyAggregate) -> None:
+        """ Adds the counts of an hour
+
+        :param aggregate: aggregate of the hour
+        :return: None
+        """
+
+        for domain, threshold in aggregate.thresholds.items():
+            self.total_thresholds[domain] += threshold
+
+        for domain, rows in aggregate.rows_per_domain.items():
+            threshold = aggregate.thresholds.get(domain, 0)
+            domain_counts = self.counts[domain]
+            for view_count, page_title in rows:
+                # the thresholds of the hours before a counter was created are left uncovered
+                domain_counts.add(page_title, view_count)[2] += threshold
+
+
+    def get_top_rows_per_domain(self, k: int = 25) -> Tuple[Dict[bytes, List[Tuple[int, int, bytes]]],
+                                                              Dict[bytes, ErrorBound]]:
+        """ Computes the top K pages of each domain over the range, ranked by the lower bound of their count, and
+        their error bound
+
+        :param k: number of pages kept per domain
+        :return: (dict(domain -> list of (lower bound of view_count, 0, page_title)) as expected by
+                  Wikimedia.rows_to_pageviews, dict(domain -> ErrorBound))
+        """
+
+        top_rows_per_domain, error_bounds = {}, {}
+        for domain, domain_counts in self.counts.items():
+            total_threshold = self.total_thresholds[domain]
+            counters = domain_counts.counters
+            top_titles = heapq.nlargest(k, counters,
+                                        key=lambda page_title: counters[page_title][0] - counters[page_title][1])
+            top_rows_per_domain[domain] = [(counters[page_title][0] - counters[page_title][1], 0, page_title)
+                                           for page_title in top_titles]
+
+            max_error = max((self.get_max_error(domain, page_title) for page_title in top_titles), default=0)
+            # a page outside the top K (or not counted) can't have more views than this upper bound
+            top_set = set(top_titles)
+            max_upper_bound = max((count + total_threshold - covered_threshold
+                                   for page_title, (count, _, covered_threshold) in counters.items()
+                                   if page_title not in top_set), default=0)
+            max_upper_bound = max(max_upper_bound, domain_counts.min_count + total_threshold)
+            guaranteed = (max_upper_bound == 0 if len(top_titles) < k
+                          else top_rows_per_domain[domain][-1][0] >= max_upper_bound)
+            error_bounds[domain] = ErrorBound(max_error, guaranteed)
+
+        return top_rows_per_domain, error_bounds
+
+
+    def get_max_error(self, domain: bytes, page_title: bytes) -> int:
+        """ Error bound of the count of a page: its true count is between its lower bound and the lower bound plus
+        this error
+
+        :param domain: domain encoded in UTF-8
+        :param page_title: page title encoded in UTF-8, counted in the rollup
+        :return: the error bound
+        """
+
+        _, error, covered_threshold = self.counts[domain].counters[page_title]
+
+        return error + self.total_thresholds[domain] - covered_threshold
+
+
+    def encode_error_bounds(self, top_rows_per_domain: Dict[bytes, List[Tuple[int, int, bytes]]],
+                            error_bounds: Dict[bytes, ErrorBound]) -> bytes:
+        """ Encodes the error bound of every row of the result as a CSV file ordered like the result (per domain and
+        view count ascending): the lower bound of the count, how far below the true count it can be and whether the
+        top K of the domain is the true one
+
+        :param top_rows_per_domain: top rows computed by get_top_rows_per_domain
+        :param error_bounds: error bounds computed by get_top_rows_per_domain
+        :return: the CSV file encoded in UTF-8
+        """
+
+        lines = [f'{self.ERROR_BOUNDS_HEADER}\n']
+        for domain in sorted(top_rows_per_domain):
+            guaranteed = str(error_bounds[domain].guaranteed).lower()
+            decoded_domain = domain.decode('utf-8', errors='replace')
+            for view_count, _, page_title in sorted(top_rows_per_domain[domain], key=lambda row: row[0]):
+                lines.append(f'{decoded_domain},{page_title.decode("utf-8", errors="replace")},{view_count},'
+                             f'{self.get_max_error(domain, page_title)},{guaranteed}\n')
+
+        return ''.join(lines).encode('utf-8')
@@ -1,22 +1,34 @@
-from typing import Set
+from contextlib import closing
+from typing import Dict, Set, Tuple, Optional
+from itertools import repeat
+import os
 
+from src.model.bloom import BloomFilter
+from src.model.http_client import HttpClient
 from src.model.pageview import Pageview
 from src.utils import repeat_if_exception
 
 
+import click
 import requests
 
 
 class BlackList:
     """
-    Class that downloads, only once, blacklisted pageviews and saves them in a class attribute
+    Class that downloads, only once, blacklisted pageviews and saves them in a class attribute.
+    The parsed blacklist is persisted in a local index (INDEX_FILE_PATH) along with the ETag and Last-Modified headers
+    of the upstream file: the next invocations send a conditional request and load the index when the blacklist
+    didn't change upstream
     """
 
     BLACKLIST_URL = 'https://s3.amazonaws.com/dd-interview-data/data_engineer/wikipedia/blacklist_domains_and_pages'
+    INDEX_FILE_PATH = '/tmp/wikiexporter_blacklist.idx'
+    INDEX_HEADER = b'wikiexporter-blacklist-index 1'
     PAGEVIEWS_BLACKLIST = set()
+    PAGEVIEWS_BLACKLIST_KEYS = set()
+    PAGEVIEWS_BLACKLIST_FILTER = None
 
     @classmethod
-    @repeat_if_exception(message='Something went wrong when downloading the pageviews blacklist from S3')
     def get_pageviews_blacklist(cls) -> Set['Pageview']:
         """Downloads, only once, a set of pagesviews from the BALCKLIST_URL and saves that in a set.
         If the the pageview were already downloaded, simply return the class attribute
@@ -25,11 +37,223 @@ class BlackList:
         """
 
         if not cls.PAGEVIEWS_BLACKLIST:
-            response = requests.get(cls.BLACKLIST_URL, stream=True)
+            for domain, page_title in cls.get_pageviews_blacklist_keys():
+                cls.PAGEVIEWS_BLACKLIST.add(Pageview(domain.decode('utf-8', errors='replace'),
+                                                     page_title.decode('utf-8', errors='replace'), None))
+
+        return cls.PAGEVIEWS_BLACKLIST
+
+
+    @classmethod
+    def get_pageviews_blacklist_keys(cls) -> Set[Tuple[bytes, bytes]]:
+        """ The blacklist as a set of (domain, page_title) encoded in UTF-8 so it can be checked against the raw lines
+        of a dump without decoding them. Loaded only once, from the local index when it's up to date
+
+        :return: Set of (domain, page_title) to filter out
+        """
+
+        if not cls.PAGEVIEWS_BLACKLIST_KEYS:
+            cls.PAGEVIEWS_BLACKLIST_KEYS = cls._load_blacklist_keys()
+
+        return cls.PAGEVIEWS_BLACKLIST_KEYS
+
+
+    @classmethod
+    def get_pageviews_blacklist_filter(cls) -> 'BlacklistFilter':
+        """ The blacklist keys behind a Bloom filter prefilter, built only once.
+        It can be used wherever the set of blacklist keys is expected
+
+        :return: BlacklistFilter of the blacklist keys
+        """
+
+        if cls.PAGEVIEWS_BLACKLIST_FILTER is None:
+            cls.PAGEVIEWS_BLACKLIST_FILTER = BlacklistFilter(cls.get_pageviews_blacklist_keys())
+
+        return cls.PAGEVIEWS_BLACKLIST_FILTER
+
+
+    @classmethod
+    @repeat_if_exception(message='Something went wrong when downloading the pageviews blacklist from S3')
+    def _load_blacklist_keys(cls) -> Set[Tuple[bytes, bytes]]:
+        """ Sends a conditional request for the blacklist: the local index is used when the upstream file didn't
+        change (304) and is rebuilt otherwise. A stale index is still used if the blacklist can't be downloaded
+
+        :return: Set of (domain, page_title) to filter out
+        """
+
+        index = cls._read_index()
+        headers = {}
+        if index is not None:
+            etag, last_modified, _ = index
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = HttpClient.get(cls.BLACKLIST_URL, headers)
+
+        # closed on every path so the connection goes back to the pool
+        with closing(response):
+            if response.status_code == requests.codes.not_modified and index is not None:
+                return index[2]
+
             if response.status_code != requests.codes.ok:
+                if index is not None:
+                    click.echo(click.style('Black list could not be downloaded, using the local index', fg='yellow'))
+                    return index[2]
                 raise Exception('Black list could not be downloaded')
+
+            blacklist_keys = set()
+            encoded_domains = {}
             for line in response.iter_lines():
-                pageview = Pageview.instance_from_balcklist_line(str(line))
-                cls.PAGEVIEWS_BLACKLIST.add(pageview)
+                if not line:
+                    continue
+                domain, page_title = line.split(b' ')
+                # one bytes object per domain shared by all the keys of that domain
+                blacklist_keys.add((encoded_domains.setdefault(domain, domain), page_title))
 
-        return cls.PAGEVIEWS_BLACKLIST
+        try:
+            cls._write_index(response.headers.get('ETag'), response.headers.get('Last-Modified'), blacklist_keys)
+        except OSError as e:
+            click.echo(click.style(f'Black list index could not be saved: {e}', fg='yellow'))
+
+        return blacklist_keys
+
+
+    @classmethod
+    def _read_index(cls) -> Optional[Tuple[Optional[str], Optional[str], Set[Tuple[bytes, bytes]]]]:
+        """ Loads the local index. It's a text file: a header line, the ETag, the Last-Modified header then one line
+        per domain with its blacklisted page titles separated by spaces
+
+        :return: (etag, last_modified, blacklist keys) or None if there is no valid index
+        """
+
+        try:
+            with open(cls.INDEX_FILE_PATH, 'rb') as file_handle:
+                content = file_handle.read()
+        except OSError:
+            return None
+
+        lines = content.split(b'\n')
+        if len(lines) < 3 or lines[0] != cls.INDEX_HEADER:
+            return None
+
+        blacklist_keys = set()
+        for line in lines[3:]:
+            if line:
+                domain, *page_titles = line.split(b' ')
+                blacklist_keys.update(zip(repeat(domain), page_titles))
+
+        etag, last_modified = lines[1].decode('utf-8') or None, lines[2].decode('utf-8') or None
+
+        return etag, last_modified, blacklist_keys
+
+
+    @classmethod
+    def _write_index(cls, etag: Optional[str], last_modified: Optional[str],
+                     blacklist_keys: Set[Tuple[bytes, bytes]]) -> None:
+        """ Saves the blacklist in the local index, see _read_index for the format. The file is replaced atomically
+        so a concurrent invocation never reads a partial index
+
+        :param etag: ETag header of the upstream blacklist
+        :param last_modified: Last-Modified header of the upstream blacklist
+        :param blacklist_keys: Set of (domain, page_title)
+        :return: None
+        """
+
+        page_titles_per_domain = {}
+        for domain, page_title in blacklist_keys:
+            page_titles_per_domain.setdefault(domain, []).append(page_title)
+
+        temporary_path = f'{cls.INDEX_FILE_PATH}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file_handle:
+            file_handle.write(b'\n'.join([cls.INDEX_HEADER, (etag or '').encode('utf-8'),
+                                          (last_modified or '').encode('utf-8')]) + b'\n')
+            for domain, page_titles in page_titles_per_domain.items():
+                file_handle.write(b' '.join([domain] + page_titles) + b'\n')
+        os.replace(temporary_path, cls.INDEX_FILE_PATH)
+
+
+class BlacklistFilter:
+    """
+    Membership test of (domain, page_title) in the blacklist keys. The raw b'domain page_title' key is first looked for
+    in a Bloom filter sized from the length of the blacklist, and the exact set is only probed when it answers maybe.
+    It isn't a speed-up: a pure python Bloom probe is slower than a lookup in the exact set, as the blacklist_set and
+    blacklist_filter stages of wikiexport-benchmark show. It's only used with --blacklist-prefilter, for its counters
+    (lookups, prefilter hits, false positives)
+    """
+
+    FALSE_POSITIVE_RATE = 0.01
+
+
+    def __init__(self, blacklist_keys: Set[Tuple[bytes, bytes]], false_positive_rate: float = FALSE_POSITIVE_RATE
+                 ) -> None:
+        """ Builds the Bloom filter of blacklist_keys
+
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8
+        :param false_positive_rate: expected false positive rate of the Bloom filter
+        """
+
+        self.blacklist_keys = blacklist_keys
+        self.bloom_filter = BloomFilter.from_keys((domain + b' ' + page_title for domain, page_title in blacklist_keys),
+                                                  len(blacklist_keys), false_positive_rate)
+        self.reset_counters()
+
+
+    def __contains__(self, key: Tuple[bytes, bytes]) -> bool:
+        """ inclusion test with the Bloom filter first, then the exact set
+
+        :param key: (domain, page_title) encoded in UTF-8
+        :return: True if the key is blacklisted
+        """
+
+        self.lookups += 1
+        if key[0] + b' ' + key[1] not in self.bloom_filter:
+            return False
+
+        self.prefilter_hits += 1
+        if key in self.blacklist_keys:
+            return True
+
+        self.false_positives += 1
+        return False
+
+
+    def __len__(self) -> int:
+        """ Number of blacklisted keys
+
+        :return: length of the blacklist
+        """
+
+        return len(self.blacklist_keys)
+
+
+    def get_counters(self) -> Dict[str, int]:
+        """ Counters of the lookups since the last reset
+
+        :return: dict(counter name -> value)
+        """
+
+        return {'lookups': self.lookups, 'prefilter_hits': self.prefilter_hits,
+                'false_positives': self.false_positives}
+
+
+    def add_counters(self, counters: Dict[str, int]) -> None:
+        """ Adds the counters of a copy of the filter, e.g. the one of another process
+
+        :param counters: counters returned by get_counters
+        :return: None
+        """
+
+        self.lookups += counters['lookups']
+        self.prefilter_hits += counters['prefilter_hits']
+        self.false_positives += counters['false_positives']
+
+
+    def reset_counters(self) -> None:
+        """ Sets every counter back to 0
+
+        :return: None
+        """
+
+        self.lookups, self.prefilter_hits, self.false_positives = 0, 0, 0
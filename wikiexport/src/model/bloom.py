@@ -0,0 +1,87 @@
+from typing import Iterable
+import math
+import zlib
+
+
+class BloomFilter:
+    """
+    A probabilistic set of byte strings: a key that was added is always found, a key that wasn't can be found with a
+    probability close to false_positive_rate.
+    The bit positions are derived from crc32 and adler32 (double hashing) instead of the built-in hash so a filter
+    built in one process gives the same answers in another one, whatever PYTHONHASHSEED is.
+    In pure python a probe is slower than a lookup in a set of the same keys: the filter saves memory, not time
+    """
+
+    NB_HASHES = 3
+
+
+    def __init__(self, nb_items: int, false_positive_rate: float = 0.01) -> None:
+        """ Instantiates an empty filter sized for nb_items keys
+
+        :param nb_items: expected number of keys
+        :param false_positive_rate: expected probability of finding a key that wasn't added
+        """
+
+        bits_per_item = -self.NB_HASHES / math.log(1 - false_positive_rate ** (1 / self.NB_HASHES))
+        self.nb_bits = max(int(math.ceil(max(nb_items, 1) * bits_per_item)), 8)
+        self._bits = bytearray((self.nb_bits + 7) // 8)
+
+
+    @classmethod
+    def from_keys(cls, keys: Iterable[bytes], nb_items: int, false_positive_rate: float = 0.01) -> 'BloomFilter':
+        """ Factory method building a filter from its keys
+
+        :param keys: keys to add
+        :param nb_items: number of keys
+        :param false_positive_rate: expected probability of finding a key that wasn't added
+        :return: the filter
+        """
+
+        bloom_filter = cls(nb_items, false_positive_rate)
+        for key in keys:
+            bloom_filter.add(key)
+
+        return bloom_filter
+
+
+    def add(self, key: bytes) -> None:
+        """ Adds a key to the filter
+
+        :param key: key to add
+        :return: None
+        """
+
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+
+    def __contains__(self, key: bytes) -> bool:
+        """ inclusion test: False means the key was never added, True means it probably was
+
+        :param key: key to look for
+        :return: True if the key may have been added, False otherwise
+        """
+
+        # inlined _positions: most absent keys are rejected by the first probe
+        bits, nb_bits = self._bits, self.nb_bits
+        position = zlib.crc32(key) % nb_bits
+        if not bits[position >> 3] & (1 << (position & 7)):
+            return False
+
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+
+    def _positions(self, key: bytes) -> Iterable[int]:
+        """ Bit positions of a key
+
+        :param key: the key
+        :return: NB_HASHES bit positions
+        """
+
+        first_hash, second_hash = zlib.crc32(key), zlib.adler32(key) | 1
+
+        return ((first_hash + i * second_hash) % self.nb_bits for i in range(self.NB_HASHES))
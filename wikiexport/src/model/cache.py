@@ -1,5 +1,11 @@
 from datetime import datetime
 from abc import ABC, abstractmethod
+from typing import Dict, Iterable
+import os
+import socket
+import sqlite3
+import time
+import uuid
 
 from src.utils import repeat_if_exception
 
@@ -139,3 +145,233 @@ class LocalCache(Cache):
             for dt, export_path in self.cache.items():
                 dt_str = dt.strftime(self.DATETIME_FORMAT)
                 file_handle.write(f'{dt_str},{export_path}\n')
+
+
+
+class SqliteCache(Cache):
+    """
+    A transactional local cache backed by an embedded SQLite database saved in CACHE_FILE_PATH. It's a singleton class.
+    Nothing is loaded when it's instantiated: entries are looked up in the primary key index when needed, so the
+    startup doesn't depend on the number of hours already processed.
+    Each set_entry is committed on its own, so a run that crashes keeps the hours it already wrote, and SQLite locks
+    the database file so concurrent runs don't overwrite each other's entries.
+    A run claims the hours it's about to process with a lease: other runs see them as in flight until the entry is
+    set, the claim is released or the lease expires (when the run holding it died)
+    """
+
+    CACHE_FILE_PATH = '/tmp/wikiexporter_cache.sqlite'
+    DATETIME_FORMAT = '%Y%m%dT%H:%M:%S'
+    # seconds a run waits for another one holding the write lock
+    LOCK_TIMEOUT = 30
+    # maximum number of hours looked up by a single query
+    QUERY_BATCH_SIZE = 500
+
+    __instance = None
+
+    @classmethod
+    def get_instance(cls) -> 'SqliteCache':
+        """Get the only instance of SqliteCache, instantiate it if needed
+
+        :return: The only instance of SqliteCache
+        """
+
+        if cls.__instance is None:
+            cls()
+
+        return cls.__instance
+
+
+    @classmethod
+    def _remove_instance(cls) -> None:
+        """ Clear the only instance of this class, closing its database connection
+
+        :return: None
+        """
+
+        if cls.__instance is not None:
+            cls.__instance.connection.close()
+        cls.__instance = None
+
+
+    def __init__(self) -> None:
+        """ Opens the database the first time the only instance is instantiated
+        """
+
+        if SqliteCache.__instance is None:
+            self.connection = self._open_database()
+            # identifies the leases of this run
+            self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+            SqliteCache.__instance = self
+        else:
+            raise Exception('Already instantiated')
+
+
+    def set_entry(self, dt: datetime, file_path: str) -> None:
+        """ Add an Entry in the cache and replaces a previously set entry with the same key. The entry is committed
+        before returning
+
+        :param dt: datetime of the request
+        :param file_path: path where the CSV file is saved
+        :return: None
+        """
+
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO entries (datetime_hour, file_path) VALUES (?, ?)',
+                                    (dt.strftime(self.DATETIME_FORMAT), file_path))
+            self.connection.execute('DELETE FROM leases WHERE datetime_hour = ?', (dt.strftime(self.DATETIME_FORMAT),))
+
+
+    def get_entry(self, dt: datetime) -> str:
+        """ Get the path to CSV file of the request if any saved in cache
+
+        :param dt: datetime of the request
+        :return: path to the CSV file
+        """
+
+        row = self.connection.execute('SELECT file_path FROM entries WHERE datetime_hour = ?',
+                                      (dt.strftime(self.DATETIME_FORMAT),)).fetchone()
+
+        return row[0] if row is not None else None
+
+
+    def get_entries(self, dts: Iterable[datetime]) -> Dict[datetime, str]:
+        """ Get the paths to the CSV files of several requests with a query per batch of hours
+
+        :param dts: datetimes of the requests
+        :return: dict(datetime -> path to the CSV file) of the requests saved in cache
+        """
+
+        dts_by_str = {dt.strftime(self.DATETIME_FORMAT): dt for dt in dts}
+        dt_strs = list(dts_by_str)
+        entries = {}
+        for start in range(0, len(dt_strs), self.QUERY_BATCH_SIZE):
+            batch = dt_strs[start:start + self.QUERY_BATCH_SIZE]
+            rows = self.connection.execute(f'SELECT datetime_hour, file_path FROM entries '
+                                           f'WHERE datetime_hour IN ({", ".join("?" * len(batch))})', batch)
+            entries.update((dts_by_str[dt_str], file_path) for dt_str, file_path in rows)
+
+        return entries
+
+
+    def remove_entries(self, dts: Iterable[datetime]) -> None:
+        """ Removes the entries of several requests, committed before returning
+
+        :param dts: datetimes of the requests
+        :return: None
+        """
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM entries WHERE datetime_hour = ?',
+                                        [(dt.strftime(self.DATETIME_FORMAT),) for dt in dts])
+
+
+    def __contains__(self, dt: datetime) -> bool:
+        """ inclusion test that relies on the __contains__ magic method.
+        SqliteCache can be used with the in operator: datetime.now() in cache
+
+        :param dt: datetime of the request
+        :return: True if datetime in cache, false otherwise
+        """
+
+        return self.get_entry(dt) is not None
+
+
+    def claim_entry(self, dt: datetime, ttl: float, file_path: str = None) -> bool:
+        """ Claims the hour dt for this run with a lease of ttl seconds. The claim fails if the hour is already in
+        the cache (at file_path, when given) or claimed by another run whose lease didn't expire
+
+        :param dt: datetime of the request
+        :param ttl: duration of the lease in seconds
+        :param file_path: path where the result of dt is expected, any path when None
+        :return: True if this run holds the lease, False otherwise
+        """
+
+        dt_str = dt.strftime(self.DATETIME_FORMAT)
+        with self.connection:
+            # BEGIN IMMEDIATE takes the write lock: checking and taking the lease is atomic across runs
+            self.connection.execute('BEGIN IMMEDIATE')
+            entry = self.connection.execute('SELECT file_path FROM entries WHERE datetime_hour = ?',
+                                            (dt_str,)).fetchone()
+            if entry is not None and (file_path is None or entry[0] == file_path):
+                return False
+            lease = self.connection.execute('SELECT owner, expires_at FROM leases WHERE datetime_hour = ?',
+                                            (dt_str,)).fetchone()
+            now = time.time()
+            if lease is not None and lease[0] != self.owner and lease[1] > now:
+                return False
+            self.connection.execute('INSERT OR REPLACE INTO leases (datetime_hour, owner, expires_at) VALUES (?, ?, ?)',
+                                    (dt_str, self.owner, now + ttl))
+
+        return True
+
+
+    def renew_claims(self, dts: Iterable[datetime], ttl: float) -> None:
+        """ Extends the leases this run holds on dts by ttl seconds from now
+
+        :param dts: datetimes of the requests
+        :param ttl: duration of the leases in seconds
+        :return: None
+        """
+
+        expires_at = time.time() + ttl
+        with self.connection:
+            self.connection.executemany('UPDATE leases SET expires_at = ? WHERE datetime_hour = ? AND owner = ?',
+                                        [(expires_at, dt.strftime(self.DATETIME_FORMAT), self.owner) for dt in dts])
+
+
+    def release_claims(self, dts: Iterable[datetime]) -> None:
+        """ Releases the leases this run holds on dts so other runs can claim them right away
+
+        :param dts: datetimes of the requests
+        :return: None
+        """
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM leases WHERE datetime_hour = ? AND owner = ?',
+                                        [(dt.strftime(self.DATETIME_FORMAT), self.owner) for dt in dts])
+
+
+    @repeat_if_exception(message='Something went wrong when opening the cache', nb_times=3)
+    def _open_database(self) -> sqlite3.Connection:
+        """ private method opening the database. The table is created when the application is started for the first
+        time, with the entries of the LocalCache file if there is one. The connection is closed when opening fails
+
+        :return: connection to the database
+        """
+
+        connection = sqlite3.connect(self.CACHE_FILE_PATH, timeout=self.LOCK_TIMEOUT)
+        try:
+            # readers don't block the writer of another run, and a commit is a single append to the write ahead log
+            connection.execute('PRAGMA journal_mode=WAL')
+
+            with connection:
+                # BEGIN IMMEDIATE takes the write lock so only one run creates and imports the table
+                connection.execute('BEGIN IMMEDIATE')
+                exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entries'"
+                                            ).fetchone()
+                if not exists:
+                    connection.execute('CREATE TABLE entries (datetime_hour TEXT PRIMARY KEY, file_path TEXT NOT NULL)')
+                    connection.executemany('INSERT OR REPLACE INTO entries (datetime_hour, file_path) VALUES (?, ?)',
+                                           self._read_local_cache_entries())
+                connection.execute('CREATE TABLE IF NOT EXISTS leases '
+                                   '(datetime_hour TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+        except Exception:
+            # the next attempt opens a new connection
+            connection.close()
+            raise
+
+        return connection
+
+
+    @staticmethod
+    def _read_local_cache_entries() -> list:
+        """ Entries of the flat LocalCache file, imported once when the database is created
+
+        :return: list of (datetime string, path to CSV file)
+        """
+
+        if not os.path.exists(LocalCache.CACHE_FILE_PATH):
+            return []
+
+        with open(LocalCache.CACHE_FILE_PATH) as file_handle:
+            return [tuple(line.strip().split(',', 1)) for line in file_handle if line.strip()]
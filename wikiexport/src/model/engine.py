@@ -0,0 +1,255 @@
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Set, Tuple
+
+from src.model.pageview import Pageview
+from src.model.wikimedia import Wikimedia
+
+try:
+    import numpy
+except ImportError:
+    # numpy is an optional dependency: pip install ./wikiexport[numpy]
+    numpy = None
+
+
+class Engine(ABC):
+    """
+    An abstract base class for the engines computing the top K rows per domain of an hour of raw dump lines
+    """
+
+    ENGINE_NAMES = ('python', 'numpy')
+
+
+    @classmethod
+    def instantiate_engine(cls, engine_name: str) -> 'Engine':
+        """ A factory method to choose which engine to instantiate
+
+        :param engine_name: one of ENGINE_NAMES
+        :return: the engine
+        """
+
+        if engine_name == 'python':
+            return PythonEngine()
+        elif engine_name == 'numpy':
+            return NumpyEngine()
+        else:
+            raise ValueError(f'Unknown engine {engine_name}')
+
+
+    @abstractmethod
+    def get_top_rows_per_domain(self, lines: Iterable[bytes], blacklist_keys: Set[Tuple[bytes, bytes]], k: int = 25,
+                                first_line_number: int = 0,
+                                counters: Dict[str, int] = None) -> Dict[bytes, List[Tuple[int, int, bytes]]]:
+        """ An abstract method computing the top K rows of each domain. Ties on view_count are won by the row that
+        comes first in the dump
+
+        :param lines: raw lines of a pageviews dump (domain page_title view_count response_size)
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8 to filter out
+        :param k: number of rows kept per domain
+        :param first_line_number: line number of the first line in the dump, when lines is only a part of it
+        :param counters: when given, the rows found in the blacklist are added to its 'blacklisted_rows'. Only the
+        rows that could enter the top K are looked up, so the count depends on the engine
+        :return: dict(domain -> list of (view_count, -line_number, page_title)) with at most k rows per domain
+        """
+
+        pass
+
+
+    def get_top_pageviews_per_domain(self, lines: Iterable[bytes], blacklist_keys: Set[Tuple[bytes, bytes]],
+                                     k: int = 25) -> List[Pageview]:
+        """ Computes the top K pageviews per domain of raw dump lines
+
+        :param lines: raw lines of a pageviews dump
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8 to filter out
+        :param k: number of pageviews kept per domain
+        :return: List of top K pageviews per domain, in the order of Wikimedia.rows_to_pageviews
+        """
+
+        return Wikimedia.rows_to_pageviews(self.get_top_rows_per_domain(lines, blacklist_keys, k))
+
+
+class PythonEngine(Engine):
+    """
+    Pure python engine: the fused parse, filter and rank loop with min heaps of Wikimedia
+    """
+
+
+    def get_top_rows_per_domain(self, lines: Iterable[bytes], blacklist_keys: Set[Tuple[bytes, bytes]], k: int = 25,
+                                first_line_number: int = 0,
+                                counters: Dict[str, int] = None) -> Dict[bytes, List[Tuple[int, int, bytes]]]:
+        """ Computes the top K rows of each domain with Wikimedia.get_top_rows_per_domain_from_lines
+
+        :param lines: raw lines of a pageviews dump
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8 to filter out
+        :param k: number of rows kept per domain
+        :param first_line_number: line number of the first line in the dump
+        :param counters: when given, the rows found in the blacklist are added to its 'blacklisted_rows'
+        :return: dict(domain -> list of (view_count, -line_number, page_title))
+        """
+
+        return Wikimedia.get_top_rows_per_domain_from_lines(lines, blacklist_keys, k, first_line_number, counters)
+
+
+class NumpyEngine(Engine):
+    """
+    Vectorized engine: the hour is loaded in one buffer and split into columns (domain codes, title offsets and view
+    counts) with numpy. The top K per domain is a grouped sort on (domain, -view_count, line number).
+    The blacklist is applied as a mask: blacklisted rows are only looked for among the candidates of the top K and
+    masked out until no candidate is blacklisted, which is cheap because blacklisted rows are rare
+    """
+
+
+    def __init__(self) -> None:
+        """ Checks numpy is installed
+        """
+
+        if numpy is None:
+            raise ImportError('The numpy engine requires numpy: pip install ./wikiexport[numpy]')
+
+
+    def get_top_rows_per_domain(self, lines: Iterable[bytes], blacklist_keys: Set[Tuple[bytes, bytes]], k: int = 25,
+                                first_line_number: int = 0,
+                                counters: Dict[str, int] = None) -> Dict[bytes, List[Tuple[int, int, bytes]]]:
+        """ Computes the top K rows of each domain with numpy
+
+        :param lines: raw lines of a pageviews dump
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8 to filter out
+        :param k: number of rows kept per domain
+        :param first_line_number: line number of the first line in the dump
+        :param counters: when given, the rows masked out by the blacklist are added to its 'blacklisted_rows'
+        :return: dict(domain -> list of (view_count, -line_number, page_title))
+        """
+
+        buffer = b'\n'.join(lines)
+        domains, domain_codes, title_starts, title_ends, view_counts = self._load_columns(buffer)
+
+        # a stable sort on (domain, view_count descending) keeps rows with the same view_count in line order
+        max_view_count = int(view_counts.max()) if len(view_counts) else 0
+        sort_keys = domain_codes.astype(numpy.int64) * (max_view_count + 1) + (max_view_count - view_counts)
+        order = numpy.argsort(sort_keys, kind='stable')
+        masked_rows = numpy.zeros(len(view_counts), dtype=bool)
+
+        while True:
+            top_rows = self._first_rows_per_domain(order, domain_codes, k).tolist()
+            blacklisted_rows = [row for row in top_rows
+                                if (domains[domain_codes[row]], buffer[title_starts[row]:title_ends[row]])
+                                in blacklist_keys]
+            if not blacklisted_rows:
+                break
+            masked_rows[blacklisted_rows] = True
+            order = order[~masked_rows[order]]
+
+        if counters is not None:
+            counters['blacklisted_rows'] = counters.get('blacklisted_rows', 0) + int(masked_rows.sum())
+
+        top_rows_per_domain = {}
+        for row in top_rows:
+            top_rows_per_domain.setdefault(domains[domain_codes[row]], []).append(
+                (int(view_counts[row]), -(first_line_number + row), buffer[title_starts[row]:title_ends[row]]))
+
+        return top_rows_per_domain
+
+
+    @staticmethod
+    def _first_rows_per_domain(order: 'numpy.ndarray', domain_codes: 'numpy.ndarray', k: int) -> 'numpy.ndarray':
+        """ Keeps the first k rows of each domain
+
+        :param order: rows sorted by domain
+        :param domain_codes: domain code of each row
+        :param k: number of rows kept per domain
+        :return: the first k rows of each domain
+        """
+
+        sorted_codes = domain_codes[order]
+        domain_starts = numpy.flatnonzero(numpy.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        domain_sizes = numpy.diff(numpy.r_[domain_starts, len(order)])
+        ranks = numpy.arange(len(order)) - numpy.repeat(domain_starts, domain_sizes)
+
+        return order[ranks < k]
+
+
+    @classmethod
+    def _load_columns(cls, buffer: bytes) -> Tuple[List[bytes], 'numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray',
+                                                   'numpy.ndarray']:
+        """ Splits a buffer of dump lines into columns. Empty lines are skipped
+
+        :param buffer: lines of a dump separated by new lines
+        :return: domains, domain code of each row, title start and end offsets in buffer, view counts
+        """
+
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        new_lines = numpy.flatnonzero(data == ord('\n'))
+        line_starts = numpy.r_[0, new_lines + 1]
+        line_ends = numpy.r_[new_lines, len(data)]
+        non_empty = line_ends > line_starts
+        line_starts, line_ends = line_starts[non_empty], line_ends[non_empty]
+
+        spaces = numpy.flatnonzero(data == ord(' '))
+        first_spaces = numpy.searchsorted(spaces, line_starts)
+        # every line must have exactly 3 spaces: domain page_title view_count response_size
+        next_spaces = numpy.r_[spaces, len(data)]
+        if (first_spaces + 2 >= len(spaces)).any() or \
+                (spaces[numpy.minimum(first_spaces + 2, len(spaces) - 1)] >= line_ends).any() or \
+                (next_spaces[numpy.minimum(first_spaces + 3, len(spaces))] < line_ends).any():
+            raise ValueError('Every line of a pageviews dump must have 4 fields separated by spaces')
+
+        domain_ends, title_ends, view_count_ends = spaces[first_spaces], spaces[first_spaces + 1], \
+                                                   spaces[first_spaces + 2]
+        domains, domain_codes = cls._encode_fields(data, line_starts, domain_ends)
+        view_counts = cls._parse_integers(data, title_ends + 1, view_count_ends)
+
+        return domains, domain_codes, domain_ends + 1, title_ends, view_counts
+
+
+    @staticmethod
+    def _encode_fields(data: 'numpy.ndarray', starts: 'numpy.ndarray',
+                       ends: 'numpy.ndarray') -> Tuple[List[bytes], 'numpy.ndarray']:
+        """ Dictionary encoding of a column of short byte strings
+
+        :param data: buffer of the dump
+        :param starts: start offset of the field on each row
+        :param ends: end offset of the field on each row
+        :return: distinct values, code of the value of each row
+        """
+
+        if not len(starts):
+            return [], numpy.zeros(0, dtype=numpy.intp)
+
+        lengths = ends - starts
+        width = max(int(lengths.max()), 1)
+        fields = numpy.zeros((len(starts), width), dtype=numpy.uint8)
+        for position in range(width):
+            in_field = lengths > position
+            fields[in_field, position] = data[starts[in_field] + position]
+
+        # dumps are sorted by domain: only the first row of each run of identical values needs to be dictionary encoded
+        fields = fields.view(f'S{width}').ravel()
+        run_starts = numpy.flatnonzero(numpy.r_[True, fields[1:] != fields[:-1]])
+        values, run_codes = numpy.unique(fields[run_starts], return_inverse=True)
+        codes = numpy.repeat(run_codes.ravel(), numpy.diff(numpy.r_[run_starts, len(fields)]))
+
+        return values.tolist(), codes
+
+
+    @staticmethod
+    def _parse_integers(data: 'numpy.ndarray', starts: 'numpy.ndarray', ends: 'numpy.ndarray') -> 'numpy.ndarray':
+        """ Parses a column of decimal integers
+
+        :param data: buffer of the dump
+        :param starts: start offset of the field on each row
+        :param ends: end offset of the field on each row
+        :return: integer value of each row
+        """
+
+        lengths = ends - starts
+        if (lengths <= 0).any():
+            raise ValueError('Empty view count in pageviews dump')
+
+        values = numpy.zeros(len(starts), dtype=numpy.int64)
+        for position in range(int(lengths.max()) if len(lengths) else 0):
+            in_field = lengths > position
+            digits = data[starts[in_field] + position].astype(numpy.int64) - ord('0')
+            if ((digits < 0) | (digits > 9)).any():
+                raise ValueError('Invalid view count in pageviews dump')
+            values[in_field] = values[in_field] * 10 + digits
+
+        return values
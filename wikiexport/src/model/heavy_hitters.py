@@ -0,0 +1,81 @@
+from typing import Dict, Hashable, List, Optional, Tuple
+import heapq
+
+
+class SpaceSaving:
+    """
+    Weighted Space-Saving summary (Metwally et al.) keeping at most `capacity` counters. A counter is
+    [count, error, covered_threshold]: the true weight added for its key since the counter was created is between
+    count - error and count. When the summary is full, a new key takes the counter with the smallest count m and
+    starts at m + weight with an error of m, so a key which isn't monitored was added at most min_count in total.
+    The third field is left to the caller (see Rollup). Without a capacity every key is kept and counts are exact.
+    The smallest counter is found with a heap holding one (count, key) entry per counter. Counts only grow, so
+    entries aren't updated when a count is: an outdated entry is pushed again with its count when it reaches the top
+    """
+
+
+    def __init__(self, capacity: Optional[int] = None) -> None:
+        """ Instantiates an empty summary
+
+        :param capacity: maximum number of counters, None for no limit
+        """
+
+        self.capacity = capacity
+        self.counters: Dict[Hashable, List[int]] = {}
+        self._heap = []
+
+
+    def add(self, key: Hashable, weight: int) -> List[int]:
+        """ Adds weight to the count of key
+
+        :param key: the key
+        :param weight: weight to add
+        :return: counter of key, [count, error, covered_threshold]
+        """
+
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return counter
+
+        if self.capacity is None or len(self.counters) < self.capacity:
+            counter = self.counters[key] = [weight, 0, 0]
+        else:
+            min_count, min_key = self._pop_min()
+            del self.counters[min_key]
+            counter = self.counters[key] = [min_count + weight, min_count, 0]
+
+        if self.capacity is not None:
+            heapq.heappush(self._heap, (counter[0], key))
+
+        return counter
+
+
+    @property
+    def min_count(self) -> int:
+        """ Upper bound of the weight added for a key which isn't monitored
+
+        :return: the smallest count when the summary is full, 0 otherwise
+        """
+
+        if self.capacity is None or len(self.counters) < self.capacity:
+            return 0
+
+        min_count, min_key = self._pop_min()
+        heapq.heappush(self._heap, (min_count, min_key))
+
+        return min_count
+
+
+    def _pop_min(self) -> Tuple[int, Hashable]:
+        """ Removes the entry of the smallest counter from the heap
+
+        :return: (count, key) of the smallest counter
+        """
+
+        while True:
+            count, key = heapq.heappop(self._heap)
+            current_count = self.counters[key][0]
+            if current_count == count:
+                return count, key
+            heapq.heappush(self._heap, (current_count, key))
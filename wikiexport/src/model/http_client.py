@@ -0,0 +1,321 @@
+from contextlib import closing
+from typing import Dict, Generator, Optional, Tuple
+import os
+import re
+import threading
+import time
+
+import click
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpClient:
+    """
+    Shared HTTP client of the downloads. Each thread gets its own requests.Session, so the connections to
+    dumps.wikimedia.org and to S3 stay open from one hour to the next. A process also gets its own, because sockets
+    can't be shared after a fork.
+    urllib3 retries failed connections and RETRY_STATUSES responses with an exponential backoff. When a download
+    breaks mid-stream, the bytes already received stay in a .part file and the rest is requested with a Range header,
+    so the file isn't downloaded again from the start. A streamed body is resumed the same way, from the number of
+    bytes already yielded
+    """
+
+    POOL_SIZE = 10
+    # seconds to connect, and seconds without receiving a byte of the response
+    TIMEOUT = (10, 60)
+    # retries of a request, and retries of a download in a row that receive nothing
+    MAX_RETRIES = 5
+    # the nth retry waits BACKOFF_FACTOR * 2 ** (n - 1) seconds, at most MAX_BACKOFF
+    BACKOFF_FACTOR = 0.5
+    MAX_BACKOFF = 60
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # errors of a response broken mid-stream
+    STREAM_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                     requests.exceptions.Timeout)
+    PARTIAL_SUFFIX = '.part'
+    # the ETag of a partial file is kept next to it, so another run can resume it with If-Range
+    ETAG_SUFFIX = '.etag'
+
+    _local = threading.local()
+
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """ Session of the current thread, created the first time
+
+        :return: the session
+        """
+
+        session = getattr(cls._local, 'session', None)
+        if session is None or cls._local.pid != os.getpid():
+            session = requests.Session()
+            retry = Retry(total=cls.MAX_RETRIES, backoff_factor=cls.BACKOFF_FACTOR,
+                          status_forcelist=cls.RETRY_STATUSES, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=cls.POOL_SIZE, pool_maxsize=cls.POOL_SIZE, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls._local.session, cls._local.pid = session, os.getpid()
+
+        return session
+
+
+    @classmethod
+    def close_session(cls) -> None:
+        """ Closes the session of the current thread and its connections. The next request opens a new one
+
+        :return: None
+        """
+
+        session = getattr(cls._local, 'session', None)
+        if session is not None:
+            session.close()
+            cls._local.session = None
+
+
+    @classmethod
+    def get(cls, url: str, headers: Dict[str, str] = None) -> requests.Response:
+        """ Sends a GET request with the session of the current thread. The body is streamed, so the response must
+        be read to the end or closed for its connection to go back to the pool
+
+        :param url: url of the request
+        :param headers: headers of the request
+        :return: the response, whatever its status once the retries are exhausted
+        """
+
+        return cls.get_session().get(url, headers=headers, stream=True, timeout=cls.TIMEOUT)
+
+
+    @classmethod
+    def download(cls, url: str, file_path: str, chunk_size: int = 10 * 1024 ** 2) -> str:
+        """ Downloads a file, resuming it with Range requests when the response breaks mid-stream.
+        The file is written to file_path + PARTIAL_SUFFIX and renamed when it's complete. A partial file left by a
+        previous run is resumed as well when its ETag was saved with it, and downloaded again otherwise since there's
+        no way to tell whether the file changed in between. The server answers 200 instead of 206 when it ignores the
+        range or when the file changed since the partial file was started (If-Range): the file is then downloaded
+        again from the start
+
+        :param url: url of the file
+        :param file_path: path where to save the file
+        :param chunk_size: size of the chunks written to the file
+        :return: file_path
+        """
+
+        partial_path = file_path + cls.PARTIAL_SUFFIX
+        etag = cls._read_partial_etag(partial_path)
+        failures = 0
+        while True:
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            try:
+                response = cls.get(url, cls._get_download_headers(offset, etag))
+                if response.headers.get('ETag') != etag:
+                    etag = response.headers.get('ETag')
+                    cls._write_partial_etag(partial_path, etag)
+                with closing(response):
+                    complete = cls._save_response(url, response, partial_path, offset, chunk_size)
+                if complete:
+                    os.replace(partial_path, file_path)
+                    cls._write_partial_etag(partial_path, None)
+                    return file_path
+            except cls.STREAM_ERRORS as e:
+                received = (os.path.getsize(partial_path) if os.path.exists(partial_path) else 0) - offset
+                # the count only grows while the retries receive nothing
+                failures = 1 if received > 0 else failures + 1
+                cls._wait_before_retry(url, e, offset + received, failures)
+
+
+    @classmethod
+    def stream(cls, url: str, chunk_size: int = 1024 ** 2) -> Generator[bytes, None, None]:
+        """ Streams the body of url. When the response breaks mid-stream, the rest is requested from the number of
+        bytes already yielded, so the consumer (e.g. a decompressor) receives every byte exactly once and keeps its
+        state. When the server ignores the range, the bytes already yielded are skipped in its new response. The
+        stream fails if the file changed in between (its ETag differs)
+
+        :param url: url of the file
+        :param chunk_size: size of the chunks read from the response
+        :return: generator of the chunks of the body
+        """
+
+        offset = 0
+        etag = None
+        failures = 0
+        while True:
+            start_offset = offset
+            try:
+                response = cls.get(url, cls._get_download_headers(offset, etag))
+                with closing(response):
+                    skipped_bytes, end = cls._get_stream_range(url, response, offset, etag)
+                    if end == offset:
+                        return
+                    etag = response.headers.get('ETag')
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        if skipped_bytes:
+                            chunk, skipped_bytes = chunk[skipped_bytes:], max(0, skipped_bytes - len(chunk))
+                            if not chunk:
+                                continue
+                        offset += len(chunk)
+                        yield chunk
+
+                    # depending on the version of urllib3, a connection closed early isn't always reported as an error
+                    if end is not None and offset < end:
+                        raise requests.exceptions.ChunkedEncodingError(f'Connection closed before the end of {url}')
+                return
+            except cls.STREAM_ERRORS as e:
+                failures = 1 if offset > start_offset else failures + 1
+                cls._wait_before_retry(url, e, offset, failures)
+
+
+    @classmethod
+    def _read_partial_etag(cls, partial_path: str) -> Optional[str]:
+        """ ETag saved with a partial file left by a previous run. A partial file without one is removed: it can't
+        be resumed safely because the file may have changed since
+
+        :param partial_path: path of the partial file
+        :return: the ETag, None when there's no partial file to resume
+        """
+
+        etag = None
+        if os.path.exists(partial_path + cls.ETAG_SUFFIX):
+            with open(partial_path + cls.ETAG_SUFFIX) as file_handle:
+                etag = file_handle.read() or None
+        if etag is None and os.path.exists(partial_path):
+            os.remove(partial_path)
+
+        return etag
+
+
+    @classmethod
+    def _write_partial_etag(cls, partial_path: str, etag: Optional[str]) -> None:
+        """ Saves the ETag of the response written to a partial file, or removes the saved one when etag can't be
+        used by If-Range (None or weak)
+
+        :param partial_path: path of the partial file
+        :param etag: ETag of the response
+        :return: None
+        """
+
+        etag_path = partial_path + cls.ETAG_SUFFIX
+        if etag and not etag.startswith('W/'):
+            with open(etag_path, 'w') as file_handle:
+                file_handle.write(etag)
+        elif os.path.exists(etag_path):
+            os.remove(etag_path)
+
+
+    @staticmethod
+    def _get_download_headers(offset: int, etag: Optional[str]) -> Dict[str, str]:
+        """ Headers of a request for the bytes of a file from offset
+
+        :param offset: number of bytes already downloaded
+        :param etag: ETag of the previous response, the server sends the whole file instead of the range when the
+        file changed since
+        :return: the headers
+        """
+
+        # the offsets are the ones of the file as stored, not of a compressed transfer
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            # weak ETags can't be used by If-Range
+            if etag and not etag.startswith('W/'):
+                headers['If-Range'] = etag
+
+        return headers
+
+
+    @staticmethod
+    def _get_stream_range(url: str, response: requests.Response, offset: int,
+                          etag: Optional[str]) -> Tuple[int, Optional[int]]:
+        """ Checks the response to a request sent with _get_download_headers by stream
+
+        :param url: url of the file
+        :param response: the response
+        :param offset: number of bytes already yielded
+        :param etag: ETag of the previous response
+        :return: (number of bytes at the start of the body that were already yielded, size of the file or None
+        when it isn't known)
+        """
+
+        content_range = response.headers.get('Content-Range', '')
+        content_length = response.headers.get('Content-Length')
+        if response.status_code == requests.codes.requested_range_not_satisfiable:
+            size = re.fullmatch(r'bytes \*/(\d+)', content_range)
+            if size is None or int(size.group(1)) != offset:
+                raise Exception(f'{url} is not {offset} bytes long anymore')
+            return 0, offset
+
+        if response.status_code == requests.codes.partial_content:
+            if not content_range.startswith(f'bytes {offset}-'):
+                raise Exception(f'Unexpected range {content_range} when resuming {url} at {offset} bytes')
+            return 0, None if content_length is None else offset + int(content_length)
+
+        if response.status_code != requests.codes.ok:
+            raise Exception(f'Something went wrong when downloading {url}')
+        if offset and etag and response.headers.get('ETag') != etag:
+            raise Exception(f'{url} changed while it was downloaded')
+
+        return offset, None if content_length is None else int(content_length)
+
+
+    @classmethod
+    def _wait_before_retry(cls, url: str, error: Exception, position: int, failures: int) -> None:
+        """ Waits before resuming a download broken mid-stream, longer and longer while nothing is received
+
+        :param url: url of the file
+        :param error: error that broke the download
+        :param position: number of bytes received so far
+        :param failures: number of retries in a row that received nothing
+        :return: None, error is raised once there were more than MAX_RETRIES such retries
+        """
+
+        if failures > cls.MAX_RETRIES:
+            raise error
+
+        delay = min(cls.MAX_BACKOFF, cls.BACKOFF_FACTOR * 2 ** (failures - 1))
+        click.echo(click.style(f'Download of {url} interrupted after {position} bytes: {error}. '
+                               f'Resuming in {delay:.1f} s', fg='yellow'))
+        time.sleep(delay)
+
+
+    @staticmethod
+    def _save_response(url: str, response: requests.Response, partial_path: str, offset: int,
+                       chunk_size: int) -> bool:
+        """ Writes the body of a response to the partial file: appended to it when it's the requested range
+
+        :param url: url of the file
+        :param response: response of the request sent with _get_download_headers
+        :param partial_path: path of the partial file
+        :param offset: number of bytes already in the partial file
+        :param chunk_size: size of the chunks written to the file
+        :return: whether the file is complete, False when the partial file was discarded and must be downloaded again
+        """
+
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code == requests.codes.requested_range_not_satisfiable:
+            # the partial file is either complete or longer than the file
+            size = re.fullmatch(r'bytes \*/(\d+)', content_range)
+            if size is not None and int(size.group(1)) == offset:
+                return True
+            os.remove(partial_path)
+            return False
+
+        if response.status_code == requests.codes.partial_content:
+            if not content_range.startswith(f'bytes {offset}-'):
+                raise Exception(f'Unexpected range {content_range} when resuming {url} at {offset} bytes')
+            mode = 'ab'
+        elif response.status_code == requests.codes.ok:
+            offset, mode = 0, 'wb'
+        else:
+            raise Exception(f'Something went wrong when downloading {url}')
+
+        with open(partial_path, mode) as file_handle:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                file_handle.write(chunk)
+
+        # depending on the version of urllib3, a connection closed early isn't always reported as an error
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and os.path.getsize(partial_path) < offset + int(content_length):
+            raise requests.exceptions.ChunkedEncodingError(f'Connection closed before the end of {url}')
+
+        return True
@@ -0,0 +1,227 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Generator, Iterable, Optional
+import json
+import os
+import resource
+import time
+
+
+class StageMetrics:
+    """
+    Measures of a stage of an hour. seconds is the wall time spent in the stage itself, the time of the stages
+    nested in it (e.g. the download pulled by the decompression) being counted in theirs only. max_rss_bytes is the
+    peak RSS of the process when the stage ended
+    """
+
+    __slots__ = ('seconds', 'bytes', 'rows_in', 'rows_out', 'max_rss_bytes')
+
+
+    def __init__(self) -> None:
+        """ Instantiates empty measures
+        """
+
+        self.seconds = 0.0
+        self.bytes = 0
+        self.rows_in = None
+        self.rows_out = None
+        self.max_rss_bytes = None
+
+
+    def to_dict(self) -> Dict[str, Optional[float]]:
+        """ JSON friendly measures
+
+        :return: dict(measure -> value)
+        """
+
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class HourMetrics:
+    """
+    Measures of the stages of an hour: download, decompress, parse_rank (the engines parse, filter and rank in one
+    pass), sort and write, plus the rows the engines found in the blacklist. Stages are timed with the stage context
+    manager, or with timed for the generators of the streaming pipeline: the time spent in next() is the one of the
+    stage. A stage started while another one runs is subtracted from it, so the times of the stages add up to the
+    time of the hour
+    """
+
+
+    def __init__(self, datetime_hour: datetime) -> None:
+        """ Instantiates the metrics of an hour
+
+        :param datetime_hour: datetime of the request
+        """
+
+        self.datetime_hour = datetime_hour
+        self.stages: Dict[str, StageMetrics] = {}
+        self.blacklisted_rows = None
+        # names of the stages running, the innermost last
+        self._running = []
+
+
+    def get_stage(self, name: str) -> StageMetrics:
+        """ Measures of a stage, created empty the first time
+
+        :param name: name of the stage
+        :return: the measures
+        """
+
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageMetrics()
+
+        return stage
+
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[StageMetrics, None, None]:
+        """ Times the with block as the stage name
+
+        :param name: name of the stage
+        :return: the measures of the stage, to set its bytes and rows
+        """
+
+        stage = self.get_stage(name)
+        self._running.append(name)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            self._add_time(stage, time.perf_counter() - start)
+            stage.max_rss_bytes = self._get_max_rss_bytes()
+
+
+    def timed(self, name: str, blocks: Iterable[bytes], count_lines: bool = False) -> Generator[bytes, None, None]:
+        """ Times the production of blocks of data as the stage name, and counts their bytes
+
+        :param name: name of the stage
+        :param blocks: blocks of data (chunks, decompressed blocks or lines ending with a new line)
+        :param count_lines: count the lines of the blocks as the rows produced by the stage
+        :return: generator of the blocks
+        """
+
+        stage = self.get_stage(name)
+        if count_lines:
+            stage.rows_out = stage.rows_out or 0
+        iterator = iter(blocks)
+        while True:
+            self._running.append(name)
+            start = time.perf_counter()
+            try:
+                block = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                self._add_time(stage, time.perf_counter() - start)
+            stage.bytes += len(block)
+            if count_lines:
+                stage.rows_out += block.count(b'\n')
+            yield block
+
+        stage.max_rss_bytes = self._get_max_rss_bytes()
+
+
+    def to_dict(self) -> dict:
+        """ JSON friendly metrics
+
+        :return: dict(datetime_hour, blacklisted_rows, stages)
+        """
+
+        return {'datetime_hour': self.datetime_hour.isoformat(), 'blacklisted_rows': self.blacklisted_rows,
+                'stages': {name: stage.to_dict() for name, stage in self.stages.items()}}
+
+
+    def _add_time(self, stage: StageMetrics, seconds: float) -> None:
+        """ Adds the time of a stage that just ended and removes it from the stage it was nested in
+
+        :param stage: measures of the stage
+        :param seconds: wall time of the stage
+        :return: None
+        """
+
+        self._running.pop()
+        stage.seconds += seconds
+        if self._running:
+            self.stages[self._running[-1]].seconds -= seconds
+
+
+    @staticmethod
+    def _get_max_rss_bytes() -> int:
+        """ Peak RSS of the process so far
+
+        :return: bytes
+        """
+
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MetricsExporter:
+    """
+    Exports the metrics of each hour in dir_path: appended as a JSON line to JSON_LINES_FILE, and as the gauges of the
+    last hour in PROMETHEUS_FILE for the textfile collector of the Prometheus node exporter. The Prometheus file is
+    written to a temporary path then renamed so the collector never reads a partial file
+    """
+
+    JSON_LINES_FILE = 'wikiexport_metrics.jsonl'
+    PROMETHEUS_FILE = 'wikiexport.prom'
+    # metric name -> (StageMetrics attribute, help)
+    STAGE_GAUGES = {'wikiexport_stage_seconds': ('seconds', 'Wall time of the stage for the last processed hour'),
+                    'wikiexport_stage_bytes': ('bytes', 'Bytes produced by the stage for the last processed hour'),
+                    'wikiexport_stage_rows_in': ('rows_in', 'Rows read by the stage for the last processed hour'),
+                    'wikiexport_stage_rows_out': ('rows_out', 'Rows produced by the stage for the last processed hour'),
+                    'wikiexport_stage_max_rss_bytes': ('max_rss_bytes', 'Peak RSS of the process at the end of the '
+                                                                        'stage for the last processed hour')}
+
+
+    def __init__(self, dir_path: str) -> None:
+        """ Instantiates an exporter
+
+        :param dir_path: directory of the exported files
+        """
+
+        self.dir_path = dir_path
+
+
+    def export(self, hour_metrics: HourMetrics) -> None:
+        """ Exports the metrics of an hour
+
+        :param hour_metrics: the metrics
+        :return: None
+        """
+
+        os.makedirs(self.dir_path, exist_ok=True)
+        with open(os.path.join(self.dir_path, self.JSON_LINES_FILE), 'a') as file_handle:
+            file_handle.write(json.dumps(hour_metrics.to_dict()) + '\n')
+
+        file_path = os.path.join(self.dir_path, self.PROMETHEUS_FILE)
+        temporary_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as file_handle:
+            file_handle.write(self.to_prometheus(hour_metrics))
+        os.replace(temporary_path, file_path)
+
+
+    def to_prometheus(self, hour_metrics: HourMetrics) -> str:
+        """ Prometheus text format of the metrics of an hour
+
+        :param hour_metrics: the metrics
+        :return: content of the textfile
+        """
+
+        lines = ['# HELP wikiexport_last_hour_timestamp_seconds Datetime of the last processed hour',
+                 '# TYPE wikiexport_last_hour_timestamp_seconds gauge',
+                 f'wikiexport_last_hour_timestamp_seconds {hour_metrics.datetime_hour.timestamp()}']
+        if hour_metrics.blacklisted_rows is not None:
+            lines += ['# HELP wikiexport_blacklisted_rows Rows filtered by the blacklist for the last processed hour',
+                      '# TYPE wikiexport_blacklisted_rows gauge',
+                      f'wikiexport_blacklisted_rows {hour_metrics.blacklisted_rows}']
+
+        for metric_name, (attribute, help_text) in self.STAGE_GAUGES.items():
+            values = [(name, getattr(stage, attribute)) for name, stage in hour_metrics.stages.items()
+                      if getattr(stage, attribute) is not None]
+            if values:
+                lines += [f'# HELP {metric_name} {help_text}', f'# TYPE {metric_name} gauge']
+                lines += [f'{metric_name}{{stage="{name}"}} {value}' for name, value in values]
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,235 @@
+from abc import ABC, abstractmethod
+from typing import Generator, Iterable
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard is an optional dependency: pip install ./wikiexport[zstd]
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # pyarrow is an optional dependency: pip install ./wikiexport[arrow]
+    pyarrow = None
+
+
+class OutputFormat(ABC):
+    """
+    An abstract base class for the formats the writers encode pageviews in. Every format keeps the order of the
+    pageviews and has the same columns: domain, page_title, pageview_count
+    """
+
+    FORMAT_NAMES = ('csv', 'csv.gz', 'csv.zst', 'parquet', 'arrow')
+    HEADER = 'domain,page_title,pageview_count'
+
+
+    @classmethod
+    def instantiate_format(cls, format_name: str) -> 'OutputFormat':
+        """ A factory method to choose which format to instantiate
+
+        :param format_name: one of FORMAT_NAMES
+        :return: the format
+        """
+
+        if format_name == 'csv':
+            return CsvFormat()
+        elif format_name == 'csv.gz':
+            return CsvFormat(compression='gzip')
+        elif format_name == 'csv.zst':
+            return CsvFormat(compression='zstd')
+        elif format_name == 'parquet':
+            return ParquetFormat()
+        elif format_name == 'arrow':
+            return ArrowFormat()
+        else:
+            raise ValueError(f'Unknown format {format_name}')
+
+
+    @property
+    @abstractmethod
+    def extension(self) -> str:
+        """ Extension of the files written in this format, without the leading dot
+
+        :return: the extension
+        """
+
+        pass
+
+
+    @abstractmethod
+    def encode(self, pageviews: Iterable['Pageview']) -> Generator[bytes, None, None]:
+        """ An abstract method encoding pageviews as a sequence of byte chunks which, concatenated, are the file
+
+        :param pageviews: collection of pageviews
+        :return: generator of chunks of the file
+        """
+
+        pass
+
+
+class CsvFormat(OutputFormat):
+    """
+    CSV with a header, optionally compressed with gzip or zstd. Rows are encoded (and compressed) by batches of
+    ENCODING_BATCH_SIZE bytes so the whole file is never in memory
+    """
+
+    ENCODING_BATCH_SIZE = 64 * 1024
+    EXTENSIONS = {None: 'csv', 'gzip': 'csv.gz', 'zstd': 'csv.zst'}
+
+
+    def __init__(self, compression: str = None) -> None:
+        """ Instantiates a CSV format
+
+        :param compression: None, 'gzip' or 'zstd'
+        """
+
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('The csv.zst format requires zstandard: pip install ./wikiexport[zstd]')
+        if compression not in self.EXTENSIONS:
+            raise ValueError(f'Unknown compression {compression}')
+
+        self.compression = compression
+
+
+    @property
+    def extension(self) -> str:
+        """ csv, csv.gz or csv.zst
+
+        :return: the extension
+        """
+
+        return self.EXTENSIONS[self.compression]
+
+
+    def encode(self, pageviews: Iterable['Pageview']) -> Generator[bytes, None, None]:
+        """ Encodes the header and the rows in UTF-8, then compresses them
+
+        :param pageviews: collection of pageviews
+        :return: generator of chunks of the file
+        """
+
+        if self.compression == 'gzip':
+            compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        elif self.compression == 'zstd':
+            compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            compressor = None
+
+        for chunk in self.encode_rows(pageviews):
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+
+        if compressor:
+            yield compressor.flush()
+
+
+    def encode_rows(self, pageviews: Iterable['Pageview']) -> Generator[bytes, None, None]:
+        """ Encodes the header and the rows in UTF-8 by batches of about ENCODING_BATCH_SIZE bytes
+
+        :param pageviews: collection of pageviews
+        :return: generator of encoded batches of CSV lines
+        """
+
+        rows = [f'{self.HEADER}\n']
+        batch_size = 0
+        for pageview in pageviews:
+            row = f'{pageview.domain},{pageview.page_title},{pageview.view_count}\n'
+            rows.append(row)
+            batch_size += len(row)
+            if batch_size >= self.ENCODING_BATCH_SIZE:
+                yield ''.join(rows).encode('utf-8')
+                rows, batch_size = [], 0
+
+        yield ''.join(rows).encode('utf-8')
+
+
+class ArrowFormat(OutputFormat):
+    """
+    Arrow IPC file: the columns can be memory mapped by the readers without any parsing
+    """
+
+
+    def __init__(self) -> None:
+        """ Checks pyarrow is installed
+        """
+
+        if pyarrow is None:
+            raise ImportError(f'The {self.extension} format requires pyarrow: pip install ./wikiexport[arrow]')
+
+
+    @property
+    def extension(self) -> str:
+        """ arrow
+
+        :return: the extension
+        """
+
+        return 'arrow'
+
+
+    def encode(self, pageviews: Iterable['Pageview']) -> Generator[bytes, None, None]:
+        """ Encodes the pageviews as a single record batch
+
+        :param pageviews: collection of pageviews
+        :return: generator of the file, in one chunk
+        """
+
+        table = self._to_table(pageviews)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_file(sink, table.schema) as ipc_writer:
+            ipc_writer.write_table(table)
+
+        yield sink.getvalue().to_pybytes()
+
+
+    @staticmethod
+    def _to_table(pageviews: Iterable['Pageview']) -> 'pyarrow.Table':
+        """ Columns of the pageviews, in their order
+
+        :param pageviews: collection of pageviews
+        :return: table (domain, page_title, pageview_count)
+        """
+
+        domains, page_titles, view_counts = [], [], []
+        for pageview in pageviews:
+            domains.append(pageview.domain)
+            page_titles.append(pageview.page_title)
+            view_counts.append(pageview.view_count)
+
+        # domains repeat up to 25 times in a row: dictionary encoding stores each one once
+        return pyarrow.table({'domain': pyarrow.array(domains, pyarrow.string()).dictionary_encode(),
+                              'page_title': pyarrow.array(page_titles, pyarrow.string()),
+                              'pageview_count': pyarrow.array(view_counts, pyarrow.int64())})
+
+
+class ParquetFormat(ArrowFormat):
+    """
+    Parquet file compressed with zstd
+    """
+
+
+    @property
+    def extension(self) -> str:
+        """ parquet
+
+        :return: the extension
+        """
+
+        return 'parquet'
+
+
+    def encode(self, pageviews: Iterable['Pageview']) -> Generator[bytes, None, None]:
+        """ Encodes the pageviews as a single row group
+
+        :param pageviews: collection of pageviews
+        :return: generator of the file, in one chunk
+        """
+
+        sink = pyarrow.BufferOutputStream()
+        pyarrow.parquet.write_table(self._to_table(pageviews), sink, compression='zstd')
+
+        yield sink.getvalue().to_pybytes()
@@ -1,8 +1,15 @@
+import sys
+
+
 class Pageview:
     """
-    Class representing a pageview object
+    Class representing a pageview object.
+    Millions of them can be alive (the blacklist, the heaps), so instances have no __dict__ and all the pageviews of a
+    domain share the same interned domain string
     """
 
+    __slots__ = ('domain', 'page_title', 'view_count')
+
     @classmethod
     def instance_from_pageview_line(cls, pageview_line: str) -> 'Pageview':
         """ Factory method to generate pageview instances from wikimedia pageview file. The last part of the line
@@ -38,7 +45,7 @@ class Pageview:
         :param view_count: number of views for that particular page on that particular domain
         """
 
-        self.domain = domain
+        self.domain = sys.intern(domain)
         self.page_title = page_title
         self.view_count = view_count
 
@@ -0,0 +1,178 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import heapq
+
+from src.model.blacklist import BlacklistFilter
+from src.model.engine import Engine
+from src.model.pageview import Pageview
+from src.model.wikimedia import Wikimedia
+
+
+# state of a parsing process, set once by _init_parser when the process pool starts it
+_parser_state = {}
+
+
+class ParallelParser:
+    """
+    Computes the top K pageviews per domain of a single dump with several processes. The caller decompresses the dump
+    once into large line aligned blocks, each block is sent to a parsing process which computes the partial top K
+    rows per domain of its lines with an Engine, and the partial results are merged into the final top K.
+    Rows carry their line number in the whole dump so ties are broken exactly like a single Engine would
+    """
+
+
+    def __init__(self, processes: int, blacklist_keys: Set[Tuple[bytes, bytes]], engine_name: str = 'python') -> None:
+        """ Starts the parsing processes. They receive the blacklist once and are reused for every hour
+
+        :param processes: number of parsing processes
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8 to filter out
+        :param engine_name: engine used by the parsing processes, one of Engine.ENGINE_NAMES
+        """
+
+        self.processes = processes
+        self.blacklist_keys = blacklist_keys
+        self._executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_parser,
+                                             initargs=(blacklist_keys, engine_name))
+
+
+    def __enter__(self) -> 'ParallelParser':
+        """ ParallelParser can be used as a context manager so the processes are always stopped
+
+        :return: the parser itself
+        """
+
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        """ Stops the processes when leaving the with block
+
+        :return: None
+        """
+
+        self.close()
+
+
+    def close(self) -> None:
+        """ Stops the parsing processes
+
+        :return: None
+        """
+
+        self._executor.shutdown(wait=True)
+
+
+    def get_top_pageviews_per_domain(self, blocks: Iterable[bytes], k: int = 25) -> List[Pageview]:
+        """ Computes the top K pageviews per domain of a dump
+
+        :param blocks: line aligned blocks of the dump, see Wikimedia.get_pageview_blocks
+        :param k: number of pageviews kept per domain
+        :return: List of top K pageviews per domain, in the order of Wikimedia.rows_to_pageviews
+        """
+
+        return Wikimedia.rows_to_pageviews(self.get_top_rows_per_domain(blocks, k))
+
+
+    def get_top_rows_per_domain(self, blocks: Iterable[bytes], k: int = 25,
+                                counters: Dict[str, int] = None) -> Dict[bytes, List[Tuple[int, int, bytes]]]:
+        """ Computes the top K rows per domain of a dump. At most two blocks per process are in flight so the
+        decompressed dump is never fully in memory
+
+        :param blocks: line aligned blocks of the dump, see Wikimedia.get_pageview_blocks
+        :param k: number of rows kept per domain
+        :param counters: when given, the rows found in the blacklist by the parsing processes are added to its
+        'blacklisted_rows'
+        :return: dict(domain -> list of (view_count, -line_number, page_title)) with at most k rows per domain
+        """
+
+        top_rows_per_domain = {}
+        in_flight = deque()
+        first_line_number = 0
+
+        for block in blocks:
+            if len(in_flight) >= 2 * self.processes:
+                self._merge_result(top_rows_per_domain, in_flight.popleft().result(), k, counters)
+            in_flight.append(self._executor.submit(_get_top_rows_of_block, block, first_line_number, k))
+            first_line_number += block.count(b'\n') + (not block.endswith(b'\n'))
+
+        while in_flight:
+            self._merge_result(top_rows_per_domain, in_flight.popleft().result(), k, counters)
+
+        return top_rows_per_domain
+
+
+    def _merge_result(self, top_rows_per_domain: Dict[bytes, List[Tuple[int, int, bytes]]],
+                      result: Tuple[Dict[bytes, List[Tuple[int, int, bytes]]], Optional[Dict[str, int]], int],
+                      k: int, counters: Dict[str, int] = None) -> None:
+        """ Merges the result of a block: its partial top K rows and the blacklist counters of its parsing process
+
+        :param top_rows_per_domain: top K rows per domain of the blocks merged so far
+        :param result: (partial top K rows per domain, blacklist counters or None, number of rows found in the
+        blacklist), see _get_top_rows_of_block
+        :param k: number of rows kept per domain
+        :param counters: when given, the rows found in the blacklist are added to its 'blacklisted_rows'
+        :return: None
+        """
+
+        partial_top_rows_per_domain, filter_counters, blacklisted_rows = result
+        self._merge_top_rows(top_rows_per_domain, partial_top_rows_per_domain, k)
+        if filter_counters is not None:
+            self.blacklist_keys.add_counters(filter_counters)
+        if counters is not None:
+            counters['blacklisted_rows'] = counters.get('blacklisted_rows', 0) + blacklisted_rows
+
+
+    @staticmethod
+    def _merge_top_rows(top_rows_per_domain: Dict[bytes, List[Tuple[int, int, bytes]]],
+                        partial_top_rows_per_domain: Dict[bytes, List[Tuple[int, int, bytes]]], k: int) -> None:
+        """ Merges the partial top K rows of a block in the top K rows of the dump, in place
+
+        :param top_rows_per_domain: top K rows per domain of the blocks merged so far
+        :param partial_top_rows_per_domain: top K rows per domain of a block
+        :param k: number of rows kept per domain
+        :return: None
+        """
+
+        for domain, partial_top_rows in partial_top_rows_per_domain.items():
+            # rows are (view_count, -line_number, page_title): the largest ones win, the earliest line on ties
+            top_rows_per_domain[domain] = heapq.nlargest(k, top_rows_per_domain.get(domain, []) + partial_top_rows,
+                                                         key=lambda row: (row[0], row[1]))
+
+
+def _init_parser(blacklist_keys: Set[Tuple[bytes, bytes]], engine_name: str) -> None:
+    """ Initializer of each parsing process
+
+    :param blacklist_keys: set of (domain, page_title) encoded in UTF-8 to filter out
+    :param engine_name: engine used to compute the partial top K
+    :return: None
+    """
+
+    _parser_state['blacklist_keys'] = blacklist_keys
+    _parser_state['engine'] = Engine.instantiate_engine(engine_name)
+
+
+def _get_top_rows_of_block(block: bytes, first_line_number: int,
+                           k: int) -> Tuple[Dict[bytes, List[Tuple[int, int, bytes]]], Optional[Dict[str, int]], int]:
+    """ Task executed by a parsing process: the partial top K rows per domain of a block
+
+    :param block: line aligned block of the dump
+    :param first_line_number: line number of the first line of the block in the dump
+    :param k: number of rows kept per domain
+    :return: (dict(domain -> list of (view_count, -line_number, page_title)), blacklist counters of the block or None
+             when the blacklist is a plain set, number of rows of the block found in the blacklist)
+    """
+
+    lines = block.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+
+    blacklist_keys = _parser_state['blacklist_keys']
+    if isinstance(blacklist_keys, BlacklistFilter):
+        blacklist_keys.reset_counters()
+    counters = {'blacklisted_rows': 0}
+    top_rows_per_domain = _parser_state['engine'].get_top_rows_per_domain(lines, blacklist_keys, k, first_line_number,
+                                                                          counters)
+
+    return top_rows_per_domain, (blacklist_keys.get_counters() if isinstance(blacklist_keys, BlacklistFilter)
+                                 else None), counters['blacklisted_rows']
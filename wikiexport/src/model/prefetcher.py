@@ -0,0 +1,164 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+from datetime import datetime
+from typing import Iterable
+import os
+
+from src.model.wikimedia import Wikimedia
+
+
+class Prefetcher:
+    """
+    Bounded prefetch pipeline: while an hour is being parsed and ranked, the dump files of the next `depth` hours are
+    downloaded to Wikimedia.DIR_PATH by background threads.
+    The files waiting to be consumed (and the ones being downloaded) must fit in `disk_budget` bytes. Because the size
+    of a dump is unknown before downloading it, a download is reserved the size of the largest file seen so far.
+    At least one download is always allowed so the pipeline can't stall.
+    Scheduling only happens in the consumer thread (get_file_path and release), downloads run in the background threads
+    """
+
+
+    def __init__(self, datetime_hours: Iterable[datetime], depth: int, disk_budget: int) -> None:
+        """ Instantiates a new Prefetcher and starts downloading the first hours
+
+        :param datetime_hours: hours that will be consumed, in order
+        :param depth: number of hours downloaded ahead of the one being consumed
+        :param disk_budget: maximum number of bytes staged in Wikimedia.DIR_PATH
+        """
+
+        self.depth = depth
+        self.disk_budget = disk_budget
+        self._datetime_hours = deque(datetime_hours)
+        self._executor = ThreadPoolExecutor(max_workers=max(depth, 1), thread_name_prefix='prefetcher')
+        self._futures = OrderedDict()
+        self._staged_bytes = {}
+        self._largest_file_size = 0
+        self._schedule()
+
+
+    def __enter__(self) -> 'Prefetcher':
+        """ Prefetcher can be used as a context manager so staged files are always cleaned up
+
+        :return: the prefetcher itself
+        """
+
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        """ Closes the prefetcher when leaving the with block
+
+        :return: None
+        """
+
+        self.close()
+
+
+    def get_file_path(self, dt: datetime) -> str:
+        """ Waits for dt's file to be downloaded. dt must be the next hour to consume
+
+        :param dt: datetime of the request
+        :return: path of the downloaded file
+        """
+
+        if dt not in self._futures:
+            # it didn't fit in the disk budget when the previous hours were scheduled
+            self._datetime_hours.remove(dt)
+            self._submit(dt)
+
+        try:
+            file_path = self._futures[dt].result()
+        except Exception:
+            self.release(dt)
+            raise
+
+        # the size of dt's file is now known so the disk budget may allow more downloads
+        self._schedule()
+
+        return file_path
+
+
+    def release(self, dt: datetime) -> None:
+        """ Deletes dt's file once it has been consumed and starts the next downloads
+
+        :param dt: datetime of the request
+        :return: None
+        """
+
+        future = self._futures.pop(dt, None)
+        self._staged_bytes.pop(dt, None)
+
+        if future is not None and future.done() and future.exception() is None:
+            self._remove_file(future.result())
+
+        self._schedule()
+
+
+    def close(self) -> None:
+        """ Stops the downloads that were not started, waits for the running ones and deletes every staged file
+
+        :return: None
+        """
+
+        self._datetime_hours.clear()
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+        for future in self._futures.values():
+            if not future.cancelled() and future.exception() is None:
+                self._remove_file(future.result())
+        self._futures.clear()
+
+
+    def _schedule(self) -> None:
+        """ Starts downloading the next hours as long as the depth and the disk budget allow it
+
+        :return: None
+        """
+
+        self._update_staged_bytes()
+
+        while self._datetime_hours and len(self._futures) <= self.depth:
+            reserved_bytes = sum(self._staged_bytes.values())
+            # until a first file is downloaded its size can't be estimated so only one download runs
+            if self._futures and (not self._largest_file_size or
+                                  reserved_bytes + self._largest_file_size > self.disk_budget):
+                return
+            self._submit(self._datetime_hours.popleft())
+
+
+    def _submit(self, dt: datetime) -> None:
+        """ Starts downloading dt's file in a background thread
+
+        :param dt: datetime of the request
+        :return: None
+        """
+
+        self._staged_bytes[dt] = self._largest_file_size
+        self._futures[dt] = self._executor.submit(Wikimedia.download_pageviews, dt)
+
+
+    def _update_staged_bytes(self) -> None:
+        """ Replaces the reserved size of the finished downloads by the actual size of their file
+
+        :return: None
+        """
+
+        for dt, future in self._futures.items():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                file_size = os.path.getsize(future.result())
+                self._largest_file_size = max(self._largest_file_size, file_size)
+                self._staged_bytes[dt] = file_size
+
+
+    @staticmethod
+    def _remove_file(file_path: str) -> None:
+        """ Deletes a staged file if it's still there
+
+        :param file_path: path of the file
+        :return: None
+        """
+
+        if os.path.exists(file_path):
+            os.remove(file_path)
@@ -0,0 +1,142 @@
+from datetime import datetime
+from typing import List, Optional
+import cProfile
+import io
+import marshal
+import pickle
+import pstats
+import tracemalloc
+
+import click
+
+
+class HourProfiler:
+    """
+    Profiles the processing of an hour in the current thread: with cProfile (cpu), tracemalloc (memory) or both.
+    The results are saved next to the result of the hour, as a .prof file readable by pstats or snakeviz and a
+    .tracemalloc snapshot readable by tracemalloc.Snapshot.load. The threads of the prefetcher and of the AsyncWriter
+    and the processes of the ParallelParser aren't profiled, only the thread the hour is computed in
+    """
+
+    MODES = ('cpu', 'memory', 'both')
+    PROF_EXTENSION = 'prof'
+    SNAPSHOT_EXTENSION = 'tracemalloc'
+    # frames kept per allocation, so the snapshot can be grouped by traceback and not only by line
+    NB_FRAMES = 5
+    # allocations of the profiler itself, left out of the summary
+    IGNORED_FILES = (tracemalloc.__file__, '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>')
+
+
+    def __init__(self, datetime_hour: datetime, mode: str = 'both') -> None:
+        """ Instantiates the profiler of an hour
+
+        :param datetime_hour: datetime of the request
+        :param mode: one of MODES
+        """
+
+        if mode not in self.MODES:
+            raise ValueError(f'Unknown profile mode {mode}, expected one of {", ".join(self.MODES)}')
+
+        self.datetime_hour = datetime_hour
+        self.mode = mode
+        self.cpu_profile: Optional[cProfile.Profile] = None
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.peak_bytes: Optional[int] = None
+        self._stop_tracemalloc = False
+
+
+    def __enter__(self) -> 'HourProfiler':
+        """ Starts profiling
+
+        :return: the profiler
+        """
+
+        if self.mode in ('memory', 'both'):
+            # tracemalloc may already be tracing (PYTHONTRACEMALLOC), it's then left running
+            self._stop_tracemalloc = not tracemalloc.is_tracing()
+            if self._stop_tracemalloc:
+                tracemalloc.start(self.NB_FRAMES)
+            elif hasattr(tracemalloc, 'reset_peak'):
+                # Python 3.9+, before that the peak also covers what was traced before the hour
+                tracemalloc.reset_peak()
+        if self.mode in ('cpu', 'both'):
+            self.cpu_profile = cProfile.Profile()
+            self.cpu_profile.enable()
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        """ Stops profiling, even when the hour failed
+
+        :return: None
+        """
+
+        if self.cpu_profile is not None:
+            self.cpu_profile.disable()
+        if self.mode in ('memory', 'both'):
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, file_name) for file_name in self.IGNORED_FILES])
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+            if self._stop_tracemalloc:
+                tracemalloc.stop()
+
+
+    def save(self, writer: 'Writer') -> List[str]:
+        """ Writes the profile and the snapshot next to the result of the hour
+
+        :param writer: writer of the results
+        :return: paths of the written files
+        """
+
+        file_paths = []
+        if self.cpu_profile is not None:
+            # the format of cProfile.Profile.dump_stats. The stats are built again from the profile as pstats.Stats
+            # empties them
+            self.cpu_profile.create_stats()
+            file_paths.append(writer.write_bytes(marshal.dumps(self.cpu_profile.stats), self.datetime_hour,
+                                                 self.PROF_EXTENSION))
+        if self.snapshot is not None:
+            # the format of tracemalloc.Snapshot.dump
+            file_paths.append(writer.write_bytes(pickle.dumps(self.snapshot, pickle.HIGHEST_PROTOCOL),
+                                                 self.datetime_hour, self.SNAPSHOT_EXTENSION))
+
+        return file_paths
+
+
+    def get_summary(self, top_n: int = 20) -> str:
+        """ The top_n functions taking the most time by themselves, and the top_n lines holding the most memory
+        at the end of the hour
+
+        :param top_n: number of functions and of lines
+        :return: summary to print
+        """
+
+        parts = [f'Profile of {self.datetime_hour}:']
+        if self.cpu_profile is not None:
+            stream = io.StringIO()
+            pstats.Stats(self.cpu_profile, stream=stream).strip_dirs().sort_stats('tottime').print_stats(top_n)
+            parts.append(stream.getvalue().strip('\n'))
+        if self.snapshot is not None:
+            parts.append(f'Peak of traced memory: {self.peak_bytes / 1024 ** 2:.1f} MiB, top {top_n} lines by '
+                         f'memory still allocated:')
+            parts += [f'  {statistic}' for statistic in self.snapshot.statistics('lineno')[:top_n]]
+
+        return '\n'.join(parts)
+
+
+    def save_and_echo(self, writer: 'Writer', top_n: int = 20) -> None:
+        """ Prints the summary and saves the profile. A profile that can't be saved only prints a warning, so it
+        never fails the hour
+
+        :param writer: writer of the results
+        :param top_n: number of functions and of lines of the summary
+        :return: None
+        """
+
+        click.echo(self.get_summary(top_n))
+        try:
+            for file_path in self.save(writer):
+                click.echo(click.style(f'Profile of {self.datetime_hour} saved to {file_path}', fg='green'))
+        except Exception as e:
+            click.echo(click.style(f'Profile of {self.datetime_hour} could not be saved: {e}', fg='yellow'))
@@ -0,0 +1,110 @@
+from datetime import datetime
+from typing import List, Optional
+import os
+import zlib
+
+from src.model.pageview import Pageview
+
+
+class ResultCache:
+    """
+    Keeps the computed top K pageviews of the processed hours in DIR_PATH so they can be written again to another
+    output without downloading the dump. Each hour is a zlib compressed file of 'domain page_title view_count' lines
+    (the dump format, titles never contain spaces). When the files exceed max_size, the least recently used ones are
+    evicted: the modification time of a file is its last use.
+    Files are written to a temporary path then renamed so worker processes can share the directory
+    """
+
+    DIR_PATH = '/tmp/wikiexporter_results'
+    FILE_PATTERN = '%Y%m%dT%H:%M:%S'
+
+
+    def __init__(self, max_size: int, dir_path: str = None) -> None:
+        """ Instantiates a result cache
+
+        :param max_size: maximum size in bytes of the cached results
+        :param dir_path: directory of the cached results, DIR_PATH when None
+        """
+
+        self.max_size = max_size
+        self.dir_path = dir_path or self.DIR_PATH
+
+
+    def get_pageviews(self, dt: datetime) -> Optional[List[Pageview]]:
+        """ The cached top K pageviews of dt, marked as the most recently used
+
+        :param dt: datetime of the request
+        :return: the pageviews in the order they were computed, or None when dt is not cached
+        """
+
+        file_path = self._get_file_path(dt)
+        try:
+            with open(file_path, 'rb') as file_handle:
+                content = zlib.decompress(file_handle.read())
+            os.utime(file_path)
+        except (OSError, zlib.error):
+            return None
+
+        pageviews = []
+        for line in content.decode('utf-8').split('\n'):
+            if line:
+                domain, page_title, view_count = line.split(' ')
+                pageviews.append(Pageview(domain, page_title, int(view_count)))
+
+        return pageviews
+
+
+    def set_pageviews(self, dt: datetime, pageviews: List[Pageview]) -> None:
+        """ Caches the top K pageviews of dt then evicts the least recently used results over max_size
+
+        :param dt: datetime of the request
+        :param pageviews: the top K pageviews
+        :return: None
+        """
+
+        content = ''.join(f'{pageview.domain} {pageview.page_title} {pageview.view_count}\n' for pageview in pageviews)
+        os.makedirs(self.dir_path, exist_ok=True)
+        file_path = self._get_file_path(dt)
+        temporary_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file_handle:
+            file_handle.write(zlib.compress(content.encode('utf-8')))
+        os.replace(temporary_path, file_path)
+
+        self._evict()
+
+
+    def _evict(self) -> None:
+        """ Removes the least recently used results until they fit in max_size
+
+        :return: None
+        """
+
+        entries = []
+        for entry in os.scandir(self.dir_path):
+            if entry.name.endswith('.zlib'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            total_size -= size
+
+
+    def _get_file_path(self, dt: datetime) -> str:
+        """ Path of the cached result of dt
+
+        :param dt: datetime of the request
+        :return: file path
+        """
+
+        return os.path.join(self.dir_path, f'{dt.strftime(self.FILE_PATTERN)}.zlib')
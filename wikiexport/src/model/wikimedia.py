@@ -1,13 +1,13 @@
 import gzip
 from datetime import datetime
-from typing import List, Iterable, Generator
+from typing import Dict, List, Iterable, Generator, Set, Tuple
 from collections import defaultdict
 import heapq
 import itertools
 import os
+import zlib
 
-import requests
-
+from src.model.http_client import HttpClient
 from src.model.pageview import Pageview
 from src.utils import repeat_if_exception
 
@@ -20,26 +20,141 @@ class Wikimedia:
 
     PAGEVIEWS_URL_TEMPLATE = 'https://dumps.wikimedia.org/other/pageviews/{year}/{year}-{month}/pageviews-{date}-{hour}0000.gz'
     DIR_PATH = '/tmp'
+    BLOCK_SIZE = 16 * 1024 ** 2
 
 
     @classmethod
-    @repeat_if_exception(message='Something went wrong when downloading the pagesviews data', nb_times=3)
-    def get_pageviews(cls, dt: datetime) -> Generator['Pageview', None, None]:
+    def get_pageviews(cls, dt: datetime, stage_to_disk: bool = False) -> Generator['Pageview', None, None]:
         """ Get the pageviews data related to the datetime dt.
         it's a generator it doesn't load all the data in memory.
-        It's getting one line a time from secondary storage and converts it to a Pageview instance
+        By default the dump is decompressed while it's being downloaded so parsing overlaps the network transfer and
+        nothing is written to disk. With stage_to_disk the file is first downloaded to DIR_PATH then read from there
+        one line at a time. A download broken mid-stream is resumed where it stopped, in both cases, without
+        yielding a pageview twice
 
         :param dt: datetime of the request
+        :param stage_to_disk: download the whole file to DIR_PATH before reading it
         :return: generator on the downloaded pageviews
         """
 
-        pageview_url = cls._get_pageview_url(dt)
-        file_path = cls._download_file(pageview_url, dir_path=cls.DIR_PATH)
+        for line in cls.get_pageview_lines(dt, stage_to_disk=stage_to_disk):
+            yield Pageview.instance_from_pageview_line(line.decode('utf-8', errors='replace'))
+
+
+    @classmethod
+    def get_pageview_lines(cls, dt: datetime, stage_to_disk: bool = False,
+                           metrics: 'HourMetrics' = None) -> Generator[bytes, None, None]:
+        """ Get the raw lines of the pageviews data related to the datetime dt, without decoding nor parsing them.
+        Like get_pageviews the dump is decompressed while it's being downloaded unless stage_to_disk is set
+
+        :param dt: datetime of the request
+        :param stage_to_disk: download the whole file to DIR_PATH before reading it
+        :param metrics: when given, the download and the decompression are measured in it
+        :return: generator on the lines of the dump
+        """
+
+        if stage_to_disk:
+            file_path = cls._download_measured(dt, metrics)
+            yield from cls.read_pageview_lines(file_path, metrics)
+            os.remove(file_path)
+        else:
+            yield from cls._stream_lines(cls._get_pageview_url(dt), metrics=metrics)
+
+
+    @classmethod
+    def get_pageview_blocks(cls, dt: datetime, stage_to_disk: bool = False, block_size: int = BLOCK_SIZE,
+                            metrics: 'HourMetrics' = None) -> Generator[bytes, None, None]:
+        """ Get the pageviews data related to the datetime dt as large blocks of raw lines. Every block but the last
+        one ends with a new line so a line is never split across two blocks
+
+        :param dt: datetime of the request
+        :param stage_to_disk: download the whole file to DIR_PATH before reading it
+        :param block_size: minimum size of a block (the last one can be smaller)
+        :param metrics: when given, the download and the decompression are measured in it
+        :return: generator on the blocks of the dump
+        """
+
+        if stage_to_disk:
+            file_path = cls._download_measured(dt, metrics)
+            yield from cls.read_pageview_blocks(file_path, block_size, metrics)
+            os.remove(file_path)
+        else:
+            yield from cls._align_blocks(cls._stream_blocks(cls._get_pageview_url(dt), metrics=metrics), block_size)
+
+
+    @classmethod
+    @repeat_if_exception(message='Something went wrong when downloading the pagesviews data', nb_times=3)
+    def download_pageviews(cls, dt: datetime) -> str:
+        """ Downloads the pageviews file related to the datetime dt in DIR_PATH
+
+        :param dt: datetime of the request
+        :return: path of the downloaded file
+        """
+
+        return cls._download_file(cls._get_pageview_url(dt), dir_path=cls.DIR_PATH)
+
+
+    @classmethod
+    def read_pageviews(cls, file_path: str) -> Generator['Pageview', None, None]:
+        """ Reads the pageviews of an already downloaded file one line at a time. The file is left in place
+
+        :param file_path: path of the gzipped pageviews file
+        :return: generator on the pageviews of the file
+        """
 
         for line in cls._read_lines(file_path):
             yield Pageview.instance_from_pageview_line(line)
 
-        os.remove(file_path)
+
+    @classmethod
+    def read_pageview_lines(cls, file_path: str, metrics: 'HourMetrics' = None) -> Generator[bytes, None, None]:
+        """ Reads the raw lines of an already downloaded file. The file is left in place
+
+        :param file_path: path of the gzipped pageviews file
+        :param metrics: when given, the decompression is measured in it
+        :return: generator on the lines of the file
+        """
+
+        lines = cls._read_raw_lines(file_path)
+        yield from metrics.timed('decompress', lines, count_lines=True) if metrics is not None else lines
+
+
+    @classmethod
+    def read_pageview_blocks(cls, file_path: str, block_size: int = BLOCK_SIZE,
+                             metrics: 'HourMetrics' = None) -> Generator[bytes, None, None]:
+        """ Reads an already downloaded file as large blocks of raw lines (see get_pageview_blocks). The file is
+        left in place
+
+        :param file_path: path of the gzipped pageviews file
+        :param block_size: minimum size of a block (the last one can be smaller)
+        :param metrics: when given, the decompression is measured in it
+        :return: generator on the blocks of the file
+        """
+
+        with gzip.open(file_path, 'rb') as file_handle:
+            blocks = iter(lambda: file_handle.read(block_size), b'')
+            if metrics is not None:
+                blocks = metrics.timed('decompress', blocks, count_lines=True)
+            yield from cls._align_blocks(blocks, block_size)
+
+
+    @classmethod
+    def _download_measured(cls, dt: datetime, metrics: 'HourMetrics' = None) -> str:
+        """ Calls download_pageviews as the download stage of metrics
+
+        :param dt: datetime of the request
+        :param metrics: metrics of the hour, the file is just downloaded when None
+        :return: path of the downloaded file
+        """
+
+        if metrics is None:
+            return cls.download_pageviews(dt)
+
+        with metrics.stage('download') as stage:
+            file_path = cls.download_pageviews(dt)
+            stage.bytes = os.path.getsize(file_path)
+
+        return file_path
 
 
     @classmethod
@@ -56,7 +171,8 @@ class Wikimedia:
 
     @classmethod
     def _download_file(cls, url: str, dir_path: str, chunk_size=10 * 1024 ** 2) -> str:
-        """ Downloads a file from url and saves it in a temporary path.
+        """ Downloads a file from url and saves it in a temporary path. A download broken mid-stream is resumed
+        where it stopped (see HttpClient.download)
 
         :param url: url of the file to download
         :param dir_path: local path where to save the file
@@ -65,17 +181,8 @@ class Wikimedia:
         """
 
         file_name = url.split('/')[-1]
-        file_path = os.path.join(dir_path, file_name)
-        response = requests.get(url=url, stream=True)
-
-        if response.status_code != requests.codes.ok:
-           raise Exception(f'Something went wrong when downloading {url}')
 
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                f.write(chunk)
-
-        return file_path
+        return HttpClient.download(url, os.path.join(dir_path, file_name), chunk_size)
 
 
     @classmethod
@@ -90,12 +197,143 @@ class Wikimedia:
             yield from file_handle
 
 
+    @classmethod
+    def _read_raw_lines(cls, file_path: str) -> Generator[bytes, None, None]:
+        """read lines of a gzipped file without decoding them.
+
+        :param file_path: path of the file to read
+        :return: Generator over the lines of the file being read
+        """
+
+        with gzip.open(file_path, 'rb') as file_handle:
+            yield from file_handle
+
+
+    @classmethod
+    def _stream_lines(cls, url: str, chunk_size=1024 ** 2,
+                      metrics: 'HourMetrics' = None) -> Generator[bytes, None, None]:
+        """ Downloads a gzipped file and yields its lines as the compressed chunks arrive, without staging it on disk
+
+        :param url: url of the gzipped file
+        :param chunk_size: size of the compressed chunks read from the response
+        :param metrics: when given, the download and the decompression are measured in it
+        :return: Generator over the lines of the file being downloaded
+        """
+
+        yield from cls._split_lines(cls._stream_blocks(url, chunk_size, metrics))
+
+
+    @classmethod
+    def _stream_blocks(cls, url: str, chunk_size=1024 ** 2,
+                       metrics: 'HourMetrics' = None) -> Generator[bytes, None, None]:
+        """ Downloads a gzipped file and yields blocks of decompressed data as the compressed chunks arrive.
+        HttpClient.stream resumes a response broken mid-stream from the last compressed byte received, so the
+        decompressor keeps its state and no line is yielded twice.
+        With metrics, the chunks are timed as the download stage and the decompressed blocks as the decompress stage
+
+        :param url: url of the gzipped file
+        :param chunk_size: size of the compressed chunks read from the response
+        :param metrics: when given, the download and the decompression are measured in it
+        :return: Generator over blocks of decompressed data (lines can span several blocks)
+        """
+
+        chunks = HttpClient.stream(url, chunk_size)
+        if metrics is None:
+            yield from cls._decompress_chunks(chunks)
+        else:
+            yield from metrics.timed('decompress', cls._decompress_chunks(metrics.timed('download', chunks)),
+                                     count_lines=True)
+
+
+    @classmethod
+    def _decompress_chunks(cls, chunks: Iterable[bytes]) -> Generator[bytes, None, None]:
+        """ Incrementally decompresses gzip data. Concatenated gzip members are supported like gzip.open does and,
+        like gzip.open, data ending in the middle of a member raises an EOFError so a truncated dump isn't taken for a
+        complete one
+
+        :param chunks: chunks of compressed data
+        :return: Generator over blocks of decompressed data
+        """
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # whether the current member received data
+        started = False
+
+        for chunk in chunks:
+            while chunk:
+                started = True
+                block = decompressor.decompress(chunk)
+                if block:
+                    yield block
+                if decompressor.eof:
+                    # the remaining bytes belong to the next gzip member
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    started = False
+                else:
+                    chunk = b''
+
+        block = decompressor.flush()
+        if block:
+            yield block
+        if started and not decompressor.eof:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+    @classmethod
+    def _split_lines(cls, blocks: Iterable[bytes]) -> Generator[bytes, None, None]:
+        """ Splits blocks of data into lines. A line can span several blocks
+
+        :param blocks: consecutive blocks of data
+        :return: Generator over the lines (without the trailing new line)
+        """
+
+        pending = b''
+
+        for block in blocks:
+            lines = (pending + block).split(b'\n')
+            pending = lines.pop()
+            yield from lines
+
+        if pending:
+            yield pending
+
+
+    @classmethod
+    def _align_blocks(cls, blocks: Iterable[bytes], block_size: int) -> Generator[bytes, None, None]:
+        """ Regroups blocks of data into blocks of at least block_size bytes ending with a new line
+
+        :param blocks: consecutive blocks of data
+        :param block_size: minimum size of a block (the last one can be smaller)
+        :return: Generator over line aligned blocks
+        """
+
+        pending, pending_size = [], 0
+
+        for block in blocks:
+            pending.append(block)
+            pending_size += len(block)
+            if pending_size >= block_size:
+                data = b''.join(pending)
+                end = data.rfind(b'\n') + 1
+                if end:
+                    yield data[:end]
+                    pending, pending_size = [data[end:]], len(data) - end
+                else:
+                    pending, pending_size = [data], len(data)
+
+        data = b''.join(pending)
+        if data:
+            yield data
+
+
     @classmethod
     def get_top_pageviews_per_domain(cls, pageviews: Iterable[Pageview], k=25) -> List[Pageview]:
         """ Get the top K pageviews per domain. The main data structure is a dictionary where each key
         represents a domain and each value is a min heap containing the top 25 pageviews based on the view_count
         of each pageview.
         Time complexity is O(n log k) where k is usually 25 and n number of elements in pageviews.
+        Ties on view_count are won by the pageview that comes first, like in get_top_pageviews_per_domain_from_lines.
 
         :param pageviews: An iterable over a collection of pageviews
         :param k: The size of the min heap to compute top K pageviews per domain
@@ -104,21 +342,115 @@ class Wikimedia:
 
         top_k_per_domain = defaultdict(list)
 
-        for pageview in pageviews:
+        for position, pageview in enumerate(pageviews):
             domain, view_count = pageview.domain, pageview.view_count
             top_k = top_k_per_domain[domain]
 
             if len(top_k) < k:
-                heapq.heappush(top_k, (view_count, id(pageview), pageview))
+                heapq.heappush(top_k, (view_count, -position, pageview))
 
             elif len(top_k) == k and view_count > top_k[0][0]:
-                heapq.heapreplace(top_k, (view_count, id(pageview), pageview))
+                heapq.heapreplace(top_k, (view_count, -position, pageview))
 
         top_k_pageviews = list(pageview for _, _, pageview in itertools.chain(*top_k_per_domain.values()))
 
         return top_k_pageviews
 
 
+    @classmethod
+    def get_top_pageviews_per_domain_from_lines(cls, lines: Iterable[bytes],
+                                                blacklist_keys: Set[Tuple[bytes, bytes]] = frozenset(),
+                                                k=25) -> List[Pageview]:
+        """ Same result as filtering the pageviews of lines with the blacklist then calling get_top_pageviews_per_domain,
+        but parsing, filtering and ranking are fused and work on the raw lines of the dump (see
+        get_top_rows_per_domain_from_lines). Titles are only decoded, and pageviews built, for the final top K.
+
+        :param lines: raw lines of a pageviews dump (domain page_title view_count response_size)
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8 to filter out
+        :param k: The size of the min heap to compute top K pageviews per domain
+        :return: List of top K pageviews per domain, in the order of rows_to_pageviews
+        """
+
+        return cls.rows_to_pageviews(cls.get_top_rows_per_domain_from_lines(lines, blacklist_keys, k))
+
+
+    @classmethod
+    def get_top_rows_per_domain_from_lines(cls, lines: Iterable[bytes],
+                                           blacklist_keys: Set[Tuple[bytes, bytes]] = frozenset(), k=25,
+                                           first_line_number=0, counters: Dict[str, int] = None
+                                           ) -> Dict[bytes, List[Tuple[int, int, bytes]]]:
+        """ Fused parse, filter and rank of raw dump lines.
+        Once the heap of a domain holds k entries its root view_count becomes the admission threshold of the domain:
+        a row that doesn't beat it is rejected right after reading its domain and view_count, before the blacklist
+        lookup. Most rows of a dump are in the long tail so most rows stop there.
+        Ties on view_count are won by the row that comes first in the dump.
+
+        :param lines: raw lines of a pageviews dump (domain page_title view_count response_size)
+        :param blacklist_keys: set of (domain, page_title) encoded in UTF-8 to filter out
+        :param k: The size of the min heap to compute top K pageviews per domain
+        :param first_line_number: line number of the first line in the dump, when lines is only a part of it
+        :param counters: when given, the rows found in the blacklist are added to its 'blacklisted_rows'
+        :return: dict(domain -> heap of (view_count, -line_number, page_title)) with at most k rows per domain
+        """
+
+        top_k_per_domain = defaultdict(list)
+        thresholds = {}
+        blacklisted_rows = 0
+
+        for line_number, line in enumerate(lines, first_line_number):
+            domain, page_title, view_count, _ = line.split(b' ')
+            view_count = int(view_count)
+
+            if view_count <= thresholds.get(domain, -1):
+                continue
+            if (domain, page_title) in blacklist_keys:
+                blacklisted_rows += 1
+                continue
+
+            top_k = top_k_per_domain[domain]
+            if len(top_k) < k:
+                heapq.heappush(top_k, (view_count, -line_number, page_title))
+                if len(top_k) < k:
+                    continue
+            else:
+                heapq.heapreplace(top_k, (view_count, -line_number, page_title))
+            thresholds[domain] = top_k[0][0]
+
+        if counters is not None:
+            counters['blacklisted_rows'] = counters.get('blacklisted_rows', 0) + blacklisted_rows
+
+        return top_k_per_domain
+
+
+    @classmethod
+    def rows_to_pageviews(cls, top_rows_per_domain: Dict[bytes, List[Tuple[int, int, bytes]]]) -> List[Pageview]:
+        """ Decodes the top rows of each domain into pageviews. Rows of a domain are ordered by view_count then line
+        number, so whatever engine computed the rows the sorted output (see sort_pageviews_per_domain_and_views)
+        is the same
+
+        :param top_rows_per_domain: dict(domain -> list of (view_count, -line_number, page_title))
+        :return: List of top K pageviews per domain
+        """
+
+        return list(cls._decode_pageview(domain, page_title, view_count)
+                    for domain, top_rows in top_rows_per_domain.items()
+                    for view_count, _, page_title in sorted(top_rows, key=lambda row: (row[0], -row[1])))
+
+
+    @classmethod
+    def _decode_pageview(cls, domain: bytes, page_title: bytes, view_count: int) -> Pageview:
+        """ Builds a pageview from the raw fields of a dump line
+
+        :param domain: domain encoded in UTF-8
+        :param page_title: page title encoded in UTF-8
+        :param view_count: number of views
+        :return: Pageview object
+        """
+
+        return Pageview(domain.decode('utf-8', errors='replace'), page_title.decode('utf-8', errors='replace'),
+                        view_count)
+
+
     @classmethod
     def sort_pageviews_per_domain_and_views(cls, pageviews: List['Pageview']) -> None:
         """ Sort the pageviews per domain and view_count ascending. The sort is done in place.
@@ -1,37 +1,52 @@
-from typing import Iterable, Tuple
+from typing import Generator, Iterable, List, Optional, Sequence, Set, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import  datetime
 from os import path
+import json
+import os
 from urllib import parse
 from abc import ABC, abstractmethod
+import threading
+import time
 
+from src.model.output_format import CsvFormat, OutputFormat
 from src.utils import repeat_if_exception
 
 import boto3
+import click
 
 
 class Writer(ABC):
     """
-    This class is responsible of writing CSV to storage
+    This class is responsible of writing CSV (or another OutputFormat) to storage
     """
 
-    HEADER = 'domain,page_title,pageview_count'
+    HEADER = OutputFormat.HEADER
     FILE_PATTERN = '%Y%m%dT%H:%M:%S'
 
 
     @classmethod
-    def instantiate_writer(cls, output_path: str, aws_access_key_id: str = None,
-                           aws_secret_access_key: str = None) -> 'Writer':
-        """ A factory method to choose which type of Writer to instantiate. If AWS credentials are not null
-        priority is given to S3Writer
+    def instantiate_writer(cls, output_path: Union[str, Sequence[str]], aws_access_key_id: str = None,
+                           aws_secret_access_key: str = None, format_name: str = 'csv',
+                           file_pattern: str = FILE_PATTERN) -> 'Writer':
+        """ A factory method to choose which type of Writer to instantiate. Paths starting with s3:// are written by
+        an S3Writer (with the AWS credentials, or the default ones of boto3 when they are null) and the others by a
+        LocalWriter. Several output paths give a MultiWriter writing to all of them
 
         :param: output_path: path where to save the result CSV can be local or on S3 dir path (s3://mybucket/my_dir
+                             or a sequence of such paths
+        :param: format_name: format of the files, one of OutputFormat.FORMAT_NAMES
+        :param: file_pattern: strftime pattern of the file names, without the extension
         """
 
-        if aws_secret_access_key and aws_access_key_id:
-            return S3Writer(s3_dir_path=output_path, aws_access_key_id= aws_access_key_id,
-                            aws_secret_access_key=aws_secret_access_key)
-        else:
-            return LocalWriter(output_path)
+        output_format = OutputFormat.instantiate_format(format_name)
+        output_paths = [output_path] if isinstance(output_path, str) else list(output_path)
+        writers = [S3Writer(output, aws_access_key_id, aws_secret_access_key, output_format, file_pattern)
+                   if output.startswith('s3://') else LocalWriter(output, output_format, file_pattern)
+                   for output in output_paths]
+
+        return writers[0] if len(writers) == 1 else MultiWriter(writers, output_format)
 
 
     @abstractmethod
@@ -46,19 +61,77 @@ class Writer(ABC):
         pass
 
 
+    @abstractmethod
+    def write_bytes(self, content: bytes, dt: datetime, extension: str = None) -> str:
+        """ Abstract method to write the pageviews of dt already encoded in the format of the writer
+
+        :param content: the encoded file
+        :param dt: datetime of the request
+        :param extension: extension of the file, the one of the format of the writer when None. Another extension
+        writes a file next to the result of dt, such as its profile
+        :return: path where the file is saved
+        """
+
+        pass
+
+
+    def write_measured(self, pageviews: List['Pageview'], dt: datetime, metrics: 'HourMetrics') -> str:
+        """ Writes the pageviews as the write stage of metrics. They are encoded once, so the stage reports the size
+        of the written file
+
+        :param pageviews: collection of pageviews
+        :param dt: datetime of the request
+        :param metrics: metrics of the hour
+        :return: path where the pageviews were written
+        """
+
+        with metrics.stage('write') as stage:
+            stage.rows_in = len(pageviews)
+            content = b''.join(self.output_format.encode(pageviews))
+            stage.bytes = len(content)
+            return self.write_bytes(content, dt)
+
+
+    @abstractmethod
+    def get_path(self, dt: datetime) -> str:
+        """ Abstract method computing where the pageviews of dt are written
+
+        :param dt: datetime of the request
+        :return: path of the CSV
+        """
+
+        pass
+
+
+    @abstractmethod
+    def get_existing_paths(self, file_paths: Iterable[str]) -> Set[str]:
+        """ Abstract method checking in bulk which of file_paths, written by this writer, still exist
+
+        :param file_paths: paths returned by get_path
+        :return: the paths that exist
+        """
+
+        pass
+
+
 class LocalWriter(Writer):
     """
     Class that writes CSV files in local storage
     """
 
 
-    def __init__(self, output_dir: str) -> None:
+    def __init__(self, output_dir: str, output_format: 'OutputFormat' = None,
+                 file_pattern: str = Writer.FILE_PATTERN) -> None:
         """ instantiates a new LocalWriter
 
         :param output_dir: directory where to wright the resulting CSV
+        :param output_format: format of the files, plain CSV when None
+        :param file_pattern: strftime pattern of the file names
         """
 
         self.output_dir = output_dir if not output_dir.endswith('/') else output_dir[:-1]
+        self.output_format = output_format or CsvFormat()
+        self.file_pattern = file_pattern
 
 
     @repeat_if_exception(message='Something went wrong when writing data in local storage', nb_times=3)
@@ -70,31 +143,94 @@ class LocalWriter(Writer):
         :return: path where the pageviews were written
         """
 
-        file_name = f'{dt.strftime(self.FILE_PATTERN)}.csv'
-        file_path = path.join(self.output_dir, file_name)
-        with open(file_path, 'wt') as f:
-            f.write(f'{self.HEADER}\n')
-            for pageview in pageviews:
-                f.write(f'{pageview.domain},{pageview.page_title},{pageview.view_count}\n')
+        file_path = self.get_path(dt)
+        if self.output_format.extension == 'csv':
+            with open(file_path, 'wt') as f:
+                f.write(f'{self.HEADER}\n')
+                for pageview in pageviews:
+                    f.write(f'{pageview.domain},{pageview.page_title},{pageview.view_count}\n')
+        else:
+            with open(file_path, 'wb') as f:
+                for chunk in self.output_format.encode(pageviews):
+                    f.write(chunk)
 
         return file_path
 
 
+    @repeat_if_exception(message='Something went wrong when writing data in local storage', nb_times=3)
+    def write_bytes(self, content: bytes, dt: datetime, extension: str = None) -> str:
+        """ Write an encoded file in local storage
+
+        :param content: the encoded file
+        :param dt: datetime of the request
+        :param extension: extension of the file, the one of the format of the writer when None
+        :return: path where the file was written
+        """
+
+        file_path = self.get_path(dt, extension)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+
+        return file_path
+
+
+    def get_path(self, dt: datetime, extension: str = None) -> str:
+        """ Path of the CSV of dt in the output directory
+
+        :param dt: datetime of the request
+        :param extension: extension of the file, the one of the format of the writer when None
+        :return: path of the CSV
+        """
+
+        file_name = f'{dt.strftime(self.file_pattern)}.{extension or self.output_format.extension}'
+
+        return path.join(self.output_dir, file_name)
+
+
+    def get_existing_paths(self, file_paths: Iterable[str]) -> Set[str]:
+        """ Checks the files with os.stat
+
+        :param file_paths: paths returned by get_path
+        :return: the paths that exist
+        """
+
+        existing_paths = set()
+        for file_path in file_paths:
+            try:
+                os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            existing_paths.add(file_path)
+
+        return existing_paths
+
+
 class S3Writer(Writer):
     """
-    Class that writes CSV files in S3 without staging data in local storage
+    Class that writes CSV files (or another OutputFormat) in S3 without staging data in local storage.
+    The encoded chunks are appended to a buffer which is uploaded as soon as it reaches PART_SIZE: the first time it
+    does, a multipart upload is started, so the memory used doesn't depend on the size of the output. Outputs smaller
+    than PART_SIZE are uploaded with a single put_object
     """
 
+    # size of the parts of a multipart upload, S3 requires at least 5 MB for every part except the last one
+    PART_SIZE = 8 * 1024 ** 2
+
 
-    def __init__(self, s3_dir_path: str, aws_access_key_id: str, aws_secret_access_key: str) -> None:
+    def __init__(self, s3_dir_path: str, aws_access_key_id: str, aws_secret_access_key: str,
+                 output_format: 'OutputFormat' = None, file_pattern: str = Writer.FILE_PATTERN) -> None:
         """
 
         :param s3_dir_path: the bucket and directory where to save CSV files. Example: s3://mybucket/mydir
         :param aws_access_key_id:
         :param aws_secret_access_key:
+        :param output_format: format of the objects, plain CSV when None
+        :param file_pattern: strftime pattern of the object names
         """
 
         self.s3_dir_path = s3_dir_path if not s3_dir_path.endswith('/') else s3_dir_path[:-1]
+        self.output_format = output_format or CsvFormat()
+        self.file_pattern = file_pattern
         self.s3_client = boto3.Session(aws_access_key_id=aws_access_key_id,
                                        aws_secret_access_key=aws_secret_access_key).client('s3')
 
@@ -108,28 +244,393 @@ class S3Writer(Writer):
         :return: S3 path of the newly uploaded object
         """
 
-        csv_lines = [S3Writer.HEADER] + list(f'{pageview.domain},{pageview.page_title},{pageview.view_count}'
-                                             for pageview in pageviews)
-        csv_content = '\n'.join(csv_lines)
-        bucket, object_name = self._get_bucket_and_object(dt)
-        object_path = f's3://{bucket}/{object_name}'
-        response = self.s3_client.put_object(Body=csv_content, Bucket=bucket, Key=object_name)
+        return self._upload(self.output_format.encode(pageviews), dt)
+
+
+    @repeat_if_exception(message='Something went wrong when writing data to S3', nb_times=3)
+    def write_bytes(self, content: bytes, dt: datetime, extension: str = None) -> str:
+        """ Write an encoded file to S3, in parts when it's larger than PART_SIZE
+
+        :param content: the encoded file
+        :param dt: datetime of the request
+        :param extension: extension of the object, the one of the format of the writer when None
+        :return: S3 path of the newly uploaded object
+        """
+
+        view = memoryview(content)
+
+        return self._upload((view[start:start + self.PART_SIZE] for start in range(0, len(content), self.PART_SIZE)),
+                            dt, extension)
+
 
-        if response.get('ResponseMetadata').get('HTTPStatusCode', None) != 200:
-            raise Exception(f'Object upload to {object_path} failed')
+    def _upload(self, chunks: Iterable[bytes], dt: datetime, extension: str = None) -> str:
+        """ Uploads the chunks of a file as a single object or with a multipart upload once they reach PART_SIZE
+
+        :param chunks: the file
+        :param dt: datetime of the request
+        :param extension: extension of the object, the one of the format of the writer when None
+        :return: S3 path of the newly uploaded object
+        """
+
+        bucket, object_name = self._get_bucket_and_object(dt, extension)
+        object_path = f's3://{bucket}/{object_name}'
+        upload = _MultipartUpload(self.s3_client, bucket, object_name)
+        buffer = bytearray()
+
+        try:
+            for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= self.PART_SIZE:
+                    upload.upload_part(buffer)
+                    del buffer[:]
+
+            if upload.parts:
+                upload.upload_part(buffer)
+                upload.complete()
+            else:
+                response = self.s3_client.put_object(Body=bytes(buffer), Bucket=bucket, Key=object_name)
+                if response.get('ResponseMetadata').get('HTTPStatusCode', None) != 200:
+                    raise Exception(f'Object upload to {object_path} failed')
+        except Exception:
+            upload.abort()
+            raise
 
         return object_path
 
 
-    def _get_bucket_and_object(self, dt: datetime) -> Tuple[str, str]:
+    def get_path(self, dt: datetime) -> str:
+        """ S3 path of the object of dt
+
+        :param dt: datetime of the request
+        :return: S3 path of the object
+        """
+
+        bucket, object_name = self._get_bucket_and_object(dt)
+
+        return f's3://{bucket}/{object_name}'
+
+
+    def get_existing_paths(self, file_paths: Iterable[str]) -> Set[str]:
+        """ Lists the objects under the longest prefix shared by file_paths (one request per 1000 objects) instead
+        of sending a request per object
+
+        :param file_paths: S3 paths returned by get_path
+        :return: the paths that exist
+        """
+
+        file_paths = set(file_paths)
+        if not file_paths:
+            return set()
+
+        bucket = parse.urlparse(self.s3_dir_path).netloc
+        object_names = {parse.urlparse(file_path).path[1:]: file_path for file_path in file_paths}
+        prefix = path.commonprefix(list(object_names))
+
+        existing_paths = set()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for s3_object in page.get('Contents', []):
+                if s3_object['Key'] in object_names:
+                    existing_paths.add(object_names[s3_object['Key']])
+
+        return existing_paths
+
+
+    def _get_bucket_and_object(self, dt: datetime, extension: str = None) -> Tuple[str, str]:
         """ Computes the bucket name and object path
 
         :param dt: datetime of the request
+        :param extension: extension of the object, the one of the format of the writer when None
         :return: bucket, object path in the bucket
         """
 
         parsed_url = parse.urlparse(self.s3_dir_path)
         bucket, dir_path = parsed_url.netloc, parsed_url.path[1:]
-        dt_str = dt.strftime(S3Writer.FILE_PATTERN)
+        dt_str = dt.strftime(self.file_pattern)
+
+        return bucket, f'{dir_path}/{dt_str}.{extension or self.output_format.extension}'
+
+
+class MultiWriter(Writer):
+    """
+    Writes every result to several destinations: the pageviews are encoded once and the bytes are written by all the
+    writers concurrently. The result path is the JSON list of the paths of the writers, so it can be split back
+    whatever the characters of the paths. The time taken by each destination is reported after every write
+    """
+
+
+    def __init__(self, writers: List[Writer], output_format: 'OutputFormat') -> None:
+        """ instantiates a new MultiWriter
+
+        :param writers: writers of the destinations, all using output_format
+        :param output_format: format of the files
+        """
+
+        self.writers = writers
+        self.output_format = output_format
+
+
+    def write_pageviews(self, pageviews: Iterable['Pageview'], dt: datetime) -> str:
+        """ Encodes the pageviews once and writes them with every writer
+
+        :param pageviews: collection of pageviews
+        :param dt: datetime of the request
+        :return: paths where the pageviews were written
+        """
+
+        return self.write_bytes(b''.join(self.output_format.encode(pageviews)), dt)
+
+
+    def write_bytes(self, content: bytes, dt: datetime, extension: str = None) -> str:
+        """ Writes an encoded file with every writer concurrently. It fails if any of the writers fails. The threads
+        only live for the write, so a MultiWriter never has to be closed
+
+        :param content: the encoded file
+        :param dt: datetime of the request
+        :param extension: extension of the files, the one of the format of the writers when None
+        :return: paths where the file was written
+        """
+
+        with ThreadPoolExecutor(max_workers=len(self.writers)) as executor:
+            futures = [executor.submit(self._timed_write, writer, content, dt, extension) for writer in self.writers]
+            file_paths = []
+            for future in futures:
+                file_path, duration = future.result()
+                file_paths.append(file_path)
+                click.echo(f'{dt} written to {file_path} in {duration * 1000:.0f} ms')
+
+        return json.dumps(file_paths)
+
+
+    def get_path(self, dt: datetime) -> str:
+        """ Paths of the files of dt in every destination
+
+        :param dt: datetime of the request
+        :return: JSON list of the paths
+        """
+
+        return json.dumps([writer.get_path(dt) for writer in self.writers])
+
+
+    def get_existing_paths(self, file_paths: Iterable[str]) -> Set[str]:
+        """ A result exists only if it exists in every destination. Each writer checks its paths in bulk
+
+        :param file_paths: paths returned by get_path
+        :return: the paths that exist
+        """
+
+        # a path written by another output (e.g. a single destination) doesn't exist for this writer
+        file_paths = [file_path for file_path in file_paths if len(self._split_path(file_path)) == len(self.writers)]
+        paths_per_writer = list(zip(*(self._split_path(file_path) for file_path in file_paths))) or \
+                           [() for _ in self.writers]
+        existing_paths_per_writer = [writer.get_existing_paths(paths)
+                                     for writer, paths in zip(self.writers, paths_per_writer)]
+
+        return {file_path for file_path, paths in zip(file_paths, zip(*paths_per_writer))
+                if all(path in existing_paths for path, existing_paths in zip(paths, existing_paths_per_writer))}
+
+
+    @staticmethod
+    def _split_path(file_path: str) -> List[str]:
+        """ Paths of the writers in a path returned by get_path
+
+        :param file_path: JSON list of paths
+        :return: the paths, none when file_path isn't a JSON list of paths
+        """
+
+        try:
+            paths = json.loads(file_path)
+        except ValueError:
+            return []
+
+        return paths if isinstance(paths, list) and all(isinstance(path, str) for path in paths) else []
+
+
+    @staticmethod
+    def _timed_write(writer: Writer, content: bytes, dt: datetime, extension: str = None) -> Tuple[str, float]:
+        """ Task of the threads: writes the file with a writer and measures how long it took
+
+        :param writer: one of the writers
+        :param content: the encoded file
+        :param dt: datetime of the request
+        :param extension: extension of the file, the one of the format of the writer when None
+        :return: (path where the file was written, duration in seconds)
+        """
+
+        start = time.perf_counter()
+        file_path = writer.write_bytes(content, dt, extension)
+
+        return file_path, time.perf_counter() - start
+
+
+class _MultipartUpload:
+    """
+    A multipart upload of S3Writer, started when its first part is uploaded
+    """
+
+
+    def __init__(self, s3_client, bucket: str, object_name: str) -> None:
+        """ Instantiates an upload, nothing is sent to S3 yet
+
+        :param s3_client: boto3 S3 client
+        :param bucket: bucket of the object
+        :param object_name: key of the object
+        """
+
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.object_name = object_name
+        self.upload_id = None
+        self.parts = []
+
+
+    def upload_part(self, data: bytearray) -> None:
+        """ Uploads the next part, starting the multipart upload if needed
+
+        :param data: content of the part
+        :return: None
+        """
+
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket,
+                                                                    Key=self.object_name)['UploadId']
+
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Body=bytes(data), Bucket=self.bucket, Key=self.object_name,
+                                              PartNumber=part_number, UploadId=self.upload_id)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+
+    def complete(self) -> None:
+        """ Completes the multipart upload: the object becomes visible
+
+        :return: None
+        """
+
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.object_name, UploadId=self.upload_id,
+                                                 MultipartUpload={'Parts': self.parts})
+
+
+    def abort(self) -> None:
+        """ Aborts the multipart upload, if it was started, so S3 doesn't keep its parts
+
+        :return: None
+        """
+
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_name, UploadId=self.upload_id)
+
+
+class AsyncWriter:
+    """
+    Background write stage: the results submitted are written by a thread with a Writer while the next hour is
+    computed. At most queue_size results wait for (or are in) a write, submit blocks beyond that so results don't pile
+    up in memory when the storage is slower than the computation.
+    The outcome of each write is returned by get_completed_writes and flush, in submission order
+    """
+
+
+    def __init__(self, writer: Writer, queue_size: int) -> None:
+        """ Starts the writing thread
+
+        :param writer: writer used to save the results
+        :param queue_size: maximum number of results submitted and not written yet
+        """
+
+        self.writer = writer
+        self._slots = threading.Semaphore(queue_size)
+        self._pending = deque()
+        # a single thread writes the results in the order they were submitted
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+
+    def __enter__(self) -> 'AsyncWriter':
+        """ AsyncWriter can be used as a context manager so the thread is always stopped
+
+        :return: the writer itself
+        """
+
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        """ Waits for the pending writes and stops the thread when leaving the with block
+
+        :return: None
+        """
+
+        self.close()
+
+
+    def close(self) -> None:
+        """ Waits for the pending writes and stops the writing thread
+
+        :return: None
+        """
+
+        self._executor.shutdown(wait=True)
+
+
+    def submit(self, pageviews: List['Pageview'], dt: datetime, metrics: 'HourMetrics' = None) -> None:
+        """ Queues the pageviews of dt for writing, blocks while queue_size results are already queued
+
+        :param pageviews: collection of pageviews
+        :param dt: datetime of the request
+        :param metrics: when given, the write is measured in it as the write stage
+        :return: None
+        """
+
+        self._slots.acquire()
+        self._pending.append((dt, self._executor.submit(self._write, pageviews, dt, metrics)))
+
+
+    def get_completed_writes(self) -> Generator[Tuple[datetime, Optional[str], Optional[Exception]], None, None]:
+        """ Outcome of the writes completed since the last call, without waiting for the others
+
+        :return: generator of (dt, path, exception) where exactly one of path and exception is None
+        """
+
+        while self._pending and self._pending[0][1].done():
+            yield self._get_outcome(*self._pending.popleft())
+
+
+    def flush(self) -> Generator[Tuple[datetime, Optional[str], Optional[Exception]], None, None]:
+        """ Waits for every pending write, a failed write is returned as its exception
+
+        :return: generator of (dt, path, exception) where exactly one of path and exception is None
+        """
+
+        while self._pending:
+            yield self._get_outcome(*self._pending.popleft())
+
+
+    def _write(self, pageviews: List['Pageview'], dt: datetime, metrics: 'HourMetrics' = None) -> str:
+        """ Task of the writing thread
+
+        :param pageviews: collection of pageviews
+        :param dt: datetime of the request
+        :param metrics: metrics of the hour, None when the stages aren't measured
+        :return: path where the pageviews were written
+        """
+
+        try:
+            if metrics is None:
+                return self.writer.write_pageviews(pageviews, dt)
+            return self.writer.write_measured(pageviews, dt, metrics)
+        finally:
+            self._slots.release()
+
+
+    @staticmethod
+    def _get_outcome(dt: datetime, future) -> Tuple[datetime, Optional[str], Optional[Exception]]:
+        """ Waits for a write
+
+        :param dt: datetime of the request
+        :param future: future of the write
+        :return: (dt, path, exception)
+        """
 
-        return bucket, f'{dir_path}/{dt_str}.csv'
+        try:
+            return dt, future.result(), None
+        except Exception as e:
+            return dt, None, e
@@ -0,0 +1,379 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from typing import Dict, Generator, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
+import heapq
+
+import click
+
+from src.model.aggregate import AggregateStore, HourlyAggregate
+from src.model.blacklist import BlacklistFilter
+from src.model.engine import Engine
+from src.model.metrics import HourMetrics, MetricsExporter
+from src.model.pageview import Pageview
+from src.model.parallel import ParallelParser
+from src.model.prefetcher import Prefetcher
+from src.model.profiler import HourProfiler
+from src.model.result_cache import ResultCache
+from src.model.wikimedia import Wikimedia
+from src.model.writer import AsyncWriter, Writer
+
+
+class ProcessingOptions(NamedTuple):
+    """
+    Options of the wikiexport command that change how a single hour is processed
+    """
+
+    stage_to_disk: bool = False
+    prefetch_depth: int = 0
+    prefetch_disk_budget: int = 2 * 1024 ** 3
+    engine: str = 'python'
+    parse_processes: int = 1
+    result_cache_size: int = 0
+    write_queue_size: int = 0
+    output_format: str = 'csv'
+    # None doesn't persist the hourly aggregates, 0 persists full counts, see HourlyAggregate
+    aggregate_size: Optional[int] = None
+    # directory where the metrics of each hour are exported, None doesn't measure the stages
+    metrics_dir: Optional[str] = None
+    # one of HourProfiler.MODES to profile each hour, None doesn't profile
+    profile: Optional[str] = None
+    # number of functions and lines printed in the summary of each profile
+    profile_top: int = 20
+
+
+# state of a worker process, set once by _init_worker when the process pool starts it
+_worker_state = {}
+
+
+def process_datetime_hour(datetime_hour: datetime, blacklist_keys: Set[Tuple[bytes, bytes]], writer: 'Writer',
+                          options: ProcessingOptions = ProcessingOptions(), prefetcher: 'Prefetcher' = None,
+                          parser: 'ParallelParser' = None) -> str:
+    """ Downloads the pageviews of datetime_hour, filters out the blacklisted ones, computes the top 25 for each
+    domain, sorts them and writes them with writer
+
+    :param datetime_hour: datetime of the request
+    :param blacklist_keys: blacklisted (domain, page_title) encoded in UTF-8
+    :param writer: writer used to save the result
+    :param options: options of the processing
+    :param prefetcher: when given, the dump file is taken from the prefetcher instead of being downloaded here
+    :param parser: when given, the dump is parsed by its processes instead of the current one
+    :return: path where the result was written
+    """
+
+    metrics = HourMetrics(datetime_hour) if options.metrics_dir else None
+    with _profile_hour(datetime_hour, writer, options):
+        top_pageviews_per_domain = compute_datetime_hour(datetime_hour, blacklist_keys, options, prefetcher, parser,
+                                                         metrics)
+
+        click.echo(click.style(f'Writing pageviews for {datetime_hour} ...', fg='green'))
+
+        if metrics is None:
+            return writer.write_pageviews(top_pageviews_per_domain, datetime_hour)
+
+        result_path = writer.write_measured(top_pageviews_per_domain, datetime_hour, metrics)
+    MetricsExporter(options.metrics_dir).export(metrics)
+
+    return result_path
+
+
+def compute_datetime_hour(datetime_hour: datetime, blacklist_keys: Set[Tuple[bytes, bytes]],
+                          options: ProcessingOptions = ProcessingOptions(), prefetcher: 'Prefetcher' = None,
+                          parser: 'ParallelParser' = None, metrics: HourMetrics = None) -> List['Pageview']:
+    """ Downloads the pageviews of datetime_hour, filters out the blacklisted ones, computes the top 25 for each
+    domain and sorts them, without writing them
+
+    :param datetime_hour: datetime of the request
+    :param blacklist_keys: blacklisted (domain, page_title) encoded in UTF-8
+    :param options: options of the processing
+    :param prefetcher: when given, the dump file is taken from the prefetcher instead of being downloaded here
+    :param parser: when given, the dump is parsed by its processes instead of the current one
+    :param metrics: when given, the stages are measured in it
+    :return: sorted top 25 pageviews per domain
+    """
+
+    if isinstance(blacklist_keys, BlacklistFilter):
+        blacklist_keys.reset_counters()
+
+    if prefetcher is None:
+        click.echo(click.style(f'Downloading data for {datetime_hour} ...', fg='green'))
+        top_pageviews_per_domain = _compute_top_pageviews(datetime_hour, blacklist_keys, options, parser,
+                                                          metrics=metrics)
+    else:
+        click.echo(click.style(f'Waiting for the prefetched data of {datetime_hour} ...', fg='green'))
+        try:
+            if metrics is None:
+                file_path = prefetcher.get_file_path(datetime_hour)
+            else:
+                with metrics.stage('prefetch_wait'):
+                    file_path = prefetcher.get_file_path(datetime_hour)
+            top_pageviews_per_domain = _compute_top_pageviews(datetime_hour, blacklist_keys, options, parser,
+                                                              file_path, metrics)
+        finally:
+            prefetcher.release(datetime_hour)
+
+    if isinstance(blacklist_keys, BlacklistFilter):
+        counters = blacklist_keys.get_counters()
+        click.echo(f'Blacklist lookups for {datetime_hour}: {counters["lookups"]}, '
+                   f'prefilter hits: {counters["prefilter_hits"]}, false positives: {counters["false_positives"]}')
+
+    if options.result_cache_size:
+        try:
+            ResultCache(options.result_cache_size).set_pageviews(datetime_hour, top_pageviews_per_domain)
+        except OSError as e:
+            click.echo(click.style(f'Result of {datetime_hour} could not be cached: {e}', fg='yellow'))
+
+    return top_pageviews_per_domain
+
+
+def _compute_top_pageviews(datetime_hour: datetime, blacklist_keys: Set[Tuple[bytes, bytes]],
+                           options: ProcessingOptions, parser: 'ParallelParser' = None,
+                           file_path: str = None, metrics: HourMetrics = None) -> List['Pageview']:
+    """ Reads the dump of datetime_hour, filters out the blacklisted pageviews, computes the top 25 for each domain
+    and sorts them. When options.aggregate_size isn't None, the top options.aggregate_size rows of each domain (at
+    least 25, so the result of the hour is always the top 25) are computed instead and persisted in the
+    AggregateStore before being cut down to the top 25
+
+    :param datetime_hour: datetime of the request
+    :param blacklist_keys: blacklisted (domain, page_title) encoded in UTF-8
+    :param options: options of the processing
+    :param parser: when given, the dump is parsed by its processes instead of the current one
+    :param file_path: already downloaded dump file, the dump is downloaded when None
+    :param metrics: when given, the stages are measured in it
+    :return: sorted top 25 pageviews per domain
+    """
+
+    click.echo(click.style(f'Filtering data and computing top 25 for each domain for {datetime_hour} ...', fg='green'))
+
+    aggregate_size = options.aggregate_size
+    if aggregate_size:
+        aggregate_size = max(25, aggregate_size)
+    k = 25 if aggregate_size is None else aggregate_size or AggregateStore.FULL_SIZE
+    if metrics is None:
+        top_rows_per_domain = _compute_top_rows(datetime_hour, blacklist_keys, options, k, parser, file_path)
+    else:
+        with metrics.stage('parse_rank') as stage:
+            top_rows_per_domain = _compute_top_rows(datetime_hour, blacklist_keys, options, k, parser, file_path,
+                                                    metrics)
+            stage.rows_in = metrics.get_stage('decompress').rows_out
+            stage.rows_out = sum(len(top_rows) for top_rows in top_rows_per_domain.values())
+
+    if aggregate_size is not None:
+        AggregateStore().set_aggregate(datetime_hour,
+                                       HourlyAggregate.from_top_rows(top_rows_per_domain, aggregate_size))
+        # rows are (view_count, -line_number, page_title): the largest ones win, the earliest line on ties
+        top_rows_per_domain = {domain: heapq.nlargest(25, top_rows, key=lambda row: (row[0], row[1]))
+                               for domain, top_rows in top_rows_per_domain.items()}
+
+    top_pageviews_per_domain = Wikimedia.rows_to_pageviews(top_rows_per_domain)
+    if metrics is None:
+        Wikimedia.sort_pageviews_per_domain_and_views(top_pageviews_per_domain)
+    else:
+        with metrics.stage('sort') as stage:
+            Wikimedia.sort_pageviews_per_domain_and_views(top_pageviews_per_domain)
+            stage.rows_in = stage.rows_out = len(top_pageviews_per_domain)
+
+    return top_pageviews_per_domain
+
+
+def _compute_top_rows(datetime_hour: datetime, blacklist_keys: Set[Tuple[bytes, bytes]], options: ProcessingOptions,
+                      k: int, parser: 'ParallelParser' = None, file_path: str = None,
+                      metrics: HourMetrics = None) -> Dict[bytes, List[Tuple[int, int, bytes]]]:
+    """ Reads the dump of datetime_hour and computes the top K rows of each domain, the blacklisted ones filtered out
+
+    :param datetime_hour: datetime of the request
+    :param blacklist_keys: blacklisted (domain, page_title) encoded in UTF-8
+    :param options: options of the processing
+    :param k: number of rows kept per domain
+    :param parser: when given, the dump is parsed by its processes instead of the current one
+    :param file_path: already downloaded dump file, the dump is downloaded when None
+    :param metrics: when given, the download and the decompression are measured in it, and the rows found in the
+    blacklist are counted in it
+    :return: dict(domain -> list of (view_count, -line_number, page_title))
+    """
+
+    counters = None if metrics is None else {'blacklisted_rows': 0}
+    if parser is None:
+        if file_path is None:
+            lines = Wikimedia.get_pageview_lines(datetime_hour, stage_to_disk=options.stage_to_disk, metrics=metrics)
+        else:
+            lines = Wikimedia.read_pageview_lines(file_path, metrics)
+        top_rows_per_domain = Engine.instantiate_engine(options.engine).get_top_rows_per_domain(
+            lines, blacklist_keys, k, counters=counters)
+    else:
+        if file_path is None:
+            blocks = Wikimedia.get_pageview_blocks(datetime_hour, stage_to_disk=options.stage_to_disk, metrics=metrics)
+        else:
+            blocks = Wikimedia.read_pageview_blocks(file_path, metrics=metrics)
+        top_rows_per_domain = parser.get_top_rows_per_domain(blocks, k, counters)
+
+    if metrics is not None:
+        metrics.blacklisted_rows = counters['blacklisted_rows']
+
+    return top_rows_per_domain
+
+
+def process_datetime_hours(datetime_hours: List[datetime], blacklist_keys: Set[Tuple[bytes, bytes]],
+                           output: Union[str, Sequence[str]], aws_access_key_id: str = None,
+                           aws_secret_access_key: str = None, workers: int = 1,
+                           options: ProcessingOptions = ProcessingOptions()
+                           ) -> Generator[Tuple[datetime, Optional[str], Optional[Exception]], None, None]:
+    """ Processes every hour of datetime_hours either in the current process (workers == 1) or spread across a pool
+    of worker processes. In the current process, options.prefetch_depth upcoming hours are downloaded while the
+    current one is computed, a single hour can be parsed by options.parse_processes processes and results are written
+    by an AsyncWriter (when options.write_queue_size isn't 0) while the next hour is computed. A failing hour doesn't
+    abort the others: its exception is yielded instead of its result path.
+    Results are yielded in completion order, once written, so the caller (the only one touching the cache) can
+    record them as they come
+
+    :param datetime_hours: hours to process
+    :param blacklist_keys: blacklisted (domain, page_title) encoded in UTF-8, loaded once and shared with the workers
+    :param output: output path(s) given to Writer.instantiate_writer
+    :param aws_access_key_id: AWS credentials: ACCESS KEY ID
+    :param aws_secret_access_key: AWS credentials: SECRET ACCESS KEY
+    :param workers: number of processes to use
+    :param options: options of the processing
+    :return: generator of (datetime_hour, result_path, exception) where exactly one of result_path and exception is None
+    """
+
+    if workers == 1:
+        writer = Writer.instantiate_writer(output, aws_access_key_id, aws_secret_access_key,
+                                       options.output_format)
+        with ExitStack() as stack:
+            prefetcher, parser = None, None
+            if options.prefetch_depth:
+                prefetcher = stack.enter_context(Prefetcher(datetime_hours, options.prefetch_depth,
+                                                            options.prefetch_disk_budget))
+            if options.parse_processes > 1:
+                parser = stack.enter_context(ParallelParser(options.parse_processes, blacklist_keys, options.engine))
+
+            if not options.write_queue_size:
+                for datetime_hour in datetime_hours:
+                    yield _process_safely(datetime_hour, blacklist_keys, writer, options, prefetcher, parser)
+                return
+
+            async_writer = stack.enter_context(AsyncWriter(writer, options.write_queue_size))
+            # metrics of the hours being written, exported once their write succeeded
+            pending_metrics = {}
+            for datetime_hour in datetime_hours:
+                metrics = HourMetrics(datetime_hour) if options.metrics_dir else None
+                try:
+                    # the write runs in the thread of the AsyncWriter, only the computation is profiled
+                    with _profile_hour(datetime_hour, writer, options):
+                        top_pageviews_per_domain = compute_datetime_hour(datetime_hour, blacklist_keys, options,
+                                                                         prefetcher, parser, metrics)
+                except Exception as e:
+                    yield datetime_hour, None, e
+                else:
+                    click.echo(click.style(f'Writing pageviews for {datetime_hour} in the background ...',
+                                           fg='green'))
+                    pending_metrics[datetime_hour] = metrics
+                    async_writer.submit(top_pageviews_per_domain, datetime_hour, metrics)
+                yield from _export_metrics(async_writer.get_completed_writes(), pending_metrics, options)
+            yield from _export_metrics(async_writer.flush(), pending_metrics, options)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(blacklist_keys, output, aws_access_key_id,
+                                       aws_secret_access_key, options)) as executor:
+        futures = {executor.submit(_process_in_worker, datetime_hour): datetime_hour
+                   for datetime_hour in datetime_hours}
+        for future in as_completed(futures):
+            datetime_hour = futures[future]
+            try:
+                yield future.result()
+            except Exception as e:
+                # the worker itself died (or the result couldn't be sent back), the hour is reported as failed
+                yield datetime_hour, None, e
+
+
+@contextmanager
+def _profile_hour(datetime_hour: datetime, writer: 'Writer', options: ProcessingOptions) -> Generator[None, None, None]:
+    """ Profiles the with block when options.profile is set, then prints the summary of the profile and saves it next
+    to the result of the hour, even when the hour failed
+
+    :param datetime_hour: datetime of the request
+    :param writer: writer of the results, the profile is saved with it
+    :param options: options of the processing
+    :return: None
+    """
+
+    if options.profile is None:
+        yield
+        return
+
+    profiler = HourProfiler(datetime_hour, options.profile)
+    try:
+        with profiler:
+            yield
+    finally:
+        profiler.save_and_echo(writer, options.profile_top)
+
+
+def _export_metrics(results: Iterable[Tuple[datetime, Optional[str], Optional[Exception]]],
+                    pending_metrics: Dict[datetime, Optional[HourMetrics]], options: ProcessingOptions
+                    ) -> Generator[Tuple[datetime, Optional[str], Optional[Exception]], None, None]:
+    """ Exports the metrics of the hours whose write succeeded as their results go by
+
+    :param results: (datetime_hour, result_path, exception) of the written hours
+    :param pending_metrics: metrics of the hours being written, None when the stages aren't measured
+    :param options: options of the processing
+    :return: generator of the results
+    """
+
+    for datetime_hour, result_path, exception in results:
+        metrics = pending_metrics.pop(datetime_hour, None)
+        if metrics is not None and exception is None:
+            MetricsExporter(options.metrics_dir).export(metrics)
+        yield datetime_hour, result_path, exception
+
+
+def _process_safely(datetime_hour: datetime, blacklist_keys: Set[Tuple[bytes, bytes]], writer: 'Writer',
+                    options: ProcessingOptions, prefetcher: 'Prefetcher' = None,
+                    parser: 'ParallelParser' = None) -> Tuple[datetime, Optional[str], Optional[Exception]]:
+    """ Calls process_datetime_hour and turns any exception into a result so the other hours are still processed
+
+    :param datetime_hour: datetime of the request
+    :param blacklist_keys: blacklisted (domain, page_title) encoded in UTF-8
+    :param writer: writer used to save the result
+    :param options: options of the processing
+    :param prefetcher: prefetcher the dump file is taken from, if any
+    :param parser: parser the dump is parsed with, if any
+    :return: (datetime_hour, result_path, exception)
+    """
+
+    try:
+        result_path = process_datetime_hour(datetime_hour, blacklist_keys, writer, options, prefetcher, parser)
+        return datetime_hour, result_path, None
+    except Exception as e:
+        return datetime_hour, None, e
+
+
+def _init_worker(blacklist_keys: Set[Tuple[bytes, bytes]], output: Union[str, Sequence[str]],
+                 aws_access_key_id: str, aws_secret_access_key: str, options: ProcessingOptions) -> None:
+    """ Initializer of each worker process. The blacklist is received once per process (not once per hour) and
+    the writer is built inside the process because boto3 clients can't be pickled
+
+    :param blacklist_keys: blacklisted (domain, page_title) encoded in UTF-8
+    :param output: output path(s) given to Writer.instantiate_writer
+    :param aws_access_key_id: AWS credentials: ACCESS KEY ID
+    :param aws_secret_access_key: AWS credentials: SECRET ACCESS KEY
+    :param options: options of the processing
+    :return: None
+    """
+
+    _worker_state['options'] = options
+    _worker_state['blacklist_keys'] = blacklist_keys
+    _worker_state['writer'] = Writer.instantiate_writer(output, aws_access_key_id, aws_secret_access_key,
+                                                        options.output_format)
+
+
+def _process_in_worker(datetime_hour: datetime) -> Tuple[datetime, Optional[str], Optional[Exception]]:
+    """ Task executed by a worker process for a single hour
+
+    :param datetime_hour: datetime of the request
+    :return: (datetime_hour, result_path, exception)
+    """
+
+    return _process_safely(datetime_hour, _worker_state['blacklist_keys'], _worker_state['writer'],
+                           _worker_state['options'])
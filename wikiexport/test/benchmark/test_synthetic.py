@@ -0,0 +1,58 @@
+import unittest
+import tempfile
+
+from src.benchmark.stages import StageBenchmark
+from src.benchmark.synthetic import SyntheticDump
+from src.model.wikimedia import Wikimedia
+
+
+class SyntheticDumpTest(unittest.TestCase):
+
+
+    def test_same_seed_gives_the_same_dump(self):
+
+        self.assertEqual(list(SyntheticDump(1000, 50, seed=3).get_lines()),
+                         list(SyntheticDump(1000, 50, seed=3).get_lines()))
+        self.assertNotEqual(list(SyntheticDump(1000, 50, seed=3).get_lines()),
+                            list(SyntheticDump(1000, 50, seed=4).get_lines()))
+
+
+    def test_lines_look_like_a_dump(self):
+
+        lines = list(SyntheticDump(5000, 50).get_lines())
+        rows = [line.rstrip(b'\n').split(b' ') for line in lines]
+
+        self.assertEqual(5000, len(lines))
+        self.assertTrue(all(len(row) == 4 and int(row[2]) >= 1 for row in rows))
+        self.assertEqual(len(rows), len({(domain, page_title) for domain, page_title, _, _ in rows}))
+        domains = [domain for domain, _, _, _ in rows]
+        self.assertEqual(sorted(domains), domains)
+        # the largest domain has a lot more lines than the median one
+        domain_sizes = sorted((domains.count(domain) for domain in set(domains)), reverse=True)
+        self.assertGreater(domain_sizes[0], 10 * domain_sizes[len(domain_sizes) // 2])
+
+
+    def test_blacklist_keys_change_the_top_k(self):
+
+        dump = SyntheticDump(5000, 50)
+        blacklist_keys = dump.get_blacklist_keys(20)
+        lines = list(dump.get_lines())
+
+        self.assertEqual(20, len(blacklist_keys))
+        self.assertNotEqual(Wikimedia.get_top_pageviews_per_domain_from_lines(lines),
+                            Wikimedia.get_top_pageviews_per_domain_from_lines(lines, blacklist_keys))
+
+
+class StageBenchmarkTest(unittest.TestCase):
+
+
+    def test_stages_report_their_items(self):
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = StageBenchmark(SyntheticDump(2000, 20), work_dir, repeat=1).run(
+                ['read_lines', 'python_engine', 'local_writer'])
+
+        self.assertEqual(2000, results['read_lines'].items)
+        self.assertGreater(results['read_lines'].bytes, 0)
+        self.assertEqual(2000, results['python_engine'].items)
+        self.assertGreater(results['local_writer'].bytes, 0)
@@ -0,0 +1,106 @@
+import unittest
+from datetime import datetime
+import tempfile
+
+from src.model.aggregate import AggregateStore, ErrorBound, HourlyAggregate, Rollup
+
+
+class AggregateTest(unittest.TestCase):
+
+
+    def setUp(self):
+
+        self.dir = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+
+        self.dir.cleanup()
+
+
+    def test_threshold_is_the_last_kept_view_count_when_rows_were_cut(self):
+
+        top_rows_per_domain = {b'en': [(5, -3, b'b'), (9, -1, b'a')], b'fr': [(2, -2, b'c')]}
+
+        aggregate = HourlyAggregate.from_top_rows(top_rows_per_domain, 2)
+
+        self.assertEqual({b'en': [(5, b'b'), (9, b'a')], b'fr': [(2, b'c')]}, aggregate.rows_per_domain)
+        self.assertEqual({b'en': 5}, aggregate.thresholds)
+        self.assertEqual({}, HourlyAggregate.from_top_rows(top_rows_per_domain, 0).thresholds)
+
+
+    def test_aggregates_are_read_back(self):
+
+        aggregate_store = AggregateStore(self.dir.name)
+        aggregate = HourlyAggregate(2, {b'en': [(9, b'Main_Page'), (5, b'\xc3\x87a_va')], b'fr': [(2, b'Accueil')]},
+                                    {b'en': 5})
+
+        aggregate_store.set_aggregate(datetime(2020, 1, 1, 1), aggregate)
+
+        self.assertEqual(aggregate, aggregate_store.get_aggregate(datetime(2020, 1, 1, 1)))
+        self.assertIsNone(aggregate_store.get_aggregate(datetime(2020, 1, 1, 2)))
+
+
+    def test_full_counts_rollup_is_exact(self):
+
+        rollup = Rollup()
+        rollup.add_aggregate(HourlyAggregate(0, {b'en': [(3, b'a'), (2, b'b'), (1, b'c')]}, {}))
+        rollup.add_aggregate(HourlyAggregate(0, {b'en': [(4, b'c'), (1, b'b')]}, {}))
+
+        top_rows_per_domain, error_bounds = rollup.get_top_rows_per_domain(k=2)
+
+        self.assertEqual({b'en': [(5, 0, b'c'), (3, 0, b'a')]}, top_rows_per_domain)
+        self.assertEqual({b'en': ErrorBound(0, True)}, error_bounds)
+
+
+    def test_bounded_rollup_reports_its_error(self):
+
+        rollup = Rollup()
+        # hour 1 kept a and b, c had at most 2 views. Hour 2 kept c and a, b had at most 1 view
+        rollup.add_aggregate(HourlyAggregate(2, {b'en': [(10, b'a'), (2, b'b')]}, {b'en': 2}))
+        rollup.add_aggregate(HourlyAggregate(2, {b'en': [(3, b'c'), (1, b'a')]}, {b'en': 1}))
+
+        top_rows_per_domain, error_bounds = rollup.get_top_rows_per_domain(k=1)
+
+        self.assertEqual({b'en': [(11, 0, b'a')]}, top_rows_per_domain)
+        # b and c have at most 3 and 5 views: a is the true top 1 and its count is exact
+        self.assertEqual({b'en': ErrorBound(0, True)}, error_bounds)
+
+        top_rows_per_domain, error_bounds = rollup.get_top_rows_per_domain(k=2)
+
+        self.assertEqual({b'en': [(11, 0, b'a'), (3, 0, b'c')]}, top_rows_per_domain)
+        # c may have had 2 more views in hour 1, b has at most 3 views so it can't beat c
+        self.assertEqual({b'en': ErrorBound(2, True)}, error_bounds)
+
+        top_rows_per_domain, error_bounds = rollup.get_top_rows_per_domain(k=3)
+
+        self.assertEqual({b'en': [(11, 0, b'a'), (3, 0, b'c'), (2, 0, b'b')]}, top_rows_per_domain)
+        # a page kept in neither hour may have up to 3 views, more than b
+        self.assertEqual({b'en': ErrorBound(2, False)}, error_bounds)
+        # a is exact, c may have had 2 more views in hour 1 and b 1 more view in hour 2
+        self.assertEqual(b'domain,page_title,pageview_count,max_error,top_guaranteed\n'
+                         b'en,b,2,1,false\nen,c,3,2,false\nen,a,11,0,false\n',
+                         rollup.encode_error_bounds(top_rows_per_domain, error_bounds))
+
+
+    def test_rollup_with_a_capacity_keeps_its_bounds(self):
+
+        rollup = Rollup(capacity=2)
+        rollup.add_aggregate(HourlyAggregate(0, {b'en': [(10, b'a'), (4, b'b')]}, {}))
+        rollup.add_aggregate(HourlyAggregate(0, {b'en': [(9, b'a'), (1, b'c')]}, {}))
+        rollup.add_aggregate(HourlyAggregate(0, {b'en': [(8, b'a'), (3, b'b')]}, {}))
+
+        top_rows_per_domain, error_bounds = rollup.get_top_rows_per_domain(k=1)
+
+        self.assertEqual(2, len(rollup.counts[b'en'].counters))
+        self.assertEqual({b'en': [(27, 0, b'a')]}, top_rows_per_domain)
+        # b took the counter of c (5 views) in hour 3: it had between 3 and 8 views, less than a
+        self.assertEqual({b'en': ErrorBound(0, True)}, error_bounds)
+
+        top_rows_per_domain, error_bounds = rollup.get_top_rows_per_domain(k=2)
+
+        self.assertEqual({b'en': [(27, 0, b'a'), (3, 0, b'b')]}, top_rows_per_domain)
+        self.assertEqual({b'en': ErrorBound(5, False)}, error_bounds)
+        self.assertEqual(b'domain,page_title,pageview_count,max_error,top_guaranteed\n'
+                         b'en,b,3,5,false\nen,a,27,0,false\n',
+                         rollup.encode_error_bounds(top_rows_per_domain, error_bounds))
@@ -1,20 +1,41 @@
 import unittest
 from unittest.mock import patch
+import tempfile
+import os
 
 
-from src.model.blacklist import BlackList
+from src.model.blacklist import BlackList, BlacklistFilter
 
 from requests import codes
 
-from wikiexport.src.model.pageview import Pageview
+from src.model.pageview import Pageview
 
 
 class BlacklistTest(unittest.TestCase):
 
 
+    def setUp(self):
+
+        self.dir = tempfile.TemporaryDirectory()
+        index_file_path = os.path.join(self.dir.name, 'blacklist.idx')
+        self.patches = [patch.object(BlackList, 'INDEX_FILE_PATH', index_file_path),
+                        patch.object(BlackList, 'PAGEVIEWS_BLACKLIST', set()),
+                        patch.object(BlackList, 'PAGEVIEWS_BLACKLIST_KEYS', set()),
+                        patch.object(BlackList, 'PAGEVIEWS_BLACKLIST_FILTER', None)]
+        for attribute_patch in self.patches:
+            attribute_patch.start()
+
+
+    def tearDown(self):
+
+        for attribute_patch in self.patches:
+            attribute_patch.stop()
+        self.dir.cleanup()
+
+
     def test_get_pageviews_blacklist_failed(self):
 
-        with patch('src.model.wikimedia.requests.get') as get_mock, \
+        with patch('src.model.blacklist.HttpClient.get') as get_mock, \
              patch('click.echo'), \
              self.assertRaises(Exception):
 
@@ -26,9 +47,81 @@ class BlacklistTest(unittest.TestCase):
 
         expected_pageviews = {Pageview('a', 'main_page', None), Pageview('b', 'second_page', None)}
 
-        with patch('src.model.wikimedia.requests.get') as get_mock:
+        with patch('src.model.blacklist.HttpClient.get') as get_mock:
             get_mock.return_value.status_code = codes.ok
-            get_mock.return_value.iter_lines = lambda : ('a main_page', 'b second_page')
+            get_mock.return_value.headers = {}
+            get_mock.return_value.iter_lines = lambda : (b'a main_page', b'b second_page')
 
             actual_pageviews = BlackList.get_pageviews_blacklist()
             self.assertEqual(expected_pageviews, actual_pageviews)
+
+
+    def test_get_pageviews_blacklist_keys(self):
+
+        with patch('src.model.blacklist.HttpClient.get') as get_mock:
+            get_mock.return_value.status_code = codes.ok
+            get_mock.return_value.headers = {}
+            get_mock.return_value.iter_lines = lambda : (b'a main_page', b'b pag\xc3\xa9', b'')
+
+            self.assertEqual({(b'a', b'main_page'), (b'b', b'pag\xc3\xa9')}, BlackList.get_pageviews_blacklist_keys())
+
+
+    def test_index_used_when_blacklist_not_modified(self):
+
+        expected_keys = {(b'a', b'main_page'), (b'a', b'other_page'), (b'b', b'second_page')}
+
+        with patch('src.model.blacklist.HttpClient.get') as get_mock:
+            get_mock.return_value.status_code = codes.ok
+            get_mock.return_value.headers = {'ETag': '"1234"', 'Last-Modified': 'Wed, 21 Oct 2020 07:28:00 GMT'}
+            get_mock.return_value.iter_lines = lambda : (b'a main_page', b'a other_page', b'b second_page')
+            BlackList._load_blacklist_keys()
+
+            get_mock.reset_mock()
+            get_mock.return_value.status_code = codes.not_modified
+            actual_keys = BlackList._load_blacklist_keys()
+
+            get_mock.assert_called_once_with(BlackList.BLACKLIST_URL,
+                                             {'If-None-Match': '"1234"',
+                                              'If-Modified-Since': 'Wed, 21 Oct 2020 07:28:00 GMT'})
+            self.assertEqual(expected_keys, actual_keys)
+
+
+    def test_index_refreshed_when_blacklist_modified(self):
+
+        with patch('src.model.blacklist.HttpClient.get') as get_mock:
+            get_mock.return_value.status_code = codes.ok
+            get_mock.return_value.headers = {'ETag': '"1"'}
+            get_mock.return_value.iter_lines = lambda : (b'a main_page', )
+            BlackList._load_blacklist_keys()
+
+            get_mock.return_value.headers = {'ETag': '"2"'}
+            get_mock.return_value.iter_lines = lambda : (b'b second_page', )
+            self.assertEqual({(b'b', b'second_page')}, BlackList._load_blacklist_keys())
+            self.assertEqual(('"2"', None, {(b'b', b'second_page')}), BlackList._read_index())
+
+
+    def test_stale_index_used_when_download_fails(self):
+
+        BlackList._write_index('"1"', None, {(b'a', b'main_page')})
+
+        with patch('src.model.blacklist.HttpClient.get') as get_mock, patch('click.echo'):
+            get_mock.return_value.status_code = 503
+
+            self.assertEqual({(b'a', b'main_page')}, BlackList._load_blacklist_keys())
+
+
+    def test_blacklist_filter_counts_lookups(self):
+
+        blacklist_filter = BlacklistFilter({(b'en', b'Main_Page'), (b'fr', b'Accueil')})
+
+        self.assertIn((b'en', b'Main_Page'), blacklist_filter)
+        self.assertNotIn((b'en', b'Accueil'), blacklist_filter)
+        self.assertFalse(any((b'de', f'page{i}'.encode()) in blacklist_filter for i in range(1000)))
+
+        counters = blacklist_filter.get_counters()
+        self.assertEqual(1002, counters['lookups'])
+        self.assertEqual(counters['prefilter_hits'], counters['false_positives'] + 1)
+        self.assertLess(counters['false_positives'], 50)
+
+        blacklist_filter.reset_counters()
+        self.assertEqual({'lookups': 0, 'prefilter_hits': 0, 'false_positives': 0}, blacklist_filter.get_counters())
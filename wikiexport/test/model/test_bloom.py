@@ -0,0 +1,32 @@
+import unittest
+
+from src.model.bloom import BloomFilter
+
+
+class BloomFilterTest(unittest.TestCase):
+
+
+    def test_added_keys_are_always_found(self):
+
+        keys = [f'en page{i}'.encode() for i in range(10000)]
+
+        bloom_filter = BloomFilter.from_keys(keys, len(keys))
+
+        self.assertTrue(all(key in bloom_filter for key in keys))
+
+
+    def test_false_positive_rate_is_close_to_the_expected_one(self):
+
+        keys = [f'en page{i}'.encode() for i in range(10000)]
+        bloom_filter = BloomFilter.from_keys(keys, len(keys), false_positive_rate=0.01)
+
+        false_positives = sum(f'fr page{i}'.encode() in bloom_filter for i in range(100000))
+
+        self.assertLess(false_positives, 2000)
+
+
+    def test_empty_filter(self):
+
+        bloom_filter = BloomFilter(0)
+
+        self.assertNotIn(b'en page', bloom_filter)
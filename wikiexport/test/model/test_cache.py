@@ -1,9 +1,12 @@
 from unittest import TestCase
 from unittest.mock import patch, mock_open
 from datetime import datetime
+import tempfile
+import sqlite3
+import os
 
 
-from src.model.cache import LocalCache
+from src.model.cache import LocalCache, SqliteCache
 
 
 class LocalCacheTest(TestCase):
@@ -68,3 +71,150 @@ class LocalCacheTest(TestCase):
             local_cache = LocalCache.get_instance()
 
             self.assertEqual(local_cache.get_entry(datetime(2020, 1, 3, 1)), expected_value)
+
+
+class SqliteCacheTest(TestCase):
+
+
+    def setUp(self):
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.patches = [patch.object(SqliteCache, 'CACHE_FILE_PATH', os.path.join(self.dir.name, 'cache.sqlite')),
+                        patch.object(LocalCache, 'CACHE_FILE_PATH', os.path.join(self.dir.name, 'cache.txt'))]
+        for attribute_patch in self.patches:
+            attribute_patch.start()
+        SqliteCache._remove_instance()
+
+
+    def tearDown(self):
+
+        SqliteCache._remove_instance()
+        for attribute_patch in self.patches:
+            attribute_patch.stop()
+        self.dir.cleanup()
+
+
+    def test_equal_instances(self):
+
+        self.assertEqual(SqliteCache.get_instance(), SqliteCache.get_instance())
+        with self.assertRaises(Exception):
+            SqliteCache()
+
+
+    def test_entries_are_committed_when_set(self):
+
+        SqliteCache.get_instance().set_entry(datetime(2020, 1, 1, 1), 'tmp/pageviews-20200101T01:00:00.csv')
+
+        # another process opening the database sees the entry without any save
+        connection = sqlite3.connect(SqliteCache.CACHE_FILE_PATH)
+        self.assertEqual([('20200101T01:00:00', 'tmp/pageviews-20200101T01:00:00.csv')],
+                         connection.execute('SELECT datetime_hour, file_path FROM entries').fetchall())
+        connection.close()
+
+        SqliteCache._remove_instance()
+        cache = SqliteCache.get_instance()
+        self.assertIn(datetime(2020, 1, 1, 1), cache)
+        self.assertEqual('tmp/pageviews-20200101T01:00:00.csv', cache.get_entry(datetime(2020, 1, 1, 1)))
+        self.assertIsNone(cache.get_entry(datetime(2020, 1, 1, 2)))
+
+
+    def test_entries_are_read_and_removed_in_bulk(self):
+
+        cache = SqliteCache.get_instance()
+        dts = [datetime(2020, 1, 1, hour) for hour in range(24)] * 50
+        for dt in dts[:24:2]:
+            cache.set_entry(dt, f'{dt.hour}.csv')
+
+        with patch.object(SqliteCache, 'QUERY_BATCH_SIZE', 5):
+            entries = cache.get_entries(dts)
+
+        self.assertEqual({dt: f'{dt.hour}.csv' for dt in dts[:24:2]}, entries)
+
+        cache.remove_entries(dts[:4])
+        self.assertEqual(10, len(cache.get_entries(dts)))
+        self.assertNotIn(dts[0], cache)
+
+
+    def test_concurrent_instances_keep_each_other_entries(self):
+
+        cache = SqliteCache.get_instance()
+        other_cache = object.__new__(SqliteCache)
+        other_cache.connection = other_cache._open_database()
+
+        cache.set_entry(datetime(2020, 1, 1, 1), 'first.csv')
+        other_cache.set_entry(datetime(2020, 1, 1, 2), 'second.csv')
+        cache.set_entry(datetime(2020, 1, 1, 1), 'first-again.csv')
+
+        self.assertEqual('second.csv', cache.get_entry(datetime(2020, 1, 1, 2)))
+        self.assertEqual('first-again.csv', other_cache.get_entry(datetime(2020, 1, 1, 1)))
+        other_cache.connection.close()
+
+
+    def test_claimed_hours_cannot_be_claimed_by_another_run(self):
+
+        cache = SqliteCache.get_instance()
+        other_cache = object.__new__(SqliteCache)
+        other_cache.connection, other_cache.owner = other_cache._open_database(), 'other run'
+        dt = datetime(2020, 1, 1, 1)
+
+        self.assertTrue(cache.claim_entry(dt, ttl=60))
+        self.assertTrue(cache.claim_entry(dt, ttl=60))
+        self.assertFalse(other_cache.claim_entry(dt, ttl=60))
+
+        cache.release_claims([dt])
+        self.assertTrue(other_cache.claim_entry(dt, ttl=60))
+        other_cache.set_entry(dt, 'result.csv')
+        self.assertFalse(cache.claim_entry(dt, ttl=60))
+        self.assertFalse(cache.claim_entry(dt, ttl=60, file_path='result.csv'))
+        # the hour was written to another output
+        self.assertTrue(cache.claim_entry(dt, ttl=60, file_path='s3://bucket/result.csv'))
+        other_cache.connection.close()
+
+
+    def test_expired_leases_can_be_taken_over(self):
+
+        cache = SqliteCache.get_instance()
+        other_cache = object.__new__(SqliteCache)
+        other_cache.connection, other_cache.owner = other_cache._open_database(), 'other run'
+        dt = datetime(2020, 1, 1, 1)
+
+        with patch('src.model.cache.time.time', return_value=1000.0):
+            self.assertTrue(other_cache.claim_entry(dt, ttl=60))
+        with patch('src.model.cache.time.time', return_value=1050.0):
+            self.assertFalse(cache.claim_entry(dt, ttl=60))
+            other_cache.renew_claims([dt], ttl=60)
+        with patch('src.model.cache.time.time', return_value=1100.0):
+            self.assertFalse(cache.claim_entry(dt, ttl=60))
+        with patch('src.model.cache.time.time', return_value=1111.0):
+            self.assertTrue(cache.claim_entry(dt, ttl=60))
+        other_cache.connection.close()
+
+
+    def test_local_cache_file_is_imported_once(self):
+
+        with open(LocalCache.CACHE_FILE_PATH, 'w') as file_handle:
+            file_handle.write('20200101T01:00:00,s3://bucket/pageviews-20200101T01:00:00.csv\n')
+
+        cache = SqliteCache.get_instance()
+
+        self.assertEqual('s3://bucket/pageviews-20200101T01:00:00.csv', cache.get_entry(datetime(2020, 1, 1, 1)))
+
+
+    def test_connection_of_a_failed_attempt_is_closed(self):
+
+        connections = []
+        sqlite_connect = sqlite3.connect
+
+        def connect(*args, **kwargs):
+            connections.append(sqlite_connect(*args, **kwargs))
+            return connections[-1]
+
+        with patch('src.model.cache.sqlite3.connect', side_effect=connect), \
+             patch.object(SqliteCache, '_read_local_cache_entries', side_effect=[OSError('unreadable'), []]), \
+             patch('click.echo'):
+            cache = SqliteCache.get_instance()
+
+        self.assertEqual(2, len(connections))
+        with self.assertRaises(sqlite3.ProgrammingError):
+            connections[0].execute('SELECT 1')
+        self.assertIs(connections[1], cache.connection)
@@ -0,0 +1,79 @@
+import unittest
+import random
+
+from src.model.engine import Engine, NumpyEngine, numpy
+from src.model.wikimedia import Wikimedia
+
+
+class EngineTest(unittest.TestCase):
+
+
+    def setUp(self):
+
+        random_generator = random.Random(7)
+        domains = ['a', 'ab', 'ab.c', 'en.m', 'fr']
+        self.lines = [f'{random_generator.choice(domains)} page{random_generator.randrange(300)} '
+                      f'{random_generator.randrange(1, 40)} 0'.encode() for _ in range(3000)]
+        self.blacklist_keys = {tuple(line.split(b' ')[:2]) for line in self.lines[::17]}
+
+
+    def test_instantiate_unknown_engine(self):
+
+        with self.assertRaises(ValueError):
+            Engine.instantiate_engine('spark')
+
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_engine_matches_python_engine(self):
+
+        for k in (1, 3, 25):
+            python_pageviews = Engine.instantiate_engine('python').get_top_pageviews_per_domain(self.lines,
+                                                                                                self.blacklist_keys, k)
+            numpy_pageviews = Engine.instantiate_engine('numpy').get_top_pageviews_per_domain(self.lines,
+                                                                                              self.blacklist_keys, k)
+            Wikimedia.sort_pageviews_per_domain_and_views(python_pageviews)
+            Wikimedia.sort_pageviews_per_domain_and_views(numpy_pageviews)
+
+            self.assertEqual([(pageview.domain, pageview.page_title, pageview.view_count)
+                              for pageview in python_pageviews],
+                             [(pageview.domain, pageview.page_title, pageview.view_count)
+                              for pageview in numpy_pageviews])
+
+
+    def test_blacklisted_rows_are_counted(self):
+
+        # page100 is looked up, page1 is rejected by the admission threshold before the lookup
+        lines = [f'en page{i} {i} 0'.encode() for i in range(100, 0, -1)]
+        blacklist_keys = {(b'en', b'page100'), (b'en', b'page1')}
+
+        for engine_name in Engine.ENGINE_NAMES:
+            if engine_name == 'numpy' and numpy is None:
+                continue
+            counters = {}
+            top_rows_per_domain = Engine.instantiate_engine(engine_name).get_top_rows_per_domain(
+                lines, blacklist_keys, k=3, counters=counters)
+
+            self.assertEqual([b'page99', b'page98', b'page97'],
+                             [page_title for _, _, page_title in sorted(top_rows_per_domain[b'en'], reverse=True)])
+            self.assertEqual({'blacklisted_rows': 1}, counters)
+
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_engine_accepts_lines_with_new_lines(self):
+
+        lines = [b'a page1 12 0\n', b'a page2 10 0\n', b'b page1 1 0\n']
+
+        actual_rows = NumpyEngine().get_top_rows_per_domain(lines, set(), k=1, first_line_number=10)
+
+        self.assertEqual({b'a': [(12, -10, b'page1')], b'b': [(1, -12, b'page1')]}, actual_rows)
+        self.assertEqual({}, NumpyEngine().get_top_rows_per_domain([], set()))
+
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_engine_malformed_line(self):
+
+        with self.assertRaises(ValueError):
+            NumpyEngine().get_top_rows_per_domain([b'a page1 12 0', b'a page2 0'], set())
+
+        with self.assertRaises(ValueError):
+            NumpyEngine().get_top_rows_per_domain([b'a page1 1x 0'], set())
@@ -0,0 +1,56 @@
+import unittest
+from collections import Counter
+import random
+
+from src.model.heavy_hitters import SpaceSaving
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+
+    def test_counts_are_exact_without_capacity(self):
+
+        space_saving = SpaceSaving()
+        for key, weight in [('a', 3), ('b', 1), ('a', 2)]:
+            space_saving.add(key, weight)
+
+        self.assertEqual({'a': [5, 0, 0], 'b': [1, 0, 0]}, space_saving.counters)
+        self.assertEqual(0, space_saving.min_count)
+
+
+    def test_bounds_hold_with_a_capacity(self):
+
+        rng = random.Random(0)
+        # a skewed stream: a few heavy keys and a long tail
+        stream = [(f'key{int(rng.paretovariate(1.2))}', rng.randint(1, 10)) for _ in range(20000)]
+        true_counts = Counter()
+        space_saving = SpaceSaving(capacity=50)
+        for key, weight in stream:
+            space_saving.add(key, weight)
+            true_counts[key] += weight
+
+        self.assertEqual(50, len(space_saving.counters))
+        total = sum(true_counts.values())
+        for key, (count, error, _) in space_saving.counters.items():
+            self.assertLessEqual(count - error, true_counts[key])
+            self.assertLessEqual(true_counts[key], count)
+        for key, true_count in true_counts.items():
+            if key not in space_saving.counters:
+                self.assertLessEqual(true_count, space_saving.min_count)
+            # any key with more than total / capacity is monitored
+            if true_count > total / 50:
+                self.assertIn(key, space_saving.counters)
+
+
+    def test_new_key_takes_the_smallest_counter(self):
+
+        space_saving = SpaceSaving(capacity=2)
+        space_saving.add('a', 5)
+        space_saving.add('b', 2)
+        space_saving.add('b', 1)
+
+        counter = space_saving.add('c', 4)
+
+        self.assertEqual([7, 3, 0], counter)
+        self.assertEqual({'a', 'c'}, set(space_saving.counters))
+        self.assertEqual(5, space_saving.min_count)
@@ -0,0 +1,254 @@
+import unittest
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import os
+import random
+import tempfile
+import threading
+
+import requests
+
+from src.model.http_client import HttpClient
+from src.model.wikimedia import Wikimedia
+
+
+class _DumpHandler(BaseHTTPRequestHandler):
+    """
+    Serves CONTENT with Range support. Each request pops the first of STATUSES (error statuses returned before
+    serving the file) then of CUTS (number of bytes of the body sent before the connection is closed)
+    """
+
+    protocol_version = 'HTTP/1.1'
+    CONTENT = b''
+    STATUSES = []
+    CUTS = []
+    IGNORE_RANGE = False
+    # ETags of the successive responses, the last one is kept
+    ETAGS = ['"dump"']
+    # (Range header, client port) of each request
+    REQUESTS = []
+    # If-Range header of each request
+    IF_RANGES = []
+
+
+    def do_GET(self):
+
+        self.REQUESTS.append((self.headers.get('Range'), self.client_address[1]))
+        self.IF_RANGES.append(self.headers.get('If-Range'))
+        if self.STATUSES:
+            self.send_response(self.STATUSES.pop(0))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        etag = self.ETAGS.pop(0) if len(self.ETAGS) > 1 else self.ETAGS[0]
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header is not None and not self.IGNORE_RANGE and if_range in (None, etag):
+            start = int(range_header[len('bytes='):-len('-')])
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(self.CONTENT) - 1}/{len(self.CONTENT)}')
+        else:
+            self.send_response(200)
+        body = self.CONTENT[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        if self.CUTS:
+            self.wfile.write(body[:self.CUTS.pop(0)])
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+
+    def log_message(self, *args):
+
+        pass
+
+
+class HttpClientTest(unittest.TestCase):
+
+
+    def setUp(self):
+
+        _DumpHandler.CONTENT = random.Random(0).getrandbits(8 * 50000).to_bytes(50000, 'little')
+        _DumpHandler.STATUSES, _DumpHandler.CUTS, _DumpHandler.REQUESTS, _DumpHandler.IF_RANGES = [], [], [], []
+        _DumpHandler.IGNORE_RANGE = False
+        _DumpHandler.ETAGS = ['"dump"']
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _DumpHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/pageviews-20200101-010000.gz'
+        self.dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.dir.name, 'pageviews-20200101-010000.gz')
+        self.patches = [patch.object(HttpClient, 'BACKOFF_FACTOR', 0), patch('click.echo')]
+        for attribute_patch in self.patches:
+            attribute_patch.start()
+        HttpClient.close_session()
+
+
+    def tearDown(self):
+
+        HttpClient.close_session()
+        for attribute_patch in self.patches:
+            attribute_patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+
+    def _read_file(self):
+
+        with open(self.file_path, 'rb') as file_handle:
+            return file_handle.read()
+
+
+    def test_download_resumes_where_it_was_cut(self):
+
+        _DumpHandler.CUTS = [10000, 5000]
+
+        self.assertEqual(self.file_path, HttpClient.download(self.url, self.file_path, chunk_size=1000))
+
+        self.assertEqual(_DumpHandler.CONTENT, self._read_file())
+        self.assertEqual([None, 'bytes=10000-', 'bytes=15000-'], [range_header for range_header, _ in
+                                                                   _DumpHandler.REQUESTS])
+        self.assertFalse(os.path.exists(self.file_path + HttpClient.PARTIAL_SUFFIX))
+        self.assertFalse(os.path.exists(self.file_path + HttpClient.PARTIAL_SUFFIX + HttpClient.ETAG_SUFFIX))
+
+
+    def _write_partial_file(self, content, etag=None):
+
+        with open(self.file_path + HttpClient.PARTIAL_SUFFIX, 'wb') as file_handle:
+            file_handle.write(content)
+        if etag is not None:
+            with open(self.file_path + HttpClient.PARTIAL_SUFFIX + HttpClient.ETAG_SUFFIX, 'w') as file_handle:
+                file_handle.write(etag)
+
+
+    def test_download_resumes_a_partial_file(self):
+
+        self._write_partial_file(_DumpHandler.CONTENT[:20000], '"dump"')
+
+        HttpClient.download(self.url, self.file_path)
+
+        self.assertEqual(_DumpHandler.CONTENT, self._read_file())
+        self.assertEqual(['bytes=20000-'], [range_header for range_header, _ in _DumpHandler.REQUESTS])
+        self.assertEqual(['"dump"'], _DumpHandler.IF_RANGES)
+        self.assertFalse(os.path.exists(self.file_path + HttpClient.PARTIAL_SUFFIX + HttpClient.ETAG_SUFFIX))
+
+
+    def test_partial_file_of_a_changed_dump_is_downloaded_again(self):
+
+        self._write_partial_file(b'x' * 20000, '"previous-dump"')
+
+        HttpClient.download(self.url, self.file_path)
+
+        self.assertEqual(_DumpHandler.CONTENT, self._read_file())
+        self.assertEqual(['"previous-dump"'], _DumpHandler.IF_RANGES)
+
+
+    def test_partial_file_without_etag_is_downloaded_again(self):
+
+        self._write_partial_file(b'x' * 20000)
+
+        HttpClient.download(self.url, self.file_path)
+
+        self.assertEqual(_DumpHandler.CONTENT, self._read_file())
+        self.assertEqual([None], [range_header for range_header, _ in _DumpHandler.REQUESTS])
+
+
+    def test_etag_of_a_partial_file_is_saved_for_the_next_run(self):
+
+        _DumpHandler.CUTS = [10000] * 10
+
+        with patch.object(HttpClient, 'MAX_RETRIES', 0), \
+             self.assertRaises(requests.exceptions.RequestException):
+            HttpClient.download(self.url, self.file_path, chunk_size=1000)
+
+        with open(self.file_path + HttpClient.PARTIAL_SUFFIX + HttpClient.ETAG_SUFFIX) as file_handle:
+            self.assertEqual('"dump"', file_handle.read())
+
+
+    def test_download_restarts_when_the_range_is_ignored(self):
+
+        _DumpHandler.CUTS = [10000]
+        _DumpHandler.IGNORE_RANGE = True
+
+        HttpClient.download(self.url, self.file_path, chunk_size=1024)
+
+        self.assertEqual(_DumpHandler.CONTENT, self._read_file())
+
+
+    def test_error_statuses_are_retried(self):
+
+        _DumpHandler.STATUSES = [503, 502]
+
+        HttpClient.download(self.url, self.file_path)
+
+        self.assertEqual(_DumpHandler.CONTENT, self._read_file())
+        self.assertEqual(3, len(_DumpHandler.REQUESTS))
+
+
+    def test_download_gives_up_when_nothing_is_received(self):
+
+        _DumpHandler.CUTS = [0] * 10
+
+        with patch.object(HttpClient, 'MAX_RETRIES', 2), \
+             self.assertRaises(requests.exceptions.RequestException):
+            HttpClient.download(self.url, self.file_path)
+
+        self.assertEqual(3, len(_DumpHandler.REQUESTS))
+        self.assertFalse(os.path.exists(self.file_path))
+
+
+    def test_connections_are_reused(self):
+
+        HttpClient.download(self.url, self.file_path)
+        HttpClient.download(self.url, self.file_path)
+
+        self.assertEqual(1, len({client_port for _, client_port in _DumpHandler.REQUESTS}))
+
+
+    def test_stream_resumes_where_it_was_cut(self):
+
+        _DumpHandler.CUTS = [10000, 5000]
+
+        self.assertEqual(_DumpHandler.CONTENT, b''.join(HttpClient.stream(self.url, chunk_size=1000)))
+        self.assertEqual([None, 'bytes=10000-', 'bytes=15000-'], [range_header for range_header, _ in
+                                                                   _DumpHandler.REQUESTS])
+
+
+    def test_stream_skips_what_it_yielded_when_the_range_is_ignored(self):
+
+        _DumpHandler.CUTS = [10000, 25000]
+        _DumpHandler.IGNORE_RANGE = True
+
+        self.assertEqual(_DumpHandler.CONTENT, b''.join(HttpClient.stream(self.url, chunk_size=1000)))
+        self.assertEqual(3, len(_DumpHandler.REQUESTS))
+
+
+    def test_stream_fails_when_the_file_changed(self):
+
+        _DumpHandler.CUTS = [10000]
+        _DumpHandler.IGNORE_RANGE = True
+        _DumpHandler.ETAGS = ['"dump-1"', '"dump-2"']
+
+        with self.assertRaises(Exception) as context:
+            b''.join(HttpClient.stream(self.url, chunk_size=1000))
+
+        self.assertIn('changed', str(context.exception))
+
+
+    def test_stream_lines_are_not_yielded_twice_after_a_cut(self):
+
+        lines = [b'en Page_%d %d 0' % (i, i) for i in range(5000)]
+        _DumpHandler.CONTENT = gzip.compress(b'\n'.join(lines) + b'\n')
+        _DumpHandler.CUTS = [len(_DumpHandler.CONTENT) // 3, 1000]
+
+        actual_lines = list(Wikimedia._stream_lines(self.url, chunk_size=1000))
+
+        self.assertEqual(lines, actual_lines)
+        self.assertEqual(3, len(_DumpHandler.REQUESTS))
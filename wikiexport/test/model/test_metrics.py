@@ -0,0 +1,67 @@
+import unittest
+from unittest.mock import patch
+from datetime import datetime
+import tempfile
+import json
+import os
+
+from src.model.metrics import HourMetrics, MetricsExporter
+
+
+class HourMetricsTest(unittest.TestCase):
+
+
+    def test_nested_stages_are_not_counted_twice(self):
+
+        metrics = HourMetrics(datetime(2020, 1, 1, 1))
+        clock = iter([0.0, 1.0, 4.0, 10.0])
+
+        with patch('src.model.metrics.time.perf_counter', side_effect=lambda: next(clock)):
+            with metrics.stage('parse_rank'):
+                with metrics.stage('download'):
+                    pass
+
+        self.assertEqual(3.0, metrics.stages['download'].seconds)
+        self.assertEqual(7.0, metrics.stages['parse_rank'].seconds)
+
+
+    def test_timed_blocks_are_counted(self):
+
+        metrics = HourMetrics(datetime(2020, 1, 1, 1))
+
+        with metrics.stage('parse_rank'):
+            blocks = list(metrics.timed('decompress', iter([b'a b 1 0\nc d', b' 2 0\n']), count_lines=True))
+
+        decompress = metrics.stages['decompress']
+        self.assertEqual([b'a b 1 0\nc d', b' 2 0\n'], blocks)
+        self.assertEqual((16, 2), (decompress.bytes, decompress.rows_out))
+        self.assertGreater(decompress.max_rss_bytes, 0)
+        self.assertGreaterEqual(metrics.stages['parse_rank'].seconds, 0)
+
+
+class MetricsExporterTest(unittest.TestCase):
+
+
+    def test_metrics_are_exported_as_json_lines_and_prometheus(self):
+
+        metrics = HourMetrics(datetime(2020, 1, 1, 1))
+        with metrics.stage('sort') as stage:
+            stage.rows_in = stage.rows_out = 25
+        metrics.blacklisted_rows = 3
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            exporter = MetricsExporter(dir_path)
+            exporter.export(metrics)
+            exporter.export(metrics)
+
+            with open(os.path.join(dir_path, MetricsExporter.JSON_LINES_FILE)) as file_handle:
+                json_lines = [json.loads(line) for line in file_handle]
+            with open(os.path.join(dir_path, MetricsExporter.PROMETHEUS_FILE)) as file_handle:
+                prometheus_lines = file_handle.read().split('\n')
+
+        self.assertEqual(2, len(json_lines))
+        self.assertEqual('2020-01-01T01:00:00', json_lines[0]['datetime_hour'])
+        self.assertEqual(25, json_lines[0]['stages']['sort']['rows_out'])
+        self.assertIn('wikiexport_blacklisted_rows 3', prometheus_lines)
+        self.assertIn('wikiexport_stage_rows_out{stage="sort"} 25', prometheus_lines)
+        self.assertIn('# TYPE wikiexport_stage_seconds gauge', prometheus_lines)
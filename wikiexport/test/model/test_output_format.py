@@ -0,0 +1,70 @@
+import unittest
+import gzip
+import io
+
+from src.model.output_format import OutputFormat, CsvFormat, zstandard, pyarrow
+from src.model.pageview import Pageview
+
+
+class OutputFormatTest(unittest.TestCase):
+
+
+    def setUp(self):
+
+        self.pageviews = [Pageview('en', f'Page_{i}', 1000 - i) for i in range(3000)] + [Pageview('fr', 'Ça_va', 3)]
+        self.csv_lines = ['domain,page_title,pageview_count'] + \
+                         [f'{pageview.domain},{pageview.page_title},{pageview.view_count}'
+                          for pageview in self.pageviews] + ['']
+
+
+    def test_instantiate_unknown_format(self):
+
+        with self.assertRaises(ValueError):
+            OutputFormat.instantiate_format('xlsx')
+
+
+    def test_csv(self):
+
+        content = b''.join(CsvFormat().encode(self.pageviews))
+
+        self.assertEqual(self.csv_lines, content.decode('utf-8').split('\n'))
+
+
+    def test_gzip_csv(self):
+
+        output_format = OutputFormat.instantiate_format('csv.gz')
+        content = b''.join(output_format.encode(self.pageviews))
+
+        self.assertEqual('csv.gz', output_format.extension)
+        self.assertEqual(self.csv_lines, gzip.decompress(content).decode('utf-8').split('\n'))
+
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd_csv(self):
+
+        output_format = OutputFormat.instantiate_format('csv.zst')
+        content = b''.join(output_format.encode(self.pageviews))
+
+        self.assertEqual('csv.zst', output_format.extension)
+        decompressed = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(content)).read()
+        self.assertEqual(self.csv_lines, decompressed.decode('utf-8').split('\n'))
+
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_columnar_formats_keep_the_order(self):
+
+        for format_name in ('parquet', 'arrow'):
+            output_format = OutputFormat.instantiate_format(format_name)
+            content = b''.join(output_format.encode(self.pageviews))
+
+            if format_name == 'parquet':
+                table = pyarrow.parquet.read_table(pyarrow.BufferReader(content))
+            else:
+                table = pyarrow.ipc.open_file(pyarrow.BufferReader(content)).read_all()
+
+            self.assertEqual(format_name, output_format.extension)
+            self.assertEqual(['domain', 'page_title', 'pageview_count'], table.column_names)
+            self.assertEqual([(pageview.domain, pageview.page_title, pageview.view_count)
+                              for pageview in self.pageviews],
+                             list(zip(table.column('domain').to_pylist(), table.column('page_title').to_pylist(),
+                                      table.column('pageview_count').to_pylist())))
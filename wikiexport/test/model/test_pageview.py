@@ -0,0 +1,22 @@
+import unittest
+
+from src.model.pageview import Pageview
+
+
+class PageviewTest(unittest.TestCase):
+
+
+    def test_equality_and_hash_ignore_view_count(self):
+
+        self.assertEqual(Pageview('a', 'main_page', 23), Pageview('a', 'main_page', None))
+        self.assertEqual(hash(Pageview('a', 'main_page', 23)), hash(Pageview('a', 'main_page', None)))
+        self.assertNotEqual(Pageview('a', 'main_page', 23), Pageview('b', 'main_page', 23))
+
+
+    def test_compact_representation(self):
+
+        first_pageview = Pageview.instance_from_pageview_line('en.m main_page 23 0')
+        second_pageview = Pageview.instance_from_pageview_line('en.m second_page 2 0')
+
+        self.assertFalse(hasattr(first_pageview, '__dict__'))
+        self.assertIs(first_pageview.domain, second_pageview.domain)
@@ -0,0 +1,72 @@
+import unittest
+import random
+
+from src.model.blacklist import BlacklistFilter
+from src.model.engine import PythonEngine
+from src.model.parallel import ParallelParser
+from src.model.wikimedia import Wikimedia
+
+
+class ParallelParserTest(unittest.TestCase):
+
+
+    def test_same_result_as_a_single_engine(self):
+
+        random_generator = random.Random(3)
+        domains = ['a', 'ab', 'ab.c', 'en.m', 'fr']
+        lines = [f'{random_generator.choice(domains)} page{random_generator.randrange(300)} '
+                 f'{random_generator.randrange(1, 40)} 0'.encode() for _ in range(5000)]
+        blacklist_keys = {tuple(line.split(b' ')[:2]) for line in lines[::13]}
+        content = b'\n'.join(lines) + b'\n'
+        blocks = Wikimedia._align_blocks((content[i:i + 997] for i in range(0, len(content), 997)), 4096)
+
+        with ParallelParser(2, blacklist_keys) as parser:
+            actual_pageviews = parser.get_top_pageviews_per_domain(blocks, k=3)
+
+        expected_pageviews = PythonEngine().get_top_pageviews_per_domain(lines, blacklist_keys, k=3)
+        Wikimedia.sort_pageviews_per_domain_and_views(actual_pageviews)
+        Wikimedia.sort_pageviews_per_domain_and_views(expected_pageviews)
+
+        self.assertEqual([(pageview.domain, pageview.page_title, pageview.view_count)
+                          for pageview in expected_pageviews],
+                         [(pageview.domain, pageview.page_title, pageview.view_count)
+                          for pageview in actual_pageviews])
+
+
+    def test_blacklist_counters_of_the_parsing_processes_are_merged(self):
+
+        lines = [f'en page{i} {i} 0'.encode() for i in range(1000)]
+        blacklist_keys = BlacklistFilter({(b'en', b'page999'), (b'en', b'page998')})
+        content = b'\n'.join(lines) + b'\n'
+        blocks = Wikimedia._align_blocks((content[i:i + 997] for i in range(0, len(content), 997)), 2048)
+
+        with ParallelParser(2, blacklist_keys) as parser:
+            pageviews = parser.get_top_pageviews_per_domain(blocks, k=3)
+
+        self.assertEqual({'page997', 'page996', 'page995'}, {pageview.page_title for pageview in pageviews})
+        self.assertGreaterEqual(blacklist_keys.get_counters()['prefilter_hits'], 2)
+        self.assertGreaterEqual(blacklist_keys.get_counters()['lookups'], 5)
+
+
+    def test_blacklisted_rows_of_the_parsing_processes_are_counted(self):
+
+        lines = [f'en page{i} {i} 0'.encode() for i in range(1000)]
+        content = b'\n'.join(lines) + b'\n'
+        blocks = Wikimedia._align_blocks((content[i:i + 997] for i in range(0, len(content), 997)), 2048)
+        counters = {}
+
+        with ParallelParser(2, {(b'en', b'page999'), (b'en', b'page998')}) as parser:
+            parser.get_top_rows_per_domain(blocks, k=3, counters=counters)
+
+        self.assertEqual({'blacklisted_rows': 2}, counters)
+
+
+    def test_merge_keeps_earliest_rows_on_ties(self):
+
+        top_rows_per_domain = {b'a': [(5, -1, b'page1'), (3, -2, b'page2')]}
+
+        ParallelParser._merge_top_rows(top_rows_per_domain, {b'a': [(5, -10, b'page3'), (4, -11, b'page4')],
+                                                             b'b': [(1, -12, b'page1')]}, k=2)
+
+        self.assertEqual({b'a': [(5, -1, b'page1'), (5, -10, b'page3')], b'b': [(1, -12, b'page1')]},
+                         top_rows_per_domain)
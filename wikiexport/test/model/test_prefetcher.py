@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import patch
+from datetime import datetime
+import tempfile
+import os
+
+from src.model.prefetcher import Prefetcher
+
+
+class PrefetcherTest(unittest.TestCase):
+
+
+    def setUp(self):
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.datetime_hours = [datetime(2020, 1, 1, hour) for hour in range(4)]
+        self.downloaded = []
+
+
+    def tearDown(self):
+
+        self.dir.cleanup()
+
+
+    def download(self, dt):
+
+        file_path = os.path.join(self.dir.name, f'{dt.hour}.gz')
+        with open(file_path, 'wb') as f:
+            f.write(b'x' * 100)
+        self.downloaded.append(dt)
+
+        return file_path
+
+
+    def test_downloads_ahead_up_to_depth(self):
+
+        with patch('src.model.prefetcher.Wikimedia.download_pageviews', side_effect=self.download):
+            with Prefetcher(self.datetime_hours, depth=2, disk_budget=10 ** 6) as prefetcher:
+                file_path = prefetcher.get_file_path(self.datetime_hours[0])
+                for future in list(prefetcher._futures.values()):
+                    future.result()
+
+                self.assertEqual(self.datetime_hours[:3], sorted(self.downloaded))
+
+                prefetcher.release(self.datetime_hours[0])
+                self.assertFalse(os.path.exists(file_path))
+
+        self.assertEqual([], os.listdir(self.dir.name))
+
+
+    def test_disk_budget_limits_prefetching(self):
+
+        with patch('src.model.prefetcher.Wikimedia.download_pageviews', side_effect=self.download):
+            with Prefetcher(self.datetime_hours, depth=3, disk_budget=150) as prefetcher:
+                for dt in self.datetime_hours:
+                    prefetcher.get_file_path(dt)
+                    self.assertLessEqual(len(os.listdir(self.dir.name)), 2)
+                    prefetcher.release(dt)
+
+        self.assertEqual(self.datetime_hours, self.downloaded)
+        self.assertEqual([], os.listdir(self.dir.name))
+
+
+    def test_failed_download_is_raised_to_the_consumer(self):
+
+        def download(dt):
+            if dt == self.datetime_hours[1]:
+                raise Exception('download failed')
+            return self.download(dt)
+
+        with patch('src.model.prefetcher.Wikimedia.download_pageviews', side_effect=download):
+            with Prefetcher(self.datetime_hours, depth=1, disk_budget=10 ** 6) as prefetcher:
+                prefetcher.get_file_path(self.datetime_hours[0])
+                prefetcher.release(self.datetime_hours[0])
+
+                with self.assertRaises(Exception):
+                    prefetcher.get_file_path(self.datetime_hours[1])
+
+                self.assertTrue(os.path.exists(prefetcher.get_file_path(self.datetime_hours[2])))
@@ -0,0 +1,69 @@
+import unittest
+from datetime import datetime
+import tempfile
+import pstats
+import tracemalloc
+
+from src.model.profiler import HourProfiler
+from src.model.writer import LocalWriter
+
+
+def _hot_function():
+
+    return [str(i) for i in range(10000)]
+
+
+class HourProfilerTest(unittest.TestCase):
+
+
+    def test_profile_and_snapshot_are_saved_next_to_the_result(self):
+
+        dt = datetime(2020, 1, 1, 1)
+
+        with HourProfiler(dt, 'both') as profiler:
+            kept = _hot_function()
+
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreater(profiler.peak_bytes, 0)
+        summary = profiler.get_summary(5)
+        self.assertIn('_hot_function', summary)
+        self.assertIn('test_profiler.py', summary.split('Peak of traced memory')[1])
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            prof_path, snapshot_path = profiler.save(LocalWriter(output_dir))
+
+            self.assertEqual(f'{output_dir}/20200101T01:00:00.prof', prof_path)
+            self.assertEqual(f'{output_dir}/20200101T01:00:00.tracemalloc', snapshot_path)
+            functions = {function_name for _, _, function_name in pstats.Stats(prof_path).stats}
+            self.assertIn('_hot_function', functions)
+            self.assertTrue(tracemalloc.Snapshot.load(snapshot_path).statistics('lineno'))
+        self.assertEqual(10000, len(kept))
+
+
+    def test_tracemalloc_already_tracing_is_left_running(self):
+
+        tracemalloc.start()
+        try:
+            with HourProfiler(datetime(2020, 1, 1, 1), 'memory') as profiler:
+                kept = _hot_function()
+
+            self.assertTrue(tracemalloc.is_tracing())
+            self.assertGreater(profiler.peak_bytes, 0)
+            self.assertEqual(10000, len(kept))
+        finally:
+            tracemalloc.stop()
+
+
+    def test_cpu_mode_does_not_trace_memory(self):
+
+        with HourProfiler(datetime(2020, 1, 1, 1), 'cpu') as profiler:
+            _hot_function()
+
+        self.assertIsNone(profiler.snapshot)
+        self.assertNotIn('Peak of traced memory', profiler.get_summary())
+
+
+    def test_unknown_mode(self):
+
+        with self.assertRaises(ValueError):
+            HourProfiler(datetime(2020, 1, 1, 1), 'disk')
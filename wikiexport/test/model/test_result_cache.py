@@ -0,0 +1,53 @@
+import unittest
+from datetime import datetime
+import tempfile
+import os
+
+from src.model.pageview import Pageview
+from src.model.result_cache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+
+    def setUp(self):
+
+        self.dir = tempfile.TemporaryDirectory()
+
+
+    def tearDown(self):
+
+        self.dir.cleanup()
+
+
+    def test_cached_pageviews_are_read_back_in_order(self):
+
+        result_cache = ResultCache(10 ** 6, self.dir.name)
+        pageviews = [Pageview('en', 'Main_Page', 20), Pageview('en', 'Ça_va', 3), Pageview('fr', 'Accueil', 7)]
+
+        result_cache.set_pageviews(datetime(2020, 1, 1, 1), pageviews)
+
+        self.assertEqual([(pageview.domain, pageview.page_title, pageview.view_count) for pageview in pageviews],
+                         [(pageview.domain, pageview.page_title, pageview.view_count)
+                          for pageview in result_cache.get_pageviews(datetime(2020, 1, 1, 1))])
+        self.assertIsNone(result_cache.get_pageviews(datetime(2020, 1, 1, 2)))
+
+
+    def test_least_recently_used_results_are_evicted(self):
+
+        pageviews = [Pageview('en', f'page{i}', i) for i in range(100)]
+        result_cache = ResultCache(10 ** 6, self.dir.name)
+        result_cache.set_pageviews(datetime(2020, 1, 1, 0), pageviews)
+        file_size = os.path.getsize(result_cache._get_file_path(datetime(2020, 1, 1, 0)))
+        result_cache.max_size = 2 * file_size
+
+        result_cache.set_pageviews(datetime(2020, 1, 1, 1), pageviews)
+        os.utime(result_cache._get_file_path(datetime(2020, 1, 1, 0)), (0, 0))
+        os.utime(result_cache._get_file_path(datetime(2020, 1, 1, 1)), (1, 1))
+        # reading hour 0 makes hour 1 the least recently used one
+        self.assertIsNotNone(result_cache.get_pageviews(datetime(2020, 1, 1, 0)))
+        result_cache.set_pageviews(datetime(2020, 1, 1, 2), pageviews)
+
+        self.assertIsNotNone(result_cache.get_pageviews(datetime(2020, 1, 1, 0)))
+        self.assertIsNone(result_cache.get_pageviews(datetime(2020, 1, 1, 1)))
+        self.assertIsNotNone(result_cache.get_pageviews(datetime(2020, 1, 1, 2)))
@@ -1,5 +1,7 @@
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import patch
+from datetime import datetime
+import gzip
 from requests import codes
 
 from src.model.wikimedia import Wikimedia
@@ -46,6 +48,53 @@ class WikimediaTest(unittest.TestCase):
         self.assertEqual(expected_top_3_pageviews, actual_top_3_pageviews)
 
 
+    def test_get_top_3_pageviews_per_domain_from_lines(self):
+
+        lines = [b'a page1 12 0', b'a page2 10 0', b'a page3 1 0', b'a page4 3 0', b'a page5 33 0',
+                 b'ab page1 12 0', b'ab page2 33 0', b'ab page3 2 0', b'ab page4 99 0',
+                 b'ab.c page1 44 0', b'ab.c page2 33 0', b'ab.c page3 22 0', b'ab.c page5 33 0', b'ab.c page6 33 0']
+        blacklist_keys = {(b'ab', b'page4'), (b'a', b'page3')}
+
+        expected_top_3_pageviews = [Pageview(domain='a', page_title='page1', view_count=12),
+                                    Pageview(domain='a', page_title='page2', view_count=10),
+                                    Pageview(domain='a', page_title='page5', view_count=33),
+                                    Pageview(domain='ab', page_title='page1', view_count=12),
+                                    Pageview(domain='ab', page_title='page2', view_count=33),
+                                    Pageview(domain='ab', page_title='page3', view_count=2),
+                                    # ties are won by the first rows of the dump
+                                    Pageview(domain='ab.c', page_title='page1', view_count=44),
+                                    Pageview(domain='ab.c', page_title='page2', view_count=33),
+                                    Pageview(domain='ab.c', page_title='page5', view_count=33)]
+
+        actual_top_3_pageviews = Wikimedia.get_top_pageviews_per_domain_from_lines(lines, blacklist_keys, k=3)
+        actual_top_3_pageviews.sort(key=lambda pageview: (pageview.domain, pageview.page_title))
+
+        self.assertEqual(expected_top_3_pageviews, actual_top_3_pageviews)
+        self.assertEqual([12, 10, 33, 12, 33, 2, 44, 33, 33],
+                         [pageview.view_count for pageview in actual_top_3_pageviews])
+
+
+    def test_rows_below_threshold_skip_blacklist_lookup(self):
+
+        looked_up_keys = []
+
+        class Blacklist(set):
+            def __contains__(self, key):
+                looked_up_keys.append(key)
+                return super().__contains__(key)
+
+        lines = [b'a page1 12 0', b'a page2 10 0', b'a page3 1 0', b'a page4 10 0', b'a page5 11 0',
+                 b'a page6 10 0', b'a page7 2 0', b'b page1 1 0']
+
+        actual_top_2_pageviews = Wikimedia.get_top_pageviews_per_domain_from_lines(lines, Blacklist({(b'a', b'page1')}),
+                                                                                   k=2)
+
+        self.assertEqual({Pageview('a', 'page2', 10), Pageview('a', 'page5', 11), Pageview('b', 'page1', 1)},
+                         set(actual_top_2_pageviews))
+        self.assertEqual([(b'a', b'page1'), (b'a', b'page2'), (b'a', b'page3'), (b'a', b'page4'), (b'a', b'page5'),
+                          (b'b', b'page1')], looked_up_keys)
+
+
     def test_sort_pageviews_per_domain_and_view_count(self):
 
         pageviews = [Pageview(domain='ab', page_title='page2', view_count=33),
@@ -74,13 +123,10 @@ class WikimediaTest(unittest.TestCase):
         dir = Wikimedia.DIR_PATH
         expected_file_path = f'{dir}/pageviews-20200101-010000.gz'
 
-        with patch('src.model.wikimedia.open', new=mock_open()) as open_mock, \
-             patch('src.model.wikimedia.requests.get') as get_mock:
-
-            get_mock.return_value.status_code = codes.ok
+        with patch('src.model.wikimedia.HttpClient.download', return_value=expected_file_path) as download_mock:
             actual_file_path = Wikimedia._download_file(url, dir)
 
-            open_mock.assert_called_once_with(expected_file_path, 'wb')
+            download_mock.assert_called_once_with(url, expected_file_path, 10 * 1024 ** 2)
             self.assertEqual(expected_file_path, actual_file_path)
 
 
@@ -89,8 +135,84 @@ class WikimediaTest(unittest.TestCase):
         url = 'https://dumps.wikimedia.org/other/pageviews/2020/2020-01/pageviews-20200101-010000.gz'
         dir = Wikimedia.DIR_PATH
 
-        with patch('src.model.wikimedia.requests.get') as get_mock, \
+        with patch('src.model.http_client.HttpClient.get') as get_mock, \
              self.assertRaises(Exception):
 
             get_mock.return_value.status_code = 400
             Wikimedia._download_file(url, dir)
+
+
+    def test_stream_lines_across_chunks_and_gzip_members(self):
+
+        url = 'https://dumps.wikimedia.org/other/pageviews/2020/2020-01/pageviews-20200101-010000.gz'
+        content = gzip.compress(b'a page1 12 0\nab page\xc3\xa9 3 0\n') + gzip.compress(b'b page1 1 0\n')
+        chunks = [content[i:i + 7] for i in range(0, len(content), 7)]
+
+        with patch('src.model.wikimedia.HttpClient.get') as get_mock:
+            get_mock.return_value.status_code = codes.ok
+            get_mock.return_value.iter_content.return_value = iter(chunks)
+
+            actual_lines = list(Wikimedia._stream_lines(url))
+
+        self.assertEqual([b'a page1 12 0', b'ab page\xc3\xa9 3 0', b'b page1 1 0'], actual_lines)
+
+
+    def test_truncated_stream_raises(self):
+
+        content = gzip.compress(b''.join(b'a page%d %d 0\n' % (i, i) for i in range(1000)))
+
+        with self.assertRaises(EOFError):
+            list(Wikimedia._decompress_chunks([content[:len(content) // 2]]))
+        self.assertEqual(1000, sum(block.count(b'\n') for block in Wikimedia._decompress_chunks([content])))
+
+
+    def test_stream_lines_failed(self):
+
+        url = 'https://dumps.wikimedia.org/other/pageviews/2020/2020-01/pageviews-20200101-010000.gz'
+
+        with patch('src.model.wikimedia.HttpClient.get') as get_mock, \
+             self.assertRaises(Exception):
+
+            get_mock.return_value.status_code = 404
+            list(Wikimedia._stream_lines(url))
+
+
+    def test_get_pageviews_streamed_without_staging_file(self):
+
+        dt = datetime(2020, 1, 1, 1)
+        expected_url = 'https://dumps.wikimedia.org/other/pageviews/2020/2020-01/pageviews-20200101-010000.gz'
+
+        with patch.object(Wikimedia, '_stream_lines', return_value=iter([b'a page1 12 0'])) as stream_mock, \
+             patch.object(Wikimedia, '_download_file') as download_mock:
+
+            actual_pageviews = list(Wikimedia.get_pageviews(dt))
+
+            stream_mock.assert_called_once_with(expected_url, metrics=None)
+            download_mock.assert_not_called()
+            self.assertEqual([Pageview('a', 'page1', 12)], actual_pageviews)
+            self.assertEqual(12, actual_pageviews[0].view_count)
+
+
+    def test_get_pageviews_staged_to_disk(self):
+
+        dt = datetime(2020, 1, 1, 1)
+
+        with patch.object(Wikimedia, '_download_file', return_value='/tmp/file.gz') as download_mock, \
+             patch.object(Wikimedia, '_read_raw_lines', return_value=iter([b'a page1 12 0\n'])), \
+             patch('src.model.wikimedia.os.remove') as remove_mock:
+
+            actual_pageviews = list(Wikimedia.get_pageviews(dt, stage_to_disk=True))
+
+            download_mock.assert_called_once()
+            remove_mock.assert_called_once_with('/tmp/file.gz')
+            self.assertEqual([Pageview('a', 'page1', 12)], actual_pageviews)
+
+
+    def test_align_blocks_on_new_lines(self):
+
+        blocks = [b'a page1 1 0\na pa', b'ge2 2 0\nb', b'', b' page1 3 0\nb page2 4 0']
+
+        actual_blocks = list(Wikimedia._align_blocks(blocks, block_size=8))
+
+        self.assertEqual([b'a page1 1 0\n', b'a page2 2 0\n', b'b page1 3 0\n', b'b page2 4 0'], actual_blocks)
+        self.assertEqual(b''.join(blocks), b''.join(actual_blocks))
@@ -1,9 +1,23 @@
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import patch, mock_open, MagicMock
 from datetime import datetime
+import tempfile
+import threading
+import os
+import gzip
+import json
+
+import boto3
+
+try:
+    import moto
+except ImportError:
+    # moto is an optional test dependency: pip install ./wikiexport[test]
+    moto = None
 
 from src.model.pageview import Pageview
-from src.model.writer import LocalWriter, S3Writer
+from src.model.output_format import CsvFormat
+from src.model.writer import AsyncWriter, LocalWriter, S3Writer, Writer
 
 class LocalWriterTest(unittest.TestCase):
 
@@ -44,6 +58,30 @@ class LocalWriterTest(unittest.TestCase):
             open_mock.assert_called_once_with('/tmp/a-dir/that/doesnt/exist/20201023T00:00:00.csv', 'wt')
 
 
+    def test_get_existing_paths(self):
+
+        with tempfile.TemporaryDirectory() as output_dir_path:
+            local_writer = LocalWriter(output_dir_path)
+            dts = [datetime(2020, 10, 23, hour) for hour in range(3)]
+            open(local_writer.get_path(dts[1]), 'w').close()
+
+            self.assertEqual({local_writer.get_path(dts[1])},
+                             local_writer.get_existing_paths(local_writer.get_path(dt) for dt in dts))
+
+
+    def test_write_compressed_pageviews(self):
+
+        input_pageviews = [Pageview('a', 'main_page', 23), Pageview('b', 'second_page', 33)]
+
+        with tempfile.TemporaryDirectory() as output_dir_path:
+            local_writer = LocalWriter(output_dir_path, CsvFormat('gzip'))
+            actual_path = local_writer.write_pageviews(input_pageviews, datetime(2020, 10, 23))
+
+            self.assertEqual(f'{output_dir_path}/20201023T00:00:00.csv.gz', actual_path)
+            with gzip.open(actual_path, 'rt') as f:
+                self.assertEqual('domain,page_title,pageview_count\na,main_page,23\nb,second_page,33\n', f.read())
+
+
 class S3WriterTest(unittest.TestCase):
 
 
@@ -56,3 +94,243 @@ class S3WriterTest(unittest.TestCase):
 
             s3_writer = S3Writer('s3://my-bucket/my/second-directory/', None, None)
             self.assertEqual(s3_writer._get_bucket_and_object(dt), ('my-bucket', 'my/second-directory/20201027T00:00:00.csv'))
+
+
+    def test_get_existing_paths_lists_objects_under_the_common_prefix(self):
+
+        dts = [datetime(2020, 10, 27, hour) for hour in range(3)]
+        with patch('boto3.Session'):
+            s3_writer = S3Writer('s3://my-bucket/my/directory', None, None)
+        paginator = s3_writer.s3_client.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {'Contents': [{'Key': 'my/directory/20201027T00:00:00.csv'}, {'Key': 'my/directory/20201027T00:30.csv'}]},
+            {'Contents': [{'Key': 'my/directory/20201027T02:00:00.csv'}]}]
+
+        existing_paths = s3_writer.get_existing_paths(s3_writer.get_path(dt) for dt in dts)
+
+        s3_writer.s3_client.get_paginator.assert_called_once_with('list_objects_v2')
+        paginator.paginate.assert_called_once_with(Bucket='my-bucket', Prefix='my/directory/20201027T0')
+        self.assertEqual({'s3://my-bucket/my/directory/20201027T00:00:00.csv',
+                          's3://my-bucket/my/directory/20201027T02:00:00.csv'}, existing_paths)
+
+
+@unittest.skipIf(moto is None, 'moto is not installed')
+class S3WriterUploadTest(unittest.TestCase):
+
+
+    def setUp(self):
+
+        self.mock_aws = moto.mock_aws()
+        self.mock_aws.start()
+        self.s3_client = boto3.client('s3', region_name='us-east-1')
+        self.s3_client.create_bucket(Bucket='my-bucket')
+
+
+    def tearDown(self):
+
+        self.mock_aws.stop()
+
+
+    def get_object_lines(self, key, gzip_output=False):
+
+        content = self.s3_client.get_object(Bucket='my-bucket', Key=key)['Body'].read()
+        if gzip_output:
+            content = gzip.decompress(content)
+
+        return content.decode('utf-8').split('\n')
+
+
+    def test_small_output_is_uploaded_with_put_object(self):
+
+        s3_writer = S3Writer('s3://my-bucket/my/directory', 'key', 'secret')
+        pageviews = [Pageview('a', 'main_page', 23), Pageview('b', 'Ça_va', 33)]
+
+        with patch.object(s3_writer.s3_client, 'create_multipart_upload') as create_mock:
+            object_path = s3_writer.write_pageviews(pageviews, datetime(2020, 10, 27))
+
+        create_mock.assert_not_called()
+        self.assertEqual('s3://my-bucket/my/directory/20201027T00:00:00.csv', object_path)
+        self.assertEqual(['domain,page_title,pageview_count', 'a,main_page,23', 'b,Ça_va,33', ''],
+                         self.get_object_lines('my/directory/20201027T00:00:00.csv'))
+
+
+    def test_large_output_is_uploaded_in_parts(self):
+
+        pageviews = [Pageview(f'domain{i % 100}', f'page_{i:07d}_' + 'x' * 40, i) for i in range(250000)]
+        s3_writer = S3Writer('s3://my-bucket/my/directory', 'key', 'secret')
+
+        with patch.object(S3Writer, 'PART_SIZE', 5 * 1024 ** 2), \
+             patch.object(s3_writer.s3_client, 'upload_part', wraps=s3_writer.s3_client.upload_part) as upload_mock:
+            s3_writer.write_pageviews(pageviews, datetime(2020, 10, 27))
+
+        # about 15.5 MB: three full parts and the last one
+        self.assertEqual(4, upload_mock.call_count)
+        lines = self.get_object_lines('my/directory/20201027T00:00:00.csv')
+        self.assertEqual(len(pageviews) + 2, len(lines))
+        self.assertEqual(f'domain99,page_0249999_{"x" * 40},249999', lines[-2])
+
+
+    def test_gzip_output(self):
+
+        pageviews = [Pageview('a', f'page{i}', i) for i in range(1000)]
+        s3_writer = S3Writer('s3://my-bucket/my/directory', 'key', 'secret', CsvFormat('gzip'))
+
+        object_path = s3_writer.write_pageviews(pageviews, datetime(2020, 10, 27))
+
+        self.assertEqual('s3://my-bucket/my/directory/20201027T00:00:00.csv.gz', object_path)
+        self.assertEqual(['domain,page_title,pageview_count'] + [f'a,page{i},{i}' for i in range(1000)] + [''],
+                         self.get_object_lines('my/directory/20201027T00:00:00.csv.gz', gzip_output=True))
+
+
+    def test_encoded_file_is_uploaded_in_parts(self):
+
+        content = b'x' * (12 * 1024 ** 2)
+        s3_writer = S3Writer('s3://my-bucket/my/directory', 'key', 'secret')
+
+        with patch.object(S3Writer, 'PART_SIZE', 5 * 1024 ** 2), \
+             patch.object(s3_writer.s3_client, 'upload_part', wraps=s3_writer.s3_client.upload_part) as upload_mock:
+            s3_writer.write_bytes(content, datetime(2020, 10, 27))
+
+        self.assertEqual(3, upload_mock.call_count)
+        self.assertEqual(content, self.s3_client.get_object(Bucket='my-bucket',
+                                                            Key='my/directory/20201027T00:00:00.csv')['Body'].read())
+
+
+    def test_failed_upload_is_aborted(self):
+
+        pageviews = [Pageview(f'domain{i % 100}', f'page_{i:07d}_' + 'x' * 40, i) for i in range(250000)]
+        s3_writer = S3Writer('s3://my-bucket/my/directory', 'key', 'secret')
+
+        with patch.object(S3Writer, 'PART_SIZE', 5 * 1024 ** 2), \
+             patch.object(s3_writer.s3_client, 'complete_multipart_upload', side_effect=Exception('network error')), \
+             patch('click.echo'), \
+             self.assertRaises(Exception):
+            s3_writer.write_pageviews(pageviews, datetime(2020, 10, 27))
+
+        self.assertEqual([], self.s3_client.list_multipart_uploads(Bucket='my-bucket').get('Uploads', []))
+
+
+class AsyncWriterTest(unittest.TestCase):
+
+
+    def test_writes_are_returned_in_submission_order(self):
+
+        writer = MagicMock()
+        writer.write_pageviews.side_effect = lambda pageviews, dt: f'/tmp/{dt.hour}.csv'
+        dts = [datetime(2020, 10, 27, hour) for hour in range(5)]
+
+        with AsyncWriter(writer, queue_size=2) as async_writer:
+            outcomes = []
+            for dt in dts:
+                async_writer.submit([Pageview('a', 'main_page', dt.hour)], dt)
+                outcomes.extend(async_writer.get_completed_writes())
+            outcomes.extend(async_writer.flush())
+
+        self.assertEqual([(dt, f'/tmp/{dt.hour}.csv', None) for dt in dts], outcomes)
+
+
+    def test_submit_blocks_when_queue_is_full(self):
+
+        release_write = threading.Event()
+        writer = MagicMock()
+        writer.write_pageviews.side_effect = lambda pageviews, dt: release_write.wait(5) and 'path'
+
+        with AsyncWriter(writer, queue_size=1) as async_writer:
+            async_writer.submit([], datetime(2020, 10, 27, 0))
+            submitter = threading.Thread(target=async_writer.submit, args=([], datetime(2020, 10, 27, 1)))
+            submitter.start()
+            submitter.join(0.2)
+            self.assertTrue(submitter.is_alive())
+
+            release_write.set()
+            submitter.join(5)
+            self.assertFalse(submitter.is_alive())
+            self.assertEqual(2, len(list(async_writer.flush())))
+
+
+    def test_flush_surfaces_failed_writes(self):
+
+        writer = MagicMock()
+        writer.write_pageviews.side_effect = [OSError('disk full'), '/tmp/1.csv']
+
+        with AsyncWriter(writer, queue_size=2) as async_writer:
+            async_writer.submit([], datetime(2020, 10, 27, 0))
+            async_writer.submit([], datetime(2020, 10, 27, 1))
+            outcomes = list(async_writer.flush())
+
+        self.assertIsInstance(outcomes[0][2], OSError)
+        self.assertEqual((None, ('/tmp/1.csv', None)), (outcomes[0][1], outcomes[1][1:]))
+
+
+class MultiWriterTest(unittest.TestCase):
+
+
+    def test_result_is_encoded_once_and_written_everywhere(self):
+
+        pageviews = [Pageview('a', 'main_page', 23), Pageview('b', 'second_page', 33)]
+        dt = datetime(2020, 10, 23)
+
+        with tempfile.TemporaryDirectory() as first_dir, tempfile.TemporaryDirectory() as second_dir, \
+             patch('click.echo') as echo_mock:
+            multi_writer = Writer.instantiate_writer([first_dir, second_dir], format_name='csv.gz')
+            with patch.object(multi_writer.output_format, 'encode',
+                              wraps=multi_writer.output_format.encode) as encode_mock:
+                result_path = multi_writer.write_pageviews(pageviews, dt)
+
+            encode_mock.assert_called_once()
+            self.assertEqual(2, echo_mock.call_count)
+            expected_paths = [f'{first_dir}/20201023T00:00:00.csv.gz', f'{second_dir}/20201023T00:00:00.csv.gz']
+            self.assertEqual(expected_paths, json.loads(result_path))
+            self.assertEqual(result_path, multi_writer.get_path(dt))
+            for expected_path in expected_paths:
+                with gzip.open(expected_path, 'rt') as f:
+                    self.assertEqual('domain,page_title,pageview_count\na,main_page,23\nb,second_page,33\n', f.read())
+
+            os.remove(expected_paths[1])
+            self.assertEqual(set(), multi_writer.get_existing_paths([result_path]))
+            multi_writer.write_pageviews(pageviews, dt)
+            self.assertEqual({result_path}, multi_writer.get_existing_paths([result_path]))
+
+
+    def test_s3_destinations_are_recognized(self):
+
+        with patch('boto3.Session'):
+            multi_writer = Writer.instantiate_writer(['/tmp', 's3://my-bucket/dir'], 'key', 'secret')
+
+        self.assertEqual([LocalWriter, S3Writer], [type(writer) for writer in multi_writer.writers])
+        self.assertEqual('["/tmp/20201023T00:00:00.csv", "s3://my-bucket/dir/20201023T00:00:00.csv"]',
+                         multi_writer.get_path(datetime(2020, 10, 23)))
+
+
+    def test_single_destination_is_chosen_by_its_prefix(self):
+
+        with patch('boto3.Session'):
+            self.assertIsInstance(Writer.instantiate_writer('s3://my-bucket/dir'), S3Writer)
+            self.assertIsInstance(Writer.instantiate_writer(['s3://my-bucket/dir']), S3Writer)
+            self.assertIsInstance(Writer.instantiate_writer('/tmp', 'key', 'secret'), LocalWriter)
+
+
+    def test_paths_containing_the_former_separator(self):
+
+        dt = datetime(2020, 10, 23)
+
+        with tempfile.TemporaryDirectory() as output_dir, patch('click.echo'):
+            first_dir, second_dir = os.path.join(output_dir, 'a, b'), os.path.join(output_dir, 'c')
+            os.makedirs(first_dir)
+            os.makedirs(second_dir)
+            multi_writer = Writer.instantiate_writer([first_dir, second_dir])
+            result_path = multi_writer.write_pageviews([Pageview('a', 'main_page', 23)], dt)
+
+            self.assertEqual({result_path}, multi_writer.get_existing_paths([result_path, f'{first_dir}/x.csv']))
+
+
+    def test_no_thread_is_left_after_a_write(self):
+
+        threads = set(threading.enumerate())
+
+        with tempfile.TemporaryDirectory() as first_dir, tempfile.TemporaryDirectory() as second_dir, \
+             patch('click.echo'):
+            multi_writer = Writer.instantiate_writer([first_dir, second_dir])
+            multi_writer.write_pageviews([Pageview('a', 'main_page', 23)], datetime(2020, 10, 23))
+
+            self.assertEqual(threads, set(threading.enumerate()))
@@ -0,0 +1,36 @@
+import unittest
+from unittest.mock import patch
+from datetime import datetime
+import os
+import tempfile
+
+from click.testing import CliRunner
+
+from src.main import rollup
+from src.model.aggregate import AggregateStore, HourlyAggregate
+
+
+class RollupTest(unittest.TestCase):
+
+
+    def test_error_bounds_are_written_next_to_the_result(self):
+
+        with tempfile.TemporaryDirectory() as aggregate_dir, tempfile.TemporaryDirectory() as output_dir, \
+             patch.object(AggregateStore, 'DIR_PATH', aggregate_dir):
+            # hour 1 kept a and b, c had at most 2 views. Hour 2 kept c and a, b had at most 1 view
+            AggregateStore().set_aggregate(datetime(2020, 1, 1, 0),
+                                           HourlyAggregate(2, {b'en': [(10, b'a'), (2, b'b')]}, {b'en': 2}))
+            AggregateStore().set_aggregate(datetime(2020, 1, 1, 1),
+                                           HourlyAggregate(2, {b'en': [(3, b'c'), (1, b'a')]}, {b'en': 1}))
+
+            result = CliRunner().invoke(rollup, ['--start-datetime=20200101T00:00:00',
+                                                 '--end-datetime=20200101T01:00:00', f'--output={output_dir}'])
+
+            self.assertEqual(0, result.exit_code, result.output)
+            file_path = os.path.join(output_dir, '20200101T00:00:00--20200101T01:00:00')
+            with open(f'{file_path}.csv') as file_handle:
+                self.assertEqual('domain,page_title,pageview_count\nen,b,2\nen,c,3\nen,a,11\n', file_handle.read())
+            with open(f'{file_path}.errors.csv') as file_handle:
+                self.assertEqual('domain,page_title,pageview_count,max_error,top_guaranteed\n'
+                                 'en,b,2,1,false\nen,c,3,2,false\nen,a,11,0,false\n', file_handle.read())
+            self.assertIn(f'{file_path}.errors.csv', result.output)
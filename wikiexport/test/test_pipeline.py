@@ -0,0 +1,182 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from datetime import datetime
+import os
+import tempfile
+
+from src.model.aggregate import AggregateStore
+from src.model.engine import Engine
+from src.model.pageview import Pageview
+from src.model.writer import LocalWriter
+from src import pipeline
+from src.pipeline import process_datetime_hours, process_datetime_hour, ProcessingOptions
+
+
+class PipelineTest(unittest.TestCase):
+
+
+    def test_process_datetime_hour(self):
+
+        dt = datetime(2020, 1, 1, 1)
+        lines = [b'a page1 3 0', b'a page2 5 0', b'b page1 1 0']
+        blacklist = {(b'a', b'page2')}
+        writer = MagicMock()
+        writer.write_pageviews.return_value = '/tmp/20200101T01:00:00.csv'
+
+        with patch('src.pipeline.Wikimedia.get_pageview_lines', return_value=iter(lines)) as get_lines_mock, \
+             patch('click.echo'):
+            actual_path = process_datetime_hour(dt, blacklist, writer)
+
+            get_lines_mock.assert_called_once_with(dt, stage_to_disk=False, metrics=None)
+
+        written_pageviews, written_dt = writer.write_pageviews.call_args.args
+        self.assertEqual('/tmp/20200101T01:00:00.csv', actual_path)
+        self.assertEqual([Pageview('a', 'page1', 3), Pageview('b', 'page1', 1)], written_pageviews)
+        self.assertEqual(dt, written_dt)
+
+
+    def test_failed_hour_does_not_abort_the_others(self):
+
+        datetime_hours = [datetime(2020, 1, 1, 1), datetime(2020, 1, 1, 2), datetime(2020, 1, 1, 3)]
+        error = Exception('download failed')
+
+        def process(datetime_hour, pageviews_blacklist, writer, options, prefetcher, parser):
+            if datetime_hour == datetime(2020, 1, 1, 2):
+                raise error
+            return f'/tmp/{datetime_hour.hour}.csv'
+
+        with patch('src.pipeline.process_datetime_hour', side_effect=process), \
+             patch('src.pipeline.Writer.instantiate_writer'):
+
+            actual_results = list(process_datetime_hours(datetime_hours, set(), '/tmp'))
+
+        expected_results = [(datetime(2020, 1, 1, 1), '/tmp/1.csv', None),
+                            (datetime(2020, 1, 1, 2), None, error),
+                            (datetime(2020, 1, 1, 3), '/tmp/3.csv', None)]
+        self.assertEqual(expected_results, actual_results)
+
+
+    def test_worker_uses_shared_blacklist_and_writer(self):
+
+        blacklist = {(b'a', b'page2')}
+        dt = datetime(2020, 1, 1, 1)
+
+        with patch('src.pipeline.Writer.instantiate_writer') as instantiate_mock, \
+             patch('src.pipeline.process_datetime_hour', return_value='/tmp/1.csv') as process_mock:
+
+            pipeline._init_worker(blacklist, '/tmp', None, None, ProcessingOptions())
+            actual_result = pipeline._process_in_worker(dt)
+
+            instantiate_mock.assert_called_once_with('/tmp', None, None, 'csv')
+            process_mock.assert_called_once_with(dt, blacklist, instantiate_mock.return_value, ProcessingOptions(), None, None)
+            self.assertEqual((dt, '/tmp/1.csv', None), actual_result)
+
+
+    def test_process_datetime_hour_caches_result(self):
+
+        dt = datetime(2020, 1, 1, 1)
+        lines = [b'a page1 3 0', b'a page2 5 0']
+        writer = MagicMock()
+
+        with patch('src.pipeline.Wikimedia.get_pageview_lines', return_value=iter(lines)), \
+             patch('src.pipeline.ResultCache') as result_cache_mock, \
+             patch('click.echo'):
+            process_datetime_hour(dt, set(), writer, ProcessingOptions(result_cache_size=1024))
+
+        result_cache_mock.assert_called_once_with(1024)
+        result_cache_mock.return_value.set_pageviews.assert_called_once_with(dt, writer.write_pageviews.call_args.args[0])
+
+
+    def test_results_are_yielded_once_written_in_the_background(self):
+
+        datetime_hours = [datetime(2020, 1, 1, 1), datetime(2020, 1, 1, 2), datetime(2020, 1, 1, 3)]
+        compute_error, write_error = Exception('download failed'), Exception('upload failed')
+
+        def compute(datetime_hour, blacklist_keys, options, prefetcher, parser, metrics):
+            if datetime_hour == datetime(2020, 1, 1, 2):
+                raise compute_error
+            return [Pageview('a', 'page1', datetime_hour.hour)]
+
+        def write(pageviews, datetime_hour):
+            if datetime_hour == datetime(2020, 1, 1, 3):
+                raise write_error
+            return f'/tmp/{datetime_hour.hour}.csv'
+
+        with patch('src.pipeline.compute_datetime_hour', side_effect=compute), \
+             patch('src.pipeline.Writer.instantiate_writer') as instantiate_writer_mock, \
+             patch('click.echo'):
+            instantiate_writer_mock.return_value.write_pageviews.side_effect = write
+
+            actual_results = list(process_datetime_hours(datetime_hours, set(), '/tmp',
+                                                         options=ProcessingOptions(write_queue_size=2)))
+
+        self.assertEqual({(datetime(2020, 1, 1, 1), '/tmp/1.csv', None),
+                          (datetime(2020, 1, 1, 2), None, compute_error),
+                          (datetime(2020, 1, 1, 3), None, write_error)}, set(actual_results))
+
+
+    def test_process_datetime_hour_persists_the_aggregate(self):
+
+        dt = datetime(2020, 1, 1, 1)
+        lines = [b'a page%d %d 0' % (i, i) for i in range(1, 31)]
+
+        # an aggregate size under 25 doesn't cut the result of the hour below the top 25
+        for aggregate_size, expected_threshold in ((2, 6), (27, 4)):
+            writer = MagicMock()
+            with tempfile.TemporaryDirectory() as aggregate_dir, \
+                 patch.object(AggregateStore, 'DIR_PATH', aggregate_dir), \
+                 patch('src.pipeline.Wikimedia.get_pageview_lines', return_value=iter(lines)), \
+                 patch('click.echo'):
+                process_datetime_hour(dt, set(), writer, ProcessingOptions(aggregate_size=aggregate_size))
+
+                aggregate = AggregateStore(aggregate_dir).get_aggregate(dt)
+
+            self.assertEqual(max(25, aggregate_size), len(aggregate.rows_per_domain[b'a']))
+            self.assertEqual({b'a': expected_threshold}, aggregate.thresholds)
+            self.assertEqual([Pageview('a', f'page{i}', i) for i in range(6, 31)],
+                             writer.write_pageviews.call_args.args[0])
+
+
+    def test_process_datetime_hour_exports_its_metrics(self):
+
+        dt = datetime(2020, 1, 1, 1)
+
+        def get_lines(datetime_hour, stage_to_disk, metrics):
+            return metrics.timed('decompress', iter([b'a page1 3 0\n', b'a page2 5 0\n', b'a page3 4 0\n']),
+                                 count_lines=True)
+
+        for engine in Engine.ENGINE_NAMES:
+            try:
+                Engine.instantiate_engine(engine)
+            except ImportError:
+                continue
+            with tempfile.TemporaryDirectory() as output_dir, \
+                 patch('src.pipeline.Wikimedia.get_pageview_lines', side_effect=get_lines), \
+                 patch('src.pipeline.MetricsExporter') as exporter_mock, \
+                 patch('click.echo'):
+                result_path = process_datetime_hour(dt, {(b'a', b'page2')}, LocalWriter(output_dir),
+                                                    ProcessingOptions(engine=engine, metrics_dir='/tmp/metrics'))
+
+                exporter_mock.assert_called_once_with('/tmp/metrics')
+                metrics = exporter_mock.return_value.export.call_args.args[0]
+                self.assertEqual(['decompress', 'parse_rank', 'sort', 'write'], sorted(metrics.stages))
+                self.assertEqual((3, 2), (metrics.stages['parse_rank'].rows_in, metrics.stages['parse_rank'].rows_out))
+                self.assertEqual(2, metrics.stages['write'].rows_in)
+                self.assertEqual(os.path.getsize(result_path), metrics.stages['write'].bytes)
+                # the default blacklist is a plain set, its hits are counted by the engines
+                self.assertEqual(1, metrics.blacklisted_rows)
+
+
+    def test_process_datetime_hour_saves_its_profile(self):
+
+        dt = datetime(2020, 1, 1, 1)
+        writer = MagicMock()
+
+        with patch('src.pipeline.Wikimedia.get_pageview_lines', return_value=iter([b'a page1 3 0'])), \
+             patch('click.echo'):
+            process_datetime_hour(dt, set(), writer, ProcessingOptions(profile='cpu', profile_top=5))
+
+        writer.write_pageviews.assert_called_once()
+        content, profile_dt, extension = writer.write_bytes.call_args.args
+        self.assertEqual((dt, 'prof'), (profile_dt, extension))
+        self.assertTrue(content)